@@ -0,0 +1,87 @@
+#!/usr/bin/python
+import os
+import time
+import tempfile
+import tracemalloc
+import argparse
+import numpy as np
+import nibabel as nb
+import hcprep
+from hcprep.preprocess._utils import _cleaning_operator
+
+
+def make_run(path, shape, n_volumes, seed=0):
+    """Write a synthetic task-fMRI run and its brain mask
+    to path and return a matching subject_data dict."""
+    rng = np.random.RandomState(seed)
+    affine = np.diag([2., 2., 2., 1.])
+    func_file = os.path.join(path, 'func.nii.gz')
+    mask_file = os.path.join(path, 'mask.nii.gz')
+    func = (rng.randn(*shape, n_volumes) * 10 + 100).astype(np.float32)
+    nb.save(nb.Nifti1Image(func, affine), func_file)
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[tuple(slice(s//8, s-s//8) for s in shape)] = 1
+    nb.save(nb.Nifti1Image(mask, affine), mask_file)
+    trial_type = np.zeros(n_volumes)
+    trial_type[::4] = np.nan
+    return {'tr': 0.72,
+            'LR': {'func_mni': func_file,
+                   'func_mask_mni': mask_file,
+                   'trial_type': trial_type}}
+
+
+def run(subject_data, dtype, batched):
+    # every run computes the shared cleaning operator anew
+    _cleaning_operator.cache_clear()
+    tracemalloc.start()
+    t0 = time.time()
+    volumes, mask, volume_labels = hcprep.preprocess.preprocess_subject_data(
+        subject_data, ['LR'], high_pass=1./128., smoothing_fwhm=3,
+        return_masked=True, batched=batched, dtype=dtype)
+    seconds = time.time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return volumes, seconds, peak
+
+
+if __name__ == "__main__":
+
+    # setup parser
+    ap = argparse.ArgumentParser()
+    # add arguments to parser
+    ap.add_argument("--shape", required=False, default='64,76,64',
+                    help="x,y,z shape of the synthetic volumes")
+    ap.add_argument("--n_volumes", required=False, default=200, type=int,
+                    help="number of volumes of the synthetic run")
+    ap.add_argument("--batched", required=False, action='store_true',
+                    help="clean with the shared cleaning operator")
+    ap.add_argument("--repeats", required=False, default=3, type=int,
+                    help="number of timed runs per precision")
+    args = vars(ap.parse_args())
+    shape = tuple(int(s) for s in args['shape'].split(','))
+
+    dtypes = [np.float64, np.float32]
+    with tempfile.TemporaryDirectory() as path:
+        subject_data = make_run(path, shape, args['n_volumes'])
+        # warm up imports, file caches and first-call overheads
+        run(subject_data, np.float64, args['batched'])
+        results = {dtype: [] for dtype in dtypes}
+        for repeat in range(args['repeats']):
+            # alternate the order of the precisions between repeats
+            for dtype in (dtypes if repeat % 2 == 0 else dtypes[::-1]):
+                results[dtype].append(run(subject_data, dtype, args['batched']))
+
+    summary = {}
+    for dtype in dtypes:
+        seconds = np.median([seconds for _, seconds, _ in results[dtype]])
+        peak = max(peak for _, _, peak in results[dtype])
+        summary[dtype] = (results[dtype][0][0], seconds, peak)
+        print('{}: {:.2f}s (median of {}), peak memory: {:.1f} MB'.format(
+            np.dtype(dtype).name, seconds, args['repeats'], peak / 1024**2))
+
+    volumes64, seconds64, peak64 = summary[np.float64]
+    volumes32, seconds32, peak32 = summary[np.float32]
+    print('float32 vs. float64: {:.2f}x runtime, {:.2f}x peak memory, '
+          'max. abs. difference: {:.2e}'.format(
+              seconds32 / seconds64, peak32 / peak64,
+              np.abs(volumes32 - volumes64).max()))
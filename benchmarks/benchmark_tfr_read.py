@@ -0,0 +1,89 @@
+#!/usr/bin/python
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+import tensorflow as tf
+import hcprep
+
+
+def consume(dataset, n_epochs):
+    """Iterate over dataset like a dummy model would
+    and return the number of delivered volumes and
+    the elapsed seconds."""
+    n_volumes = 0
+    t0 = time.time()
+    for _ in range(n_epochs):
+        for batch in dataset:
+            volume = np.asarray(batch[0])
+            volume.sum()
+            n_volumes += volume.shape[0]
+    return n_volumes, time.time() - t0
+
+
+if __name__ == "__main__":
+
+    # setup parser
+    ap = argparse.ArgumentParser()
+    # add arguments to parser
+    ap.add_argument("--shape", required=False, default='91,109,91',
+                    help="x,y,z shape of the synthetic volumes")
+    ap.add_argument("--n_volumes", required=False, default=400, type=int,
+                    help="number of synthetic volumes")
+    ap.add_argument("--n_shards", required=False, default=8, type=int,
+                    help="number of TFRecord shards")
+    ap.add_argument("--batch_size", required=False, default=32, type=int,
+                    help="number of volumes per batch")
+    ap.add_argument("--layout", required=False, default='masked',
+                    choices=['full', 'bbox', 'masked'],
+                    help="voxels stored per volume")
+    ap.add_argument("--rebuild_full", required=False, action='store_true',
+                    help="unmask volumes to their full grid while reading")
+    ap.add_argument("--n_epochs", required=False, default=2, type=int,
+                    help="number of epochs read from each dataset")
+    args = vars(ap.parse_args())
+    shape = tuple(int(s) for s in args['shape'].split(','))
+
+    # HCP data information
+    n_classes_per_task = [2, 3, 2, 5, 2, 2, 4]
+
+    rng = np.random.RandomState(0)
+    mask = np.zeros(shape, dtype=bool)
+    mask[tuple(slice(s//8, s-s//8) for s in shape)] = True
+    volumes = rng.randn(args['n_volumes'], int(mask.sum())).astype(np.float32)
+    volume_labels = rng.randint(0, 4, args['n_volumes'])
+    metadata = hcprep.convert.make_tfr_metadata(
+        mask, layout=args['layout'], n_classes_per_task=n_classes_per_task)
+
+    with tempfile.TemporaryDirectory() as path:
+        shards = hcprep.convert.write_tfr_shards(
+            [(volumes, mask, volume_labels, 0, 6, 0)], path, args['n_shards'],
+            n_classes_per_task, metadata,
+            n_workers=min(args['n_shards'], os.cpu_count()))['shards']
+
+        # one example parsed at a time
+        per_example = tf.data.TFRecordDataset(shards).map(
+            lambda x: hcprep.convert.parse_tfr(x, metadata=metadata,
+                                             rebuild_full=args['rebuild_full'])
+        ).batch(args['batch_size'])
+        # interleaved, batched before parsing and prefetched
+        batched = hcprep.convert.make_tfr_dataset(
+            shards, metadata, args['batch_size'], rebuild_full=args['rebuild_full'])
+        cached = hcprep.convert.make_tfr_dataset(
+            shards, metadata, args['batch_size'], rebuild_full=args['rebuild_full'],
+            cache=True)
+
+        # without tensorflow
+        class NumpyBatches(object):
+            def __iter__(self):
+                return hcprep.convert.iter_tfr_batches_numpy(
+                    shards, metadata, args['batch_size'], rebuild_full=args['rebuild_full'])
+
+        for name, dataset in [('parse_tfr', per_example),
+                              ('make_tfr_dataset', batched),
+                              ('make_tfr_dataset (cache)', cached),
+                              ('iter_tfr_batches_numpy', NumpyBatches())]:
+            n_volumes, seconds = consume(dataset, args['n_epochs'])
+            print('{}: {:.1f} volumes/sec ({} volumes in {:.2f}s)'.format(
+                name, n_volumes / seconds, n_volumes, seconds))
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+import tensorflow as tf
+import hcprep
+
+
+def run(volumes, volume_labels, metadata, n_classes_per_task, tfr_file, encoding):
+    t0 = time.time()
+    tfr_writers = [tf.io.TFRecordWriter(tfr_file)]
+    hcprep.convert.write_to_tfr(tfr_writers,
+                                volumes,
+                                volume_labels,
+                                subject_id=100307,
+                                task_id=6,
+                                run_id=0,
+                                n_classes_per_task=n_classes_per_task,
+                                randomize_volumes=True,
+                                metadata=metadata,
+                                encoding=encoding)
+    [w.close() for w in tfr_writers]
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+
+    # setup parser
+    ap = argparse.ArgumentParser()
+    # add arguments to parser
+    ap.add_argument("--shape", required=False, default='91,109,91',
+                    help="x,y,z shape of the synthetic volumes")
+    ap.add_argument("--n_volumes", required=False, default=100, type=int,
+                    help="number of synthetic volumes")
+    args = vars(ap.parse_args())
+    shape = tuple(int(s) for s in args['shape'].split(','))
+
+    # HCP data information
+    n_classes_per_task = [2, 3, 2, 5, 2, 2, 4]
+
+    rng = np.random.RandomState(0)
+    volumes = rng.randn(*shape, args['n_volumes']).astype(np.float32)
+    volume_labels = rng.randint(0, 4, args['n_volumes'])
+    metadata = hcprep.convert.make_tfr_metadata(
+        shape=shape, n_classes_per_task=n_classes_per_task)
+
+    with tempfile.TemporaryDirectory() as path:
+        for encoding in ['float_list', 'raw']:
+            tfr_file = os.path.join(path, encoding+'.tfrecords')
+            seconds = run(volumes, volume_labels, metadata,
+                          n_classes_per_task, tfr_file, encoding)
+            size = os.path.getsize(tfr_file)
+            print('{}: {:.1f} volumes/sec, {:.1f} MB/sec ({:.1f} MB in {:.2f}s)'.format(
+                encoding, args['n_volumes'] / seconds, size / 1024**2 / seconds,
+                size / 1024**2, seconds))
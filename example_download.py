@@ -18,6 +18,8 @@ if __name__ == '__main__':
                     help="output path to store data")
     ap.add_argument("--n_subjects", required=False,
                     help="number of subjects to download per HCP task")
+    ap.add_argument("--n_workers", required=False,
+                    help="number of concurrent transfers")
     args = vars(ap.parse_args())
     # set variables
     ACCESS_KEY = str(args['ACCESS_KEY'])
@@ -34,13 +36,18 @@ if __name__ == '__main__':
     else:
         n_subjects = 2
     print('n_subjects to download: {}'.format(n_subjects))
+    if args['n_workers'] is not None:
+        n_workers = int(args['n_workers'])
+    else:
+        n_workers = 8
 
     # HCP data information
     hcp_info = hcprep.info.basics()    
 
     # download subject data
-    for task in hcp_info.tasks:
-        for subject in hcp_info.subjects[task][:n_subjects]:
-            for run in hcp_info.runs:
-                hcprep.download.download_subject_data(
-                    ACCESS_KEY, SECRET_KEY, subject, task, run, output_path)
+    jobs = [(subject, task, run)
+            for task in hcp_info.tasks
+            for subject in hcp_info.subjects[task][:n_subjects]
+            for run in hcp_info.runs]
+    hcprep.download.download_subjects_data(
+        ACCESS_KEY, SECRET_KEY, jobs, output_path, n_workers=n_workers)
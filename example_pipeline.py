@@ -0,0 +1,52 @@
+#!/usr/bin/python
+import argparse
+import hcprep
+
+
+if __name__ == '__main__':
+
+    # setup parser
+    ap = argparse.ArgumentParser()
+    # add arguments to parser
+    ap.add_argument("--ACCESS_KEY", required=True,
+                    help="AWS S3 access key")
+    ap.add_argument("--SECRET_KEY", required=True,
+                    help="AWS S3 secret key")
+    ap.add_argument("--path", required=False,
+                    help="output path to store data")
+    ap.add_argument("--n_subjects", required=False,
+                    help="number of subjects to process per HCP task")
+    ap.add_argument("--delete_raw", action='store_true',
+                    help="delete raw NIfTI files once converted")
+    args = vars(ap.parse_args())
+    # set variables
+    ACCESS_KEY = str(args['ACCESS_KEY'])
+    SECRET_KEY = str(args['SECRET_KEY'])
+    if args['path'] is not None:
+        path = str(args['path'])
+        print('Path: {}'.format(path))
+    else:
+        path = 'data/'
+        print('"path" not defined. Defaulting to: {}'.format(path))
+    if args['n_subjects'] is not None:
+        n_subjects = int(args['n_subjects'])
+    else:
+        n_subjects = 2
+    print('n_subjects to process: {}'.format(n_subjects))
+
+    # HCP data information
+    hcp_info = hcprep.info.basics()
+
+    # download, preprocess and convert subject data
+    jobs = [(subject, task, run)
+            for task in hcp_info.tasks
+            for subject in hcp_info.subjects[task][:n_subjects]
+            for run in hcp_info.runs]
+    hcprep.pipeline.run_pipeline(ACCESS_KEY, SECRET_KEY, jobs,
+                                 path=path,
+                                 tfr_path=path+'tfr/',
+                                 high_pass=1./128.,
+                                 smoothing_fwhm=3,
+                                 delete_raw=args['delete_raw'],
+                                 hcp_info=hcp_info,
+                                 verbose=True)
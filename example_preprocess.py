@@ -2,7 +2,6 @@
 import os
 import argparse
 import numpy as np
-import tensorflow as tf
 import hcprep
 
 
@@ -13,7 +12,34 @@ if __name__ == "__main__":
     # add arguments to parser
     ap.add_argument("--path", required=False,
                     help="path to local BIDS data")
+    ap.add_argument("--memory_budget", required=False,
+                    help="maximum memory (in GB) used for preprocessing")
+    ap.add_argument("--cache_path", required=False,
+                    help="path to cache of cleaned runs")
+    ap.add_argument("--cache_size", required=False,
+                    help="maximum size (in GB) of the cache")
+    ap.add_argument("--layout", required=False, default='full',
+                    choices=['full', 'bbox', 'masked'],
+                    help="voxels stored per volume: full grid, bounding box "
+                         "or in-mask voxels of the cohort mask")
+    ap.add_argument("--n_shards", required=False, type=int,
+                    help="write all runs to this number of TFRecord shards "
+                         "(instead of one file per run)")
+    ap.add_argument("--global_shuffle", required=False, action='store_true',
+                    help="shuffle the volumes of all runs across subjects "
+                         "before writing them to the shards (with --n_shards)")
+    ap.add_argument("--dtype", required=False, default='float32',
+                    choices=['float32', 'float16', 'int16'],
+                    help="precision in which volumes are stored")
+    ap.add_argument("--compression", required=False, choices=['GZIP', 'ZLIB'],
+                    help="compression of the TFRecord files")
+    ap.add_argument("--index", required=False, action='store_true',
+                    help="write an index of the records next to each "
+                         "(uncompressed) TFRecord file")
     args = vars(ap.parse_args())
+    if args['index'] and args['compression'] is not None:
+        ap.error('--index is only supported for uncompressed TFRecord files '
+                 '(without --compression)')
     # set variables
     if args['path'] is not None:
         path = str(args['path'])
@@ -21,10 +47,20 @@ if __name__ == "__main__":
     else:
         path = 'data/'
         print('"path" not defined. Defaulting to: {}'.format(path))
+    if args['memory_budget'] is not None:
+        memory_budget = int(float(args['memory_budget']) * 1024**3)
+    else:
+        memory_budget = None
+    if args['cache_path'] is not None:
+        cache_size = args['cache_size']
+        cache = hcprep.preprocess.PreprocessCache(
+            str(args['cache_path']),
+            max_bytes=int(float(cache_size) * 1024**3) if cache_size is not None else None)
+    else:
+        cache = None
     
     # extract subject IDs
-    subjects = [int(f.split('sub-')[1])
-                for f in os.listdir(path) if 'sub' in f]
+    subjects = hcprep.paths.BIDSLayout(path).get_subjects()
 
     # HCP data information
     hcp_info = hcprep.info.basics()
@@ -36,28 +72,58 @@ if __name__ == "__main__":
     # write data
     print('Processing these tasks: {}, with each {} subjects and {} runs.\n'.format(
         hcp_info.tasks, len(subjects), len(hcp_info.runs)))
-    for subject_id, subject in enumerate(subjects):
-        print('Processing subject: {}/{}'.format(subject_id+1, len(subjects)))
-        for task_id, task in enumerate(hcp_info.tasks):
-            for run_id, run in enumerate(hcp_info.runs):
-                # create TFR-writers
-                tfr_writers = [tf.python_io.TFRecordWriter(
-                    tfr_path+'task-{}_subject-{}_run-{}.tfrecords'.format(
-                        task, subject, run))]
-                # load subject data
-                subject_data = hcprep.data.load_subject_data(
-                    task, subject, [run], path, hcp_info.t_r)
-                # preprocess subject data
-                volumes, volume_labels = hcprep.preprocess.preprocess_subject_data(
-                    subject_data, [run], high_pass=1./128., smoothing_fwhm=3)
-                # write preprocessed data to TFR
-                hcprep.convert.write_to_tfr(tfr_writers,
-                                            volumes.get_data(),
-                                            volume_labels,
-                                            subject_id,
-                                            task_id,
-                                            run_id,
-                                            hcp_info.n_classes_per_task,
-                                            randomize_volumes=True)
-                # close writers
-                [w.close() for w in tfr_writers]
+    jobs = [(subject, task, run)
+            for subject in subjects
+            for task in hcp_info.tasks
+            for run in hcp_info.runs]
+    # dataset metadata
+    if args['layout'] != 'full':
+        cohort_mask = hcprep.convert.build_cohort_mask(jobs, path, mode='union')
+    else:
+        cohort_mask = None
+    metadata = hcprep.convert.make_tfr_metadata(
+        cohort_mask, layout=args['layout'],
+        n_classes_per_task=hcp_info.n_classes_per_task,
+        shape=(91, 109, 91), dtype=args['dtype'],
+        compression=args['compression'])
+    hcprep.convert.write_tfr_metadata(metadata, tfr_path+'metadata.json')
+    if args['n_shards'] is not None:
+        # preprocess subject data in parallel and write all runs to shards
+        runs = ((volumes, mask, volume_labels, subjects.index(subject),
+                 hcp_info.tasks.index(task), hcp_info.runs.index(run))
+                for (subject, task, run), volumes, mask, volume_labels in
+                hcprep.preprocess.preprocess_subjects_data(
+                    jobs, path, hcp_info.t_r, high_pass=1./128., smoothing_fwhm=3,
+                    memory_budget=memory_budget, cache=cache, return_masked=True))
+        shards = hcprep.convert.write_tfr_shards(
+            runs, tfr_path, args['n_shards'], hcp_info.n_classes_per_task, metadata,
+            assignment='round_robin', n_workers=min(args['n_shards'], os.cpu_count()),
+            global_shuffle=args['global_shuffle'], index=args['index'])
+        print('Wrote {} volumes to {} shards.'.format(
+            sum(shards['n_volumes']), len(shards['shards'])))
+    else:
+        # preprocess subject data in parallel
+        for (subject, task, run), volumes, volume_labels in hcprep.preprocess.preprocess_subjects_data(
+                jobs, path, hcp_info.t_r, high_pass=1./128., smoothing_fwhm=3,
+                memory_budget=memory_budget, cache=cache):
+            print('Writing: task-{} subject-{} run-{}'.format(task, subject, run))
+            # create TFR-writers
+            tfr_file = tfr_path+'task-{}_subject-{}_run-{}.tfrecords'.format(
+                task, subject, run)
+            if args['index']:
+                tfr_writers = [hcprep.convert.IndexedTFRecordWriter(tfr_file)]
+            else:
+                tfr_writers = [hcprep.convert.TFRecordFileWriter(
+                    tfr_file, compression=args['compression'])]
+            # write preprocessed data to TFR
+            hcprep.convert.write_to_tfr(tfr_writers,
+                                        volumes.get_fdata(dtype=np.float32),
+                                        volume_labels,
+                                        subjects.index(subject),
+                                        hcp_info.tasks.index(task),
+                                        hcp_info.runs.index(run),
+                                        hcp_info.n_classes_per_task,
+                                        randomize_volumes=True,
+                                        metadata=metadata)
+            # close writers
+            [w.close() for w in tfr_writers]
@@ -1,12 +1,16 @@
 #!/usr/bin/python
 
+__version__ = '0.1.0'
+
 from . import info
 from . import download
 from . import paths
 from . import data
 from . import preprocess
 from . import convert
+from . import pipeline
 
 __all__ = ['info', 'download', 'paths',
-		   'data', 'preprocess', 'convert']
+		   'data', 'preprocess', 'convert',
+		   'pipeline']
 
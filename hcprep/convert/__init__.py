@@ -1,4 +1,19 @@
 #!/usr/bin/python
-from .convert import write_to_tfr, parse_tfr
+from .convert import write_to_tfr, parse_tfr, parse_tfr_batch
+from .metadata import build_cohort_mask, make_tfr_metadata, write_tfr_metadata, read_tfr_metadata
+from .shards import write_tfr_shards
+from .index import (IndexedTFRecordWriter, tfr_index_filename, read_tfr_index,
+                    select_tfr_records, read_tfr_records, sample_tfr_batches)
+from .dataset import make_tfr_dataset
+from .records import (TFRecordFileWriter, iter_tfr_records, parse_tfr_numpy,
+                      iter_tfr_batches_numpy, crc32c, masked_crc32c)
 
-__all__ = ['write_to_tfr', 'parse_tfr']
+__all__ = ['write_to_tfr', 'parse_tfr', 'parse_tfr_batch',
+           'build_cohort_mask', 'make_tfr_metadata',
+           'write_tfr_metadata', 'read_tfr_metadata',
+           'write_tfr_shards',
+           'IndexedTFRecordWriter', 'tfr_index_filename', 'read_tfr_index',
+           'select_tfr_records', 'read_tfr_records', 'sample_tfr_batches',
+           'make_tfr_dataset',
+           'TFRecordFileWriter', 'iter_tfr_records', 'parse_tfr_numpy',
+           'iter_tfr_batches_numpy', 'crc32c', 'masked_crc32c']
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+import numpy as np
+
+
+_ENCODINGS = ['raw', 'float_list']
+_DTYPES = ['float32', 'float16', 'int16']
+_COMPRESSIONS = [None, 'GZIP', 'ZLIB']
+
+
+def _stored_voxel_idx(metadata):
+    """Return the flat (C-order) indices of the voxels of
+    the full (x, y, z) grid that are stored for each volume,
+    or None if the full grid is stored."""
+    if metadata is None or metadata['layout'] == 'full':
+        return None
+    shape = metadata['shape']
+    if metadata['layout'] == 'bbox':
+        grid_idx = np.arange(int(np.prod(shape))).reshape(shape)
+        return grid_idx[tuple(slice(start, stop) for start, stop in metadata['bbox'])].reshape(-1)
+    return np.flatnonzero(np.asarray(metadata['mask']).reshape(-1))
+
+
+def _volume_reader(X, mask=None, metadata=None):
+    """Return the number of volumes in fMRI data X and
+    a function that returns the float32 vector of the
+    stored voxels of a volume, given its index.
+
+    Args:
+        X: Ndarray of the fMRI volumes (x, y, z, volumes),
+            or, if mask is given, of the in-mask voxels
+            (volumes x voxels).
+        mask: Boolean ndarray (x, y, z) of the brain mask
+            of compact X.
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata, defining
+            which voxels are stored.
+    """
+    if mask is not None:
+        shape = mask.shape
+        n_volumes = X.shape[0]
+    else:
+        shape = X.shape[:3]
+        n_volumes = X.shape[3]
+    if metadata is not None and list(metadata['shape']) != list(shape):
+        raise ValueError('Shape of fMRI data {} does not match the metadata {}.'.format(
+            tuple(shape), tuple(metadata['shape'])))
+    stored_idx = _stored_voxel_idx(metadata)
+    n_grid = int(np.prod(shape))
+
+    if mask is None:
+        def read(vi):
+            volume = np.array(X[:, :, :, vi].reshape(n_grid), dtype=np.float32)
+            if stored_idx is not None:
+                volume = volume[stored_idx]
+            return volume
+        return n_volumes, read
+
+    mask_idx = np.flatnonzero(mask.reshape(-1))
+    if stored_idx is None:
+        # unmask into one reused buffer
+        buffer = np.zeros(n_grid, dtype=np.float32)
+
+        def read(vi):
+            buffer[mask_idx] = X[vi]
+            return buffer
+        return n_volumes, read
+
+    # map the stored voxels directly to the columns of X
+    column = np.full(n_grid, -1)
+    column[mask_idx] = np.arange(mask_idx.size)
+    column = column[stored_idx]
+    in_mask = np.flatnonzero(column >= 0)
+    column = column[in_mask]
+    buffer = np.zeros(stored_idx.size, dtype=np.float32)
+
+    def read(vi):
+        buffer[in_mask] = X[vi][column]
+        return buffer
+    return n_volumes, read
+
+
+def _varint(value):
+    """Return the protobuf varint encoding of an integer."""
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    """Return the varint at position pos of buf
+    and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _length_delimited(field, payload):
+    """Return a length-delimited protobuf field."""
+    return _varint(field << 3 | 2) + _varint(len(payload)) + payload
+
+
+# tf.train.Feature fields of each kind of feature
+_FEATURE_FIELDS = {'bytes': 1, 'float': 2, 'int64': 3}
+
+
+def _int64_feature(values):
+    return ('int64', b''.join(_varint(int(v)) for v in values))
+
+
+def _float_feature(values):
+    return ('float', np.asarray(values, dtype='<f4').tobytes())
+
+
+def _bytes_feature(values):
+    return ('bytes', b''.join(_length_delimited(1, v) for v in values))
+
+
+def _encode_feature(feature):
+    """Return the serialized tf.train.Feature of a feature."""
+    kind, payload = feature
+    if kind != 'bytes' and payload:
+        # int64 and float lists are packed
+        payload = _length_delimited(1, payload)
+    return _length_delimited(_FEATURE_FIELDS[kind], payload)
+
+
+def _encode_example(features):
+    """Return the serialized tf.train.Example of a dict of
+    features, with the same bytes as
+    tf.train.Example.SerializeToString (map entries
+    are serialized in the order of features)."""
+    entries = b''.join(
+        _length_delimited(1, _length_delimited(1, name.encode()) +
+                          _length_delimited(2, _encode_feature(feature)))
+        for name, feature in features.items())
+    return _length_delimited(1, entries)
+
+
+def _iter_fields(buf, start, stop):
+    """Iterate over the (field, wire type, value) of the protobuf
+    message buf[start:stop]. Values of length-delimited fields
+    are returned as (start, stop) positions in buf."""
+    pos = start
+    while pos < stop:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = buf[pos:pos+8], pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = (pos, pos + length), pos + length
+        elif wire_type == 5:
+            value, pos = buf[pos:pos+4], pos + 4
+        else:
+            raise ValueError('Invalid protobuf wire type: {}'.format(wire_type))
+        yield field, wire_type, value
+
+
+def _decode_feature(buf, start, stop):
+    """Return the (kind, value) of a serialized tf.train.Feature,
+    with value as an int64 or float32 ndarray or as a list of
+    (start, stop) positions of the bytes values in buf."""
+    for field, wire_type, value in _iter_fields(buf, start, stop):
+        if field == _FEATURE_FIELDS['bytes']:
+            return 'bytes', [v for f, w, v in _iter_fields(buf, *value) if f == 1 and w == 2]
+        if field == _FEATURE_FIELDS['float']:
+            values = []
+            for f, w, v in _iter_fields(buf, *value):
+                if w == 2:
+                    values.append(np.frombuffer(buf[v[0]:v[1]], dtype='<f4'))
+                elif w == 5:
+                    values.append(np.frombuffer(v, dtype='<f4'))
+            return 'float', (np.concatenate(values) if len(values) != 1 else values[0])
+        if field == _FEATURE_FIELDS['int64']:
+            values = []
+            for f, w, v in _iter_fields(buf, *value):
+                if w == 2:
+                    pos = v[0]
+                    while pos < v[1]:
+                        value, pos = _read_varint(buf, pos)
+                        values.append(value)
+                elif w == 0:
+                    values.append(v)
+            return 'int64', np.array(values, dtype=np.uint64).astype(np.int64)
+    return None, None
+
+
+def _decode_example(record):
+    """Return the features of a serialized tf.train.Example
+    as a dict of (kind, value), as returned by _decode_feature,
+    with buf being a memoryview of record."""
+    buf = memoryview(record)
+    features = {}
+    for field, _, value in _iter_fields(buf, 0, len(buf)):
+        if field != 1:
+            continue
+        for f, _, entry in _iter_fields(buf, *value):
+            if f != 1:
+                continue
+            name, feature = None, None
+            for ef, _, ev in _iter_fields(buf, *entry):
+                if ef == 1:
+                    name = bytes(buf[ev[0]:ev[1]]).decode()
+                elif ef == 2:
+                    feature = ev
+            features[name] = _decode_feature(buf, *feature) if feature else (None, None)
+    return buf, features
+
+
+def _label_features(label, task_id, n_classes_per_task):
+    """Return the label and one-hot label features of a label."""
+    label_onehot = [np.zeros(nc, dtype=np.int64) for nc in n_classes_per_task]
+    label_onehot[task_id][label] = 1
+    return (_int64_feature([label]),
+            _int64_feature(np.concatenate(label_onehot)))
+
+
+def _volume_features(volume, encoding='raw', dtype='float32'):
+    """Return the features of a volume, serialized with
+    the given encoding and (quantized) dtype."""
+    if encoding == 'float_list':
+        if dtype != 'float32':
+            raise ValueError('The float_list encoding only supports float32 volumes.')
+        return {'volume': _float_feature(volume)}
+    features = {}
+    if dtype == 'int16':
+        # scale each volume to the full int16 range
+        scale = float(np.max(np.abs(volume))) / 32767. if volume.size else 0.
+        if scale == 0 or not np.isfinite(scale):
+            scale = 1.
+        volume = np.round(volume / scale).astype('<i2')
+        features['volume_scale'] = _float_feature([scale])
+    elif dtype == 'float16':
+        volume = volume.astype('<f2')
+    else:
+        volume = volume.astype('<f4', copy=False)
+    features['volume'] = _bytes_feature([volume.tobytes()])
+    return features
+
+
+def _serialize_example(volume_features, volume_idx, label_features, id_features):
+    """Return the serialized tf.train.Example of a volume."""
+    label, label_onehot = label_features
+    feature = dict(id_features)
+    feature.update(volume_features)
+    feature['volume_idx'] = _int64_feature([volume_idx])
+    feature['label'] = label
+    feature['label_onehot'] = label_onehot
+    return _encode_example(feature)
+
+
+def _tfr_features(n_stored, n_classes, encoding='raw', dtype='float32'):
+    """Return the feature spec to parse examples
+    written by hcprep.convert.write_to_tfr."""
+    import tensorflow as tf
+    if encoding == 'raw':
+        volume_feature = tf.io.FixedLenFeature([], tf.string)
+    else:
+        volume_feature = tf.io.FixedLenFeature([n_stored], tf.float32)
+    features = {'volume': volume_feature,
+                'task_id': tf.io.FixedLenFeature([1], tf.int64),
+                'subject_id': tf.io.FixedLenFeature([1], tf.int64),
+                'run_id': tf.io.FixedLenFeature([1], tf.int64),
+                'volume_idx': tf.io.FixedLenFeature([1], tf.int64),
+                'label': tf.io.FixedLenFeature([1], tf.int64),
+                'label_onehot': tf.io.FixedLenFeature([n_classes], tf.int64)}
+    if dtype == 'int16':
+        features['volume_scale'] = tf.io.FixedLenFeature([1], tf.float32)
+    return features
+
+
+def _decode_volumes(parsed_features, n_stored, encoding='raw', dtype='float32',
+                    batched=False):
+    """Return the float32 stored voxels of parsed (and
+    possibly batched) volumes, dequantized if needed."""
+    import tensorflow as tf
+    volume_flat = parsed_features['volume']
+    if encoding == 'raw':
+        volume_flat = tf.io.decode_raw(volume_flat, getattr(tf, dtype),
+                                       little_endian=True)
+        volume_flat = tf.cast(volume_flat, tf.float32)
+    volume_flat = tf.reshape(volume_flat, ([-1] if batched else []) + [n_stored])
+    if dtype == 'int16':
+        volume_flat = volume_flat * parsed_features['volume_scale']
+    return volume_flat
+
+
+def _unmask_volumes(volume_flat, stored_idx, n_grid):
+    """Place the stored voxels of (batched) volumes back
+    into their flat full grid, with zeros elsewhere."""
+    import tensorflow as tf
+    gather_idx = np.full(n_grid, stored_idx.size, dtype=np.int64)
+    gather_idx[stored_idx] = np.arange(stored_idx.size)
+    padded = tf.concat([volume_flat, tf.zeros_like(volume_flat[..., :1])], axis=-1)
+    return tf.gather(padded, gather_idx, axis=-1)
@@ -1,17 +1,28 @@
 #!/usr/bin/python
 import numpy as np
-import tensorflow as tf
+
+from ._utils import (_ENCODINGS, _stored_voxel_idx, _volume_reader, _int64_feature,
+                     _label_features, _volume_features, _serialize_example,
+                     _tfr_features, _decode_volumes, _unmask_volumes)
+from .index import _write_record
 
 
 def write_to_tfr(tfr_writers,
                  fMRI_data, volume_labels,
                  subject_id, task_id, run_id, n_classes_per_task,
-                 randomize_volumes=True):
+                 randomize_volumes=True, mask=None, metadata=None, encoding=None):
     """Writes fMRI volumes and labels to TFRecord files.
 
     Args:
         tfr_writers: A sequence of TFRecord writers to store the data
-        fMRI_data: Ndarray of the fMRI volumes
+            (tf.io.TFRecordWriter, hcprep.convert.TFRecordFileWriter or
+            hcprep.convert.IndexedTFRecordWriter, if the records
+            should be indexed)
+        fMRI_data: Ndarray of the fMRI volumes (x, y, z, volumes),
+            or, if mask is given, a compact ndarray of the
+            in-mask voxels (volumes x voxels), as returned by
+            hcprep.preprocess.preprocess_subject_data with
+            return_masked=True
         volume_labels: A sequence, containing one numeric label per 
             volume in fMRI_data
         subject_id: Integer ID of the subject that is stored in the
@@ -27,44 +38,82 @@ def write_to_tfr(tfr_writers,
         randomize_volumes: Bool indicating whether the sequence of 
             volume (incl. their corresponding label) should be
             randomized before storing them in the TFR-files.
+        mask: Nifti1Image or boolean ndarray (x, y, z) of the
+            brain mask of compact fMRI_data. Each volume is only
+            unmasked to its full (x, y, z) grid when it is written.
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata, defining whether
+            the full grid, the bounding box of the (cohort) mask
+            or only its in-mask voxels are stored for each
+            volume, and their precision. If None, the full
+            grid is stored as float32.
+        encoding: How volumes are serialized; one of:
+            "raw": as raw little-endian float32 bytes
+            "float_list": as a list of floats
+            Defaults to the encoding of metadata
+            or to "float_list" if no metadata is given.
 
     Returns:
         None
     """
-    X = np.array(fMRI_data)
+    X = np.asarray(fMRI_data)
     y = np.array(volume_labels)
-    nx, ny, nz, nv = X.shape
+    if mask is not None and not isinstance(mask, np.ndarray):
+        mask = np.asarray(mask.dataobj)
+    if mask is not None:
+        mask = np.asarray(mask).astype(bool)
+    nv, read_volume = _volume_reader(X, mask=mask, metadata=metadata)
+    if encoding is None:
+        encoding = metadata.get('encoding', 'float_list') if metadata is not None else 'float_list'
+    if encoding not in _ENCODINGS:
+        raise ValueError('Invalid encoding: {}'.format(encoding))
+    dtype = metadata.get('dtype', 'float32') if metadata is not None else 'float32'
     _vidx = np.arange(nv)
     if randomize_volumes:
         np.random.shuffle(_vidx)
-    for vi in _vidx:
-        writer = np.random.choice(tfr_writers)
-        label = np.int(y[vi])
-        label_onehot = [np.zeros(nc) for nc in n_classes_per_task]
-        label_onehot[task_id][label] = 1
-        label_onehot = np.concatenate(label_onehot)
-        volume = np.array(X[:, :, :, vi].reshape(
-            nx*ny*nz), dtype=np.float32)
-        v_sample = tf.train.Example(
-            features=tf.train.Features(
-                feature={'volume': tf.train.Feature(float_list=tf.train.FloatList(value=list(volume))),
-                         'task_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[np.int64(task_id)])),
-                         'subject_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[np.int64(subject_id)])),
-                         'run_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[np.int64(run_id)])),
-                         'volume_idx': tf.train.Feature(int64_list=tf.train.Int64List(value=[np.int64(vi)])),
-                         'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[np.int64(label)])),
-                         'label_onehot': tf.train.Feature(int64_list=tf.train.Int64List(value=list(label_onehot.astype(np.int64))))}))
-        serialized = v_sample.SerializeToString()
-        writer.write(serialized)
-
-def parse_tfr(example_proto, nx, ny, nz, n_classes, only_parse_XY=False):
+    writer_idx = np.random.randint(len(tfr_writers), size=nv)
+
+    # features that are identical for all volumes
+    # are only encoded once
+    id_features = {'task_id': _int64_feature([task_id]),
+                   'subject_id': _int64_feature([subject_id]),
+                   'run_id': _int64_feature([run_id])}
+    label_features = {label: _label_features(label, task_id, n_classes_per_task)
+                      for label in np.unique(y[_vidx].astype(int))}
+
+    for writer_i, vi in zip(writer_idx, _vidx):
+        serialized = _serialize_example(
+            _volume_features(read_volume(vi), encoding=encoding, dtype=dtype),
+            vi, label_features[int(y[vi])], id_features)
+        _write_record(tfr_writers[writer_i], serialized,
+                      subject_id, task_id, run_id, vi, y[vi])
+
+
+def parse_tfr(example_proto, nx=None, ny=None, nz=None, n_classes=None, only_parse_XY=False,
+              metadata=None, rebuild_full=False, encoding=None):
     """Parse TFR-data
 
     Args:
         example_proto: Single example from TFR-file
         nx, ny, nz: Integers indicating the x-/y-/z-dimensions
             of the fMRI data stored in the TFR-files
+            (not needed if metadata is given)
         n_classes: Total number of classes across tasks
+            (not needed if metadata is given)
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata (or read with
+            hcprep.convert.read_tfr_metadata), defining
+            how the volumes are stored. Quantized volumes
+            are dequantized to float32.
+        rebuild_full: Bool indicating whether volumes
+            that are stored cropped to a bounding box or as
+            in-mask voxels (see metadata) are placed back
+            into their full (x, y, z) grid. If False, these
+            are returned with their stored shape.
+        encoding: How volumes are serialized ("raw" or
+            "float_list"; see hcprep.convert.write_to_tfr).
+            Defaults to the encoding of metadata or to
+            "float_list" if no metadata is given.
 
     Returns:
         Parsed data stored in TFR-files. Specifically, the:
@@ -84,16 +133,26 @@ def parse_tfr(example_proto, nx, ny, nz, n_classes, only_parse_XY=False):
             volume, task_id, subject_id, run_id, volume_idx,
             label, label_onehot are returned
     """
-    features = {'volume': tf.FixedLenFeature([nx*ny*nz], tf.float32),
-                'task_id': tf.FixedLenFeature([1], tf.int64),
-                'subject_id': tf.FixedLenFeature([1], tf.int64),
-                'run_id': tf.FixedLenFeature([1], tf.int64),
-                'volume_idx': tf.FixedLenFeature([1], tf.int64),
-                'label': tf.FixedLenFeature([1], tf.int64),
-                'label_onehot': tf.FixedLenFeature([n_classes], tf.int64)}
-    parsed_features = tf.parse_single_example(example_proto, features)
-    volume_flat = parsed_features["volume"]
-    volume = tf.reshape(volume_flat, [nx, ny, nz])
+    import tensorflow as tf
+    if metadata is not None:
+        nx, ny, nz = metadata['shape']
+        if n_classes is None:
+            n_classes = metadata['n_classes']
+        volume_shape = list(metadata['volume_shape'])
+    else:
+        volume_shape = [nx, ny, nz]
+    if encoding is None:
+        encoding = metadata.get('encoding', 'float_list') if metadata is not None else 'float_list'
+    dtype = metadata.get('dtype', 'float32') if metadata is not None else 'float32'
+    n_stored = int(np.prod(volume_shape))
+    parsed_features = tf.io.parse_single_example(
+        example_proto, _tfr_features(n_stored, n_classes, encoding=encoding, dtype=dtype))
+    volume_flat = _decode_volumes(parsed_features, n_stored, encoding=encoding, dtype=dtype)
+    stored_idx = _stored_voxel_idx(metadata)
+    if rebuild_full and stored_idx is not None:
+        volume = tf.reshape(_unmask_volumes(volume_flat, stored_idx, nx*ny*nz), [nx, ny, nz])
+    else:
+        volume = tf.reshape(volume_flat, volume_shape)
     label_onehot = parsed_features["label_onehot"]
 
     if only_parse_XY:
@@ -112,3 +171,55 @@ def parse_tfr(example_proto, nx, ny, nz, n_classes, only_parse_XY=False):
                 volume_idx,
                 label,
                 label_onehot)
+
+
+def parse_tfr_batch(serialized, metadata, rebuild_full=False, only_parse_XY=False):
+    """Parse a batch of TFR-data at once (with tf.io.parse_example).
+
+    Args:
+        serialized: 1D string tensor of serialized examples
+            (eg., a batch of a tf.data.TFRecordDataset).
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata (or read with
+            hcprep.convert.read_tfr_metadata), defining
+            how the volumes are stored. Quantized volumes
+            are dequantized to float32.
+        rebuild_full: Bool indicating whether volumes
+            that are stored cropped to a bounding box or as
+            in-mask voxels are placed back into their full
+            (x, y, z) grid.
+        only_parse_XY: Bool indicating whether only volume
+            and y onehot encoding should be returned.
+
+    Returns:
+        The same data as hcprep.convert.parse_tfr, with
+        an additional leading batch dimension.
+    """
+    import tensorflow as tf
+    shape = list(metadata['shape'])
+    volume_shape = list(metadata['volume_shape'])
+    encoding = metadata.get('encoding', 'float_list')
+    dtype = metadata.get('dtype', 'float32')
+    n_stored = int(np.prod(volume_shape))
+    parsed_features = tf.io.parse_example(
+        serialized, _tfr_features(n_stored, metadata['n_classes'],
+                                  encoding=encoding, dtype=dtype))
+    volume_flat = _decode_volumes(parsed_features, n_stored, encoding=encoding,
+                                  dtype=dtype, batched=True)
+    stored_idx = _stored_voxel_idx(metadata)
+    if rebuild_full and stored_idx is not None:
+        volume = tf.reshape(_unmask_volumes(volume_flat, stored_idx, int(np.prod(shape))),
+                            [-1] + shape)
+    else:
+        volume = tf.reshape(volume_flat, [-1] + volume_shape)
+    label_onehot = parsed_features['label_onehot']
+
+    if only_parse_XY:
+        return (volume, label_onehot)
+    return (volume,
+            parsed_features['task_id'],
+            parsed_features['subject_id'],
+            parsed_features['run_id'],
+            parsed_features['volume_idx'],
+            parsed_features['label'],
+            label_onehot)
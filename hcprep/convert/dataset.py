@@ -0,0 +1,100 @@
+#!/usr/bin/python
+from .convert import parse_tfr_batch
+
+
+def make_tfr_dataset(tfr_files, metadata, batch_size, rebuild_full=False,
+                     only_parse_XY=False, shuffle_files=True, shuffle_buffer=None,
+                     cycle_length=None, cache=None, repeat=False,
+                     drop_remainder=False, seed=None, deterministic=False):
+    """Build a tf.data pipeline that reads batches of
+    volumes from TFRecord files written by hcprep.convert.
+
+    The files are read in parallel (interleaved), records are
+    batched before they are parsed with one vectorized
+    tf.io.parse_example call per batch, and parsed batches
+    are prefetched, with all parallelism autotuned.
+
+    Args:
+        tfr_files: A sequence of TFRecord filenames (eg., shards
+            written with hcprep.convert.write_tfr_shards).
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata (or read with
+            hcprep.convert.read_tfr_metadata), defining the
+            layout, encoding, precision and compression of
+            the files.
+        batch_size: Number of volumes per batch.
+        rebuild_full: Bool indicating whether volumes that are
+            stored cropped to a bounding box or as in-mask voxels
+            are unmasked to their full (x, y, z) grid on the fly.
+        only_parse_XY: Bool indicating whether only the volumes
+            and one-hot labels are returned (eg., for keras).
+        shuffle_files: Bool indicating whether the order
+            of the files (or, with cache, the mixing of their
+            records) is shuffled anew in each epoch.
+        shuffle_buffer: Size of the shuffle buffer of the
+            records (None does not shuffle records, eg.,
+            for globally shuffled shards).
+        cycle_length: Number of files read in parallel
+            (defaults to autotuning; without cache only).
+        cache: Whether the serialized records are cached
+            after the first epoch; True caches them in memory,
+            a filename prefix caches them on disk, in one file
+            per TFRecord file (None does not cache). Records are
+            cached in their compact stored format, before they
+            are shuffled and parsed. Each file is cached on its
+            own, and the records of all files are then mixed
+            by sampling from a randomly chosen file for each
+            record, anew in each epoch (if shuffle_files).
+            The shuffle buffer is also applied after the cache,
+            so that both are reshuffled in every epoch.
+        repeat: Bool indicating whether the dataset is
+            repeated indefinitely.
+        drop_remainder: Bool indicating whether the last
+            batch is dropped if it is smaller than batch_size.
+        seed: Seed of the file and record shuffles.
+        deterministic: Bool indicating whether the interleaved
+            records are returned in a deterministic order.
+
+    Returns:
+        tf.data.Dataset of batches, as returned by
+        hcprep.convert.parse_tfr_batch.
+    """
+    import tensorflow as tf
+    tfr_files = list(tfr_files)
+    compression = metadata.get('compression') or ''
+    if cache is not None:
+        # cache each file on its own (a cache after the interleave would
+        # freeze the order of the files from the second epoch on)
+        datasets = []
+        for i, tfr_file in enumerate(tfr_files):
+            dataset = tf.data.TFRecordDataset(tfr_file, compression_type=compression)
+            datasets.append(dataset.cache() if cache is True else
+                            dataset.cache('{}-{:05d}'.format(cache, i)))
+        if shuffle_files:
+            dataset = tf.data.Dataset.sample_from_datasets(
+                datasets, seed=seed, stop_on_empty_dataset=False,
+                rerandomize_each_iteration=True)
+        else:
+            dataset = datasets[0]
+            for file_dataset in datasets[1:]:
+                dataset = dataset.concatenate(file_dataset)
+    else:
+        files = tf.data.Dataset.from_tensor_slices(tfr_files)
+        if shuffle_files:
+            files = files.shuffle(len(tfr_files), seed=seed, reshuffle_each_iteration=True)
+        dataset = files.interleave(
+            lambda tfr_file: tf.data.TFRecordDataset(tfr_file, compression_type=compression),
+            cycle_length=cycle_length if cycle_length is not None else tf.data.AUTOTUNE,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=deterministic)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    dataset = dataset.map(
+        lambda serialized: parse_tfr_batch(serialized, metadata, rebuild_full=rebuild_full,
+                                           only_parse_XY=only_parse_XY),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=deterministic)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+import os
+import tempfile
+import numpy as np
+
+from .records import TFRecordFileWriter, _read_record
+
+
+_INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i8'),
+                         ('subject_id', '<i8'), ('task_id', '<i8'), ('run_id', '<i8'),
+                         ('volume_idx', '<i8'), ('label', '<i8')])
+# each TFRecord is framed by its length (uint64),
+# the CRC of the length (uint32) and the CRC of the data (uint32)
+_RECORD_HEADER_BYTES = 12
+_RECORD_FOOTER_BYTES = 4
+
+
+def tfr_index_filename(tfr_file):
+    """Return the filename of the index of a TFRecord file."""
+    return tfr_file + '.index.npy'
+
+
+class IndexedTFRecordWriter(object):
+    """Writer of an (uncompressed) TFRecord file that also
+    writes an index with the byte offset, length, subject_id,
+    task_id, run_id, volume_idx and label of each record.
+
+    The index is written to hcprep.convert.tfr_index_filename(filename)
+    when the writer is closed. It can be passed instead of a
+    tf.io.TFRecordWriter to hcprep.convert.write_to_tfr.
+    TensorFlow is not needed to write the file. Compressed
+    output is not supported, as the byte offsets of records in
+    a compressed file cannot be seeked to.
+
+    Args:
+        filename: Filename of the TFRecord file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._writer = TFRecordFileWriter(filename)
+        self._offset = 0
+        self._index = []
+
+    def write(self, record, subject_id=-1, task_id=-1, run_id=-1,
+              volume_idx=-1, label=-1):
+        """Write a serialized record and add it to the index."""
+        self._writer.write(record)
+        self._index.append((self._offset, len(record), subject_id, task_id,
+                            run_id, volume_idx, label))
+        self._offset += _RECORD_HEADER_BYTES + len(record) + _RECORD_FOOTER_BYTES
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        """Close the TFRecord file and write its index."""
+        self._writer.close()
+        index = np.array(self._index, dtype=_INDEX_DTYPE)
+        index_file = tfr_index_filename(self.filename)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_file)),
+                                        prefix='.tmp_', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp_file, index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _write_record(writer, record, subject_id, task_id, run_id, volume_idx, label):
+    """Write a serialized record with writer, along
+    with its index fields if writer is indexed."""
+    if isinstance(writer, IndexedTFRecordWriter):
+        writer.write(record, int(subject_id), int(task_id), int(run_id),
+                     int(volume_idx), int(label))
+    else:
+        writer.write(record)
+
+
+def read_tfr_index(tfr_file):
+    """Read the index of a TFRecord file, as written
+    by hcprep.convert.IndexedTFRecordWriter.
+
+    Returns:
+        Structured ndarray with one row per record and
+        the fields offset, length, subject_id, task_id,
+        run_id, volume_idx and label.
+    """
+    return np.load(tfr_index_filename(tfr_file))
+
+
+def select_tfr_records(index, subject_ids=None, task_ids=None, run_ids=None,
+                       labels=None):
+    """Return the positions of the records in index
+    that match all given metadata values.
+
+    Args:
+        index: Index of a TFRecord file, as
+            read with hcprep.convert.read_tfr_index.
+        subject_ids, task_ids, run_ids, labels: Sequences of
+            the values to select (None selects all values).
+
+    Returns:
+        Ndarray of the positions of the selected records.
+    """
+    selected = np.ones(index.shape[0], dtype=bool)
+    for field, values in [('subject_id', subject_ids), ('task_id', task_ids),
+                          ('run_id', run_ids), ('label', labels)]:
+        if values is not None:
+            selected &= np.isin(index[field], np.asarray(values).reshape(-1))
+    return np.flatnonzero(selected)
+
+
+def read_tfr_records(tfr_file, index, positions=None, check_crc=False):
+    """Read records from a TFRecord file by seeking to
+    their byte offsets in its index.
+
+    Args:
+        tfr_file: Filename of the TFRecord file.
+        index: Index of tfr_file, as read with
+            hcprep.convert.read_tfr_index.
+        positions: Positions (in index) of the records
+            to read, eg., as returned by
+            hcprep.convert.select_tfr_records
+            (None reads all records).
+        check_crc: Bool indicating whether the CRC32C
+            checksums of the records are verified.
+
+    Returns:
+        List of the serialized records, in the order of
+        positions (to be parsed with hcprep.convert.parse_tfr
+        or hcprep.convert.parse_tfr_numpy).
+    """
+    if positions is None:
+        positions = np.arange(index.shape[0])
+    positions = np.asarray(positions).reshape(-1)
+    records = [None] * positions.size
+    with open(tfr_file, 'rb') as f:
+        # read in file order
+        for i in np.argsort(index['offset'][positions], kind='stable'):
+            offset = int(index['offset'][positions[i]])
+            length = int(index['length'][positions[i]])
+            f.seek(offset)
+            record = _read_record(f, check_crc=check_crc)
+            if record is None or len(record) != length:
+                raise ValueError('Index of {} does not match its records.'.format(tfr_file))
+            records[i] = record
+    return records
+
+
+def sample_tfr_batches(tfr_files, batch_size, n_batches=None, subject_ids=None,
+                       task_ids=None, run_ids=None, labels=None, seed=None):
+    """Iterate over random mini-batches of the records of
+    many indexed TFRecord files that match the given metadata
+    values, read directly from disk by their byte offsets.
+
+    Args:
+        tfr_files: A sequence of filenames of indexed TFRecord files.
+        batch_size: Number of records per batch.
+        n_batches: Number of batches (None iterates
+            indefinitely).
+        subject_ids, task_ids, run_ids, labels: Sequences of
+            the values to select (None selects all values;
+            see hcprep.convert.select_tfr_records).
+        seed: Seed of the random sampling.
+
+    Yields:
+        List of batch_size serialized records (to be parsed
+        with hcprep.convert.parse_tfr).
+    """
+    indices = [read_tfr_index(tfr_file) for tfr_file in tfr_files]
+    selected = [select_tfr_records(index, subject_ids, task_ids, run_ids, labels)
+                for index in indices]
+    n_selected = np.array([s.size for s in selected])
+    if n_selected.sum() == 0:
+        raise ValueError('No records match the selection.')
+    cumulative = np.cumsum(n_selected)
+    rng = np.random.RandomState(seed)
+    batch = 0
+    while n_batches is None or batch < n_batches:
+        samples = rng.randint(cumulative[-1], size=batch_size)
+        file_idx = np.searchsorted(cumulative, samples, side='right')
+        records = [None] * batch_size
+        for fi in np.unique(file_idx):
+            in_file = np.flatnonzero(file_idx == fi)
+            positions = selected[fi][samples[in_file] - (cumulative[fi] - n_selected[fi])]
+            for i, record in zip(in_file, read_tfr_records(
+                    tfr_files[fi], indices[fi], positions)):
+                records[i] = record
+        yield records
+        batch += 1
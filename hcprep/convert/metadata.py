@@ -0,0 +1,181 @@
+#!/usr/bin/python
+import os
+import json
+import base64
+import tempfile
+import numpy as np
+import nibabel as nb
+
+from ._utils import _ENCODINGS, _DTYPES, _COMPRESSIONS
+from .. import paths
+
+
+_LAYOUTS = ['full', 'bbox', 'masked']
+
+
+def build_cohort_mask(jobs, path, mode='intersection'):
+    """Combine the brain masks of many HCP subject
+    runs into one cohort mask.
+
+    The masks are read one at a time, so that memory
+    does not grow with the number of runs.
+
+    Args:
+        jobs: A sequence of (subject, task, run) tuples.
+        path: Path to the local HCP data in BIDS format.
+        mode: "intersection" (voxels that are within the
+            brain mask of every run) or "union" (voxels
+            that are within the brain mask of any run).
+
+    Returns:
+        Nifti1Image of the cohort mask.
+    """
+    if mode not in ['intersection', 'union']:
+        raise ValueError('Invalid mode: {}'.format(mode))
+    cohort_mask = None
+    affine = None
+    for subject, task, run in jobs:
+        mask_img = nb.load(paths.path_bids_func_mask_mni(subject, task, run, path))
+        mask = np.asarray(mask_img.dataobj) != 0
+        if cohort_mask is None:
+            cohort_mask = mask
+            affine = mask_img.affine
+            continue
+        if mask.shape != cohort_mask.shape or not np.allclose(mask_img.affine, affine):
+            raise ValueError('Brain mask of task-{} subject-{} run-{} does not '
+                             'match the shape and affine of the other masks.'.format(
+                                 task, subject, run))
+        if mode == 'intersection':
+            cohort_mask &= mask
+        else:
+            cohort_mask |= mask
+    if cohort_mask is None:
+        raise ValueError('No jobs given.')
+    return nb.Nifti1Image(cohort_mask.astype(np.int8), affine)
+
+
+def _bbox(mask):
+    """Return the [start, stop] bounding box of mask along each axis."""
+    bbox = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        idx = np.where(mask.any(axis=other_axes))[0]
+        if idx.size == 0:
+            raise ValueError('Mask is empty.')
+        bbox.append([int(idx[0]), int(idx[-1])+1])
+    return bbox
+
+
+def make_tfr_metadata(mask=None, layout='full', n_classes_per_task=None, shape=None,
+                      encoding='raw', dtype='float32', compression=None):
+    """Create the metadata that describes how the volumes
+    of a TFRecord dataset are stored.
+
+    Args:
+        mask: Nifti1Image or boolean ndarray (x, y, z) of the
+            (cohort) brain mask, eg., as created with
+            hcprep.convert.build_cohort_mask. Needed for the
+            "bbox" and "masked" layouts.
+        layout: One of:
+            "full": volumes are stored with their full
+                (x, y, z) grid
+            "bbox": volumes are cropped to the bounding
+                box of mask
+            "masked": only the voxels within mask are stored
+        n_classes_per_task: A sequence of integers indicating
+            the number of classes per task (as in
+            hcprep.info.basics).
+        shape: (x, y, z) shape of the volumes (only needed
+            if mask is None).
+        encoding: How volumes are serialized; "raw" (raw
+            little-endian bytes) or "float_list".
+        dtype: Precision in which volumes are stored
+            (only for the "raw" encoding); one of:
+            "float32"
+            "float16"
+            "int16": each volume is scaled to the full
+                int16 range; its scale is stored with it
+            Volumes are dequantized to float32 when parsed.
+        compression: Compression of the TFRecord files
+            (None, "GZIP" or "ZLIB").
+
+    Returns:
+        Dict of the dataset metadata (to be passed to
+        hcprep.convert.write_to_tfr and hcprep.convert.parse_tfr).
+    """
+    if layout not in _LAYOUTS:
+        raise ValueError('Invalid layout: {}'.format(layout))
+    if encoding not in _ENCODINGS:
+        raise ValueError('Invalid encoding: {}'.format(encoding))
+    if dtype not in _DTYPES:
+        raise ValueError('Invalid dtype: {}'.format(dtype))
+    if encoding == 'float_list' and dtype != 'float32':
+        raise ValueError('The float_list encoding only supports float32 volumes.')
+    if compression not in _COMPRESSIONS:
+        raise ValueError('Invalid compression: {}'.format(compression))
+    affine = None
+    if mask is not None:
+        if not isinstance(mask, np.ndarray):
+            affine = np.asarray(mask.affine).tolist()
+            mask = np.asarray(mask.dataobj)
+        mask = np.asarray(mask) != 0
+        shape = mask.shape
+    elif layout != 'full':
+        raise ValueError('A mask is needed for the "{}" layout.'.format(layout))
+    if shape is None:
+        raise ValueError('Either mask or shape must be given.')
+    shape = [int(s) for s in shape]
+
+    metadata = {'layout': layout,
+                'shape': shape,
+                'affine': affine,
+                'mask': mask,
+                'bbox': None,
+                'encoding': encoding,
+                'dtype': dtype,
+                'compression': compression,
+                'n_classes': (int(np.sum(n_classes_per_task))
+                              if n_classes_per_task is not None else None)}
+    if layout == 'full':
+        metadata['volume_shape'] = shape
+    elif layout == 'bbox':
+        metadata['bbox'] = _bbox(mask)
+        metadata['volume_shape'] = [stop-start for start, stop in metadata['bbox']]
+    else:
+        metadata['volume_shape'] = [int(mask.sum())]
+    return metadata
+
+
+def write_tfr_metadata(metadata, filename):
+    """Write the metadata of a TFRecord dataset
+    (as created with hcprep.convert.make_tfr_metadata)
+    to a JSON file."""
+    metadata = dict(metadata)
+    if metadata.get('mask') is not None:
+        mask = np.asarray(metadata['mask'], dtype=bool)
+        metadata['mask'] = base64.b64encode(
+            np.packbits(mask.reshape(-1)).tobytes()).decode('ascii')
+    dirname = os.path.dirname(os.path.abspath(filename))
+    paths.make_sure_path_exists(dirname)
+    fd, tmp_file = tempfile.mkstemp(dir=dirname, prefix='.tmp_', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(tmp_file, filename)
+
+
+def read_tfr_metadata(filename):
+    """Read the metadata of a TFRecord dataset,
+    as written by hcprep.convert.write_tfr_metadata.
+
+    Returns:
+        Dict of the dataset metadata.
+    """
+    with open(filename, 'r') as f:
+        metadata = json.load(f)
+    if metadata.get('mask') is not None:
+        shape = metadata['shape']
+        mask = np.unpackbits(np.frombuffer(
+            base64.b64decode(metadata['mask']), dtype=np.uint8),
+            count=int(np.prod(shape)))
+        metadata['mask'] = mask.astype(bool).reshape(shape)
+    return metadata
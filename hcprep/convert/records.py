@@ -0,0 +1,352 @@
+#!/usr/bin/python
+import gzip
+import zlib
+import struct
+from functools import lru_cache
+import numpy as np
+
+from ._utils import _COMPRESSIONS, _stored_voxel_idx, _decode_example
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+def _crc32c_table():
+    """Return the byte table of the CRC32C (Castagnoli) polynomial."""
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0x82F63B78), table >> 1)
+    return table.astype(np.uint32)
+
+
+_CRC32C_TABLE = _crc32c_table()
+_CRC32C_TABLE_LIST = _CRC32C_TABLE.tolist()
+
+
+@lru_cache(maxsize=None)
+def _crc32c_shift_tables(n_bytes):
+    """Return the tables of the (linear) operator that
+    advances a CRC32C state over n_bytes zero bytes,
+    one table of 256 values per state byte."""
+    state = (np.arange(256, dtype=np.uint32)[None] <<
+             (8 * np.arange(4, dtype=np.uint32))[:, None]).reshape(-1)
+    for _ in range(n_bytes):
+        state = _CRC32C_TABLE[state & 0xFF] ^ (state >> 8)
+    return [table.tolist() for table in state.reshape(4, 256)]
+
+
+def _crc32c_python(data, crc=0xFFFFFFFF):
+    table = _CRC32C_TABLE_LIST
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def crc32c(data):
+    """Return the CRC32C checksum of data.
+
+    Uses the crc32c package if it is installed. Otherwise,
+    data is split into blocks whose CRCs are computed
+    together with NumPy and then combined."""
+    if _crc32c is not None:
+        return _crc32c.crc32c(data)
+    data = np.frombuffer(data, dtype=np.uint8)
+    if data.size < 4096:
+        return _crc32c_python(data.tolist()) ^ 0xFFFFFFFF
+    block_size = 1 << int(round(np.log2(np.sqrt(data.size))))
+    n_blocks = data.size // block_size
+    blocks = np.ascontiguousarray(
+        data[:n_blocks*block_size].reshape(n_blocks, block_size).T)
+    block_crcs = np.zeros(n_blocks, dtype=np.uint32)
+    for column in blocks:
+        block_crcs = _CRC32C_TABLE[(block_crcs ^ column) & 0xFF] ^ (block_crcs >> 8)
+    # crc(a + b) = shift(crc(a), len(b)) ^ crc(b), with crc(b) started from 0
+    t0, t1, t2, t3 = _crc32c_shift_tables(block_size)
+    crc = 0xFFFFFFFF
+    for block_crc in block_crcs.tolist():
+        crc = (t0[crc & 0xFF] ^ t1[(crc >> 8) & 0xFF] ^
+               t2[(crc >> 16) & 0xFF] ^ t3[crc >> 24] ^ block_crc)
+    return _crc32c_python(data[n_blocks*block_size:].tolist(), crc) ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """Return the masked CRC32C checksum of data,
+    as stored in the framing of TFRecord files."""
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+class _ZlibReader(object):
+    """Minimal file-like reader of a zlib-compressed file."""
+    def __init__(self, filename, chunk_size=1024*1024):
+        self._file = open(filename, 'rb')
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b''
+        self._chunk_size = chunk_size
+
+    def read(self, n):
+        while len(self._buffer) < n:
+            chunk = self._file.read(self._chunk_size)
+            if not chunk:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class _ZlibWriter(object):
+    """Minimal file-like writer of a zlib-compressed file."""
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._compressor = zlib.compressobj()
+
+    def write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def flush(self):
+        self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._file.flush()
+
+    def close(self):
+        self._file.write(self._compressor.flush())
+        self._file.close()
+
+
+def _open_records(filename, compression=None, mode='rb'):
+    """Open a TFRecord file with the given compression."""
+    if compression not in _COMPRESSIONS:
+        raise ValueError('Invalid compression: {}'.format(compression))
+    if compression == 'GZIP':
+        return gzip.open(filename, mode)
+    if compression == 'ZLIB':
+        return _ZlibReader(filename) if mode == 'rb' else _ZlibWriter(filename)
+    return open(filename, mode)
+
+
+def _read_record(f, check_crc=False):
+    """Read the next record from the open TFRecord file f,
+    or return None at the end of the file."""
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header) != 12:
+        raise ValueError('Truncated TFRecord header.')
+    length, length_crc = struct.unpack('<QI', header)
+    if check_crc and masked_crc32c(header[:8]) != length_crc:
+        raise ValueError('Corrupted TFRecord length.')
+    record = f.read(length)
+    footer = f.read(4)
+    if len(record) != length or len(footer) != 4:
+        raise ValueError('Truncated TFRecord.')
+    if check_crc and masked_crc32c(record) != struct.unpack('<I', footer)[0]:
+        raise ValueError('Corrupted TFRecord data.')
+    return record
+
+
+class TFRecordFileWriter(object):
+    """Writer of TFRecord files that does not need TensorFlow.
+
+    Records are framed as by tf.io.TFRecordWriter (length,
+    masked CRC32C of the length, data, masked CRC32C of the data),
+    so that both writers produce the same files. It can be
+    passed instead of a tf.io.TFRecordWriter to
+    hcprep.convert.write_to_tfr.
+
+    Args:
+        filename: Filename of the TFRecord file.
+        compression: Compression of the file
+            (None, "GZIP" or "ZLIB").
+    """
+    def __init__(self, filename, compression=None):
+        self.filename = filename
+        self._file = _open_records(filename, compression, mode='wb')
+
+    def write(self, record):
+        """Write a serialized record."""
+        length = struct.pack('<Q', len(record))
+        self._file.write(length)
+        self._file.write(struct.pack('<I', masked_crc32c(length)))
+        self._file.write(record)
+        self._file.write(struct.pack('<I', masked_crc32c(record)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_tfr_records(tfr_file, compression=None, check_crc=False):
+    """Iterate over the serialized records of a TFRecord
+    file, without TensorFlow.
+
+    Args:
+        tfr_file: Filename of the TFRecord file.
+        compression: Compression of the file
+            (None, "GZIP" or "ZLIB").
+        check_crc: Bool indicating whether the CRC32C
+            checksums of the records are verified (slow
+            unless the crc32c package is installed).
+
+    Yields:
+        Serialized record (bytes).
+    """
+    f = _open_records(tfr_file, compression)
+    try:
+        while True:
+            record = _read_record(f, check_crc=check_crc)
+            if record is None:
+                break
+            yield record
+    finally:
+        f.close()
+
+
+def _numpy_volume(features, buf, n_stored, dtype):
+    """Return the float32 (or quantized) stored voxels and
+    the volume scale of a decoded example."""
+    kind, value = features['volume']
+    if kind == 'float':
+        volume = value
+    elif kind == 'bytes':
+        start, stop = value[0]
+        volume = np.frombuffer(buf[start:stop], dtype=np.dtype(dtype).newbyteorder('<'))
+    else:
+        raise ValueError('Example has no volume.')
+    if volume.size != n_stored:
+        raise ValueError('Volume has {} voxels, expected {}.'.format(volume.size, n_stored))
+    scale = float(features['volume_scale'][1][0]) if 'volume_scale' in features else None
+    return volume, scale
+
+
+def parse_tfr_numpy(record, nx=None, ny=None, nz=None, metadata=None,
+                    rebuild_full=False, out=None):
+    """Parse a serialized example, as written by
+    hcprep.convert.write_to_tfr, with NumPy (without TensorFlow).
+
+    Args:
+        record: Serialized example (eg., as returned by
+            hcprep.convert.iter_tfr_records).
+        nx, ny, nz: Integers indicating the x-/y-/z-dimensions
+            of the volumes (not needed if metadata is given)
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata (or read with
+            hcprep.convert.read_tfr_metadata), defining
+            how the volumes are stored. Quantized volumes
+            are dequantized to float32.
+        rebuild_full: Bool indicating whether volumes that
+            are stored cropped to a bounding box or as in-mask
+            voxels are placed back into their full (x, y, z) grid.
+        out: Optional preallocated float32 ndarray into which
+            the volume is written. If rebuild_full, only its
+            stored voxels are written (all other voxels
+            of out are expected to be zero).
+
+    Returns:
+        The same data as hcprep.convert.parse_tfr, with the
+        volume and one-hot label as ndarrays and the IDs and
+        label as integers.
+    """
+    if metadata is not None:
+        shape = list(metadata['shape'])
+        volume_shape = list(metadata['volume_shape'])
+        dtype = metadata.get('dtype', 'float32')
+    else:
+        shape = volume_shape = [nx, ny, nz]
+        dtype = 'float32'
+    return _parse_tfr_numpy(record, shape, volume_shape, dtype,
+                            _stored_voxel_idx(metadata), rebuild_full, out)
+
+
+def _parse_tfr_numpy(record, shape, volume_shape, dtype, stored_idx, rebuild_full, out):
+    buf, features = _decode_example(record)
+    volume, scale = _numpy_volume(features, buf, int(np.prod(volume_shape)), dtype)
+    if rebuild_full and stored_idx is not None:
+        if out is None:
+            out = np.zeros(shape, dtype=np.float32)
+        volume = volume.astype(np.float32)
+        if scale is not None:
+            volume *= np.float32(scale)
+        out.reshape(-1)[stored_idx] = volume
+    else:
+        if out is None:
+            out = np.empty(volume_shape, dtype=np.float32)
+        flat = out.reshape(-1)
+        if scale is not None:
+            np.multiply(volume, np.float32(scale), out=flat, casting='unsafe')
+        else:
+            flat[:] = volume
+    return (out,
+            int(features['task_id'][1][0]),
+            int(features['subject_id'][1][0]),
+            int(features['run_id'][1][0]),
+            int(features['volume_idx'][1][0]),
+            int(features['label'][1][0]),
+            features['label_onehot'][1])
+
+
+def iter_tfr_batches_numpy(tfr_files, metadata, batch_size, rebuild_full=False,
+                           check_crc=False, drop_remainder=False):
+    """Iterate over batches of the examples of TFRecord
+    files, parsed with NumPy (without TensorFlow) into
+    preallocated buffers.
+
+    The buffers are reused for all batches; copy the
+    returned arrays to keep them beyond the next batch.
+
+    Args:
+        tfr_files: A sequence of TFRecord filenames.
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata (or read with
+            hcprep.convert.read_tfr_metadata), defining the
+            layout, precision and compression of the files.
+        batch_size: Number of volumes per batch.
+        rebuild_full: Bool indicating whether volumes that
+            are stored cropped to a bounding box or as in-mask
+            voxels are placed back into their full (x, y, z) grid.
+        check_crc: Bool indicating whether the CRC32C
+            checksums of the records are verified.
+        drop_remainder: Bool indicating whether the last
+            batch is dropped if it is smaller than batch_size.
+
+    Yields:
+        Tuple of ndarrays (volume, task_id, subject_id, run_id,
+        volume_idx, label, label_onehot), each with a leading
+        batch dimension.
+    """
+    if rebuild_full:
+        volume_shape = list(metadata['shape'])
+    else:
+        volume_shape = list(metadata['volume_shape'])
+    stored_idx = _stored_voxel_idx(metadata)
+    volumes = np.zeros([batch_size] + volume_shape, dtype=np.float32)
+    ids = np.zeros((5, batch_size), dtype=np.int64)
+    label_onehot = np.zeros((batch_size, metadata['n_classes']), dtype=np.int64)
+    i = 0
+    for tfr_file in tfr_files:
+        for record in iter_tfr_records(tfr_file, compression=metadata.get('compression'),
+                                       check_crc=check_crc):
+            parsed = _parse_tfr_numpy(record, list(metadata['shape']),
+                                      list(metadata['volume_shape']),
+                                      metadata.get('dtype', 'float32'), stored_idx,
+                                      rebuild_full, volumes[i])
+            ids[:, i] = parsed[1:6]
+            label_onehot[i] = parsed[6]
+            i += 1
+            if i == batch_size:
+                yield (volumes,) + tuple(ids) + (label_onehot,)
+                i = 0
+    if i > 0 and not drop_remainder:
+        yield (volumes[:i],) + tuple(ids[:, :i]) + (label_onehot[:i],)
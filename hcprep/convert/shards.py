@@ -0,0 +1,393 @@
+#!/usr/bin/python
+import os
+import queue
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+from ._utils import (_volume_reader, _int64_feature, _label_features,
+                     _volume_features, _serialize_example)
+from .index import IndexedTFRecordWriter, _write_record
+from .records import TFRecordFileWriter
+from .. import paths
+
+
+_ASSIGNMENTS = ['round_robin', 'balanced']
+
+
+def _shard_worker(shard_files, items, compression, encoding, dtype, n_classes_per_task,
+                  index=False):
+    """Write the serialized volumes of all batches
+    received from items to their shard files."""
+    if index:
+        writers = {shard: IndexedTFRecordWriter(shard_file)
+                   for shard, shard_file in shard_files.items()}
+    else:
+        writers = {shard: TFRecordFileWriter(shard_file, compression=compression)
+                   for shard, shard_file in shard_files.items()}
+    label_features = {}
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            item = items.get(timeout=1)
+        except queue.Empty:
+            # stop if the parent process died
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if item is None:
+            break
+        shard, volumes, volume_idx, volume_labels, subject_ids, task_ids, run_ids = item
+        for volume, vi, label, subject_id, task_id, run_id in zip(
+                volumes, volume_idx, volume_labels, subject_ids, task_ids, run_ids):
+            if (task_id, label) not in label_features:
+                label_features[(task_id, label)] = _label_features(
+                    label, task_id, n_classes_per_task)
+            id_features = {'task_id': _int64_feature([task_id]),
+                           'subject_id': _int64_feature([subject_id]),
+                           'run_id': _int64_feature([run_id])}
+            _write_record(writers[shard], _serialize_example(
+                _volume_features(volume, encoding=encoding, dtype=dtype),
+                vi, label_features[(task_id, label)], id_features),
+                subject_id, task_id, run_id, vi, label)
+    [w.close() for w in writers.values()]
+
+
+def _put(items, worker, item):
+    """Put item into the queue of worker, unless it failed."""
+    while True:
+        try:
+            items.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not worker.is_alive():
+                raise RuntimeError('A shard writing process failed.')
+
+
+def _read_runs(runs, metadata):
+    """Iterate over the (n_volumes, read_volume, volume_labels,
+    subject_id, task_id, run_id) of each run."""
+    for fMRI_data, mask, volume_labels, subject_id, task_id, run_id in runs:
+        if mask is not None:
+            if not isinstance(mask, np.ndarray):
+                mask = np.asarray(mask.dataobj)
+            mask = np.asarray(mask).astype(bool)
+        nv, read_volume = _volume_reader(np.asarray(fMRI_data), mask=mask, metadata=metadata)
+        yield (nv, read_volume, np.asarray(volume_labels).astype(int),
+               int(subject_id), int(task_id), int(run_id))
+
+
+def _read_volumes(read_volume, vidx):
+    """Return the stacked stored voxels of the volumes vidx."""
+    volumes = None
+    for i, vi in enumerate(vidx):
+        volume = read_volume(vi)
+        if volumes is None:
+            volumes = np.empty((len(vidx), volume.size), dtype=np.float32)
+        volumes[i] = volume
+    return volumes
+
+
+def _iter_run_batches(runs, metadata, n_shards, assignment, randomize_volumes,
+                      batch_size, rng):
+    """Iterate over the batches of each shard, with volumes
+    shuffled within (but not across) runs."""
+    n_volumes = np.zeros(n_shards, dtype=np.int64)
+    next_shard = 0
+    for nv, read_volume, y, subject_id, task_id, run_id in _read_runs(runs, metadata):
+        _vidx = np.arange(nv)
+        if randomize_volumes:
+            rng.shuffle(_vidx)
+        if assignment == 'round_robin':
+            shards = (next_shard + np.arange(nv)) % n_shards
+            next_shard = (next_shard + nv) % n_shards
+        else:
+            shards = np.full(nv, np.argmin(n_volumes))
+        for shard in np.unique(shards):
+            shard_vidx = _vidx[shards == shard]
+            n_volumes[shard] += shard_vidx.size
+            for start in range(0, shard_vidx.size, batch_size):
+                batch_vidx = shard_vidx[start:start+batch_size]
+                n = batch_vidx.size
+                yield (int(shard), _read_volumes(read_volume, batch_vidx), batch_vidx,
+                       y[batch_vidx], np.full(n, subject_id), np.full(n, task_id),
+                       np.full(n, run_id))
+
+
+_BUCKET_FIELDS = ['volume_idx', 'label', 'subject_id', 'task_id', 'run_id']
+
+
+class _BucketFiles(object):
+    """Temporary bucket files to which rows of stored voxels
+    (float32) and their fields (int64) are appended. Rows
+    are buffered in memory up to flush_bytes per bucket."""
+
+    def __init__(self, prefix, n_buckets, flush_bytes):
+        self.files = [prefix+'-{:05d}'.format(b) for b in range(n_buckets)]
+        self.n_rows = np.zeros(n_buckets, dtype=np.int64)
+        self._pending = [[] for _ in range(n_buckets)]
+        self._pending_bytes = np.zeros(n_buckets, dtype=np.int64)
+        self._flush_bytes = flush_bytes
+
+    def append(self, b, volumes, fields):
+        self._pending[b].append((volumes, fields))
+        self._pending_bytes[b] += volumes.nbytes + fields.nbytes
+        self.n_rows[b] += fields.shape[0]
+        if self._pending_bytes[b] >= self._flush_bytes:
+            self._flush(b)
+
+    def _flush(self, b):
+        with open(self.files[b]+'.volumes', 'ab') as f:
+            for volumes, _ in self._pending[b]:
+                volumes.tofile(f)
+        with open(self.files[b]+'.fields', 'ab') as f:
+            for _, fields in self._pending[b]:
+                fields.tofile(f)
+        self._pending[b] = []
+        self._pending_bytes[b] = 0
+
+    def close(self):
+        for b in range(len(self.files)):
+            if self._pending[b]:
+                self._flush(b)
+
+
+def _remove_bucket(bucket_file):
+    for extension in ['.volumes', '.fields']:
+        if os.path.isfile(bucket_file+extension):
+            os.remove(bucket_file+extension)
+
+
+def _rescatter_bucket(bucket_file, n_rows, n_stored, memory_budget, rng):
+    """Scatter the rows of a bucket that exceeds memory_budget
+    into sub-buckets at random, reading it in chunks, such
+    that each sub-bucket is expected to fill half the budget.
+
+    Returns:
+        _BucketFiles of the sub-buckets.
+    """
+    row_bytes = 4*n_stored + 8*len(_BUCKET_FIELDS)
+    n_sub = int(np.ceil(2. * n_rows * row_bytes / memory_budget))
+    # half the budget for the buffers, half for the chunk read
+    sub_buckets = _BucketFiles(bucket_file, n_sub, max(1, memory_budget // (2*n_sub)))
+    volumes = np.memmap(bucket_file+'.volumes', dtype=np.float32, mode='r',
+                        shape=(n_rows, n_stored))
+    fields = np.memmap(bucket_file+'.fields', dtype=np.int64, mode='r',
+                       shape=(n_rows, len(_BUCKET_FIELDS)))
+    chunk_rows = max(1, memory_budget // (2*row_bytes))
+    for start in range(0, n_rows, chunk_rows):
+        chunk_volumes = np.array(volumes[start:start+chunk_rows])
+        chunk_fields = np.array(fields[start:start+chunk_rows])
+        sub = rng.randint(n_sub, size=chunk_fields.shape[0])
+        for b in np.unique(sub):
+            rows = np.flatnonzero(sub == b)
+            sub_buckets.append(b, chunk_volumes[rows], chunk_fields[rows])
+    sub_buckets.close()
+    del volumes, fields
+    _remove_bucket(bucket_file)
+    return sub_buckets
+
+
+def _iter_shuffled_batches(runs, metadata, n_shards, n_buckets, tmp_path,
+                           batch_size, rng, memory_budget=None):
+    """Iterate over the batches of each shard, with volumes
+    shuffled across all runs by a two-pass external shuffle.
+
+    In the first pass, each volume is appended to a randomly
+    chosen temporary bucket file. In the second pass, each
+    bucket is loaded, shuffled in memory and its volumes are
+    assigned round robin to the shards. As the buckets are
+    a random partition of all volumes, the concatenation of
+    the shuffled buckets is a uniformly random permutation,
+    while only one bucket is kept in memory at a time.
+
+    Volumes are buffered per bucket until memory_budget divided
+    by n_buckets is reached. A bucket that exceeds memory_budget
+    is scattered into smaller buckets at random (in chunks)
+    before it is loaded, which again yields a random partition."""
+    bucket_path = tempfile.mkdtemp(dir=tmp_path, prefix='.tmp_shuffle_')
+    try:
+        if memory_budget is not None:
+            flush_bytes = max(1, memory_budget // n_buckets)
+        else:
+            flush_bytes = 16*1024*1024
+        buckets = _BucketFiles(os.path.join(bucket_path, 'bucket'), n_buckets, flush_bytes)
+        n_stored = None
+
+        # scatter volumes into buckets
+        for nv, read_volume, y, subject_id, task_id, run_id in _read_runs(runs, metadata):
+            assigned = rng.randint(n_buckets, size=nv)
+            for b in np.unique(assigned):
+                bucket_vidx = np.flatnonzero(assigned == b)
+                volumes = _read_volumes(read_volume, bucket_vidx)
+                if n_stored is None:
+                    n_stored = volumes.shape[1]
+                elif volumes.shape[1] != n_stored:
+                    raise ValueError('All runs must store the same number of voxels.')
+                n = bucket_vidx.size
+                fields = np.stack([bucket_vidx, y[bucket_vidx], np.full(n, subject_id),
+                                   np.full(n, task_id), np.full(n, run_id)],
+                                  axis=1).astype(np.int64)
+                buckets.append(b, volumes, fields)
+        buckets.close()
+        if n_stored is None:
+            return
+        row_bytes = 4*n_stored + 8*len(_BUCKET_FIELDS)
+
+        # shuffle each bucket and gather the shards
+        next_shard = 0
+        stack = list(zip(buckets.files, buckets.n_rows))[::-1]
+        while stack:
+            bucket_file, n_rows = stack.pop()
+            if n_rows == 0:
+                continue
+            if (memory_budget is not None and n_rows > 1 and
+                    n_rows * row_bytes > memory_budget):
+                sub_buckets = _rescatter_bucket(bucket_file, n_rows, n_stored,
+                                                memory_budget, rng)
+                stack.extend(list(zip(sub_buckets.files, sub_buckets.n_rows))[::-1])
+                continue
+            fields = np.fromfile(bucket_file+'.fields', dtype=np.int64).reshape(
+                -1, len(_BUCKET_FIELDS))
+            volumes = np.fromfile(bucket_file+'.volumes', dtype=np.float32).reshape(
+                fields.shape[0], n_stored)
+            _remove_bucket(bucket_file)
+            order = rng.permutation(fields.shape[0])
+            shards = (next_shard + np.arange(order.size)) % n_shards
+            next_shard = (next_shard + order.size) % n_shards
+            # alternate between the shards (and thereby the
+            # writing processes), so that all of them are busy
+            shard_orders = [order[shards == shard] for shard in range(n_shards)]
+            for start in range(0, max(o.size for o in shard_orders), batch_size):
+                for shard, shard_order in enumerate(shard_orders):
+                    batch = shard_order[start:start+batch_size]
+                    if batch.size:
+                        yield (shard, volumes[batch]) + tuple(fields[batch].T)
+            del volumes
+    finally:
+        shutil.rmtree(bucket_path, ignore_errors=True)
+
+
+def write_tfr_shards(runs, tfr_path, n_shards, n_classes_per_task, metadata,
+                     assignment='round_robin', n_workers=1, randomize_volumes=True,
+                     prefix='shard', batch_size=32, queue_size=4,
+                     global_shuffle=False, n_buckets=64, tmp_path=None, seed=None,
+                     index=False, memory_budget=1024**3):
+    """Write the fMRI volumes and labels of many subject
+    runs to a fixed number of TFRecord shards.
+
+    Volumes are assigned to the shards deterministically and
+    the shards are written concurrently by n_workers processes,
+    each of which serializes, compresses and writes the
+    volumes of its shards. Volumes are stored in the layout,
+    encoding, precision and compression of metadata (see
+    hcprep.convert.make_tfr_metadata), so that
+    hcprep.convert.parse_tfr dequantizes them automatically.
+
+    Args:
+        runs: An iterable of (fMRI_data, mask, volume_labels,
+            subject_id, task_id, run_id) tuples, with fMRI_data,
+            mask and volume_labels as for hcprep.convert.write_to_tfr
+            (mask is None if fMRI_data is not compact).
+        tfr_path: Path to which the shards are written.
+        n_shards: Number of shards.
+        n_classes_per_task: A sequence of integers indicating
+            the number of classes per task.
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata.
+        assignment: How volumes are assigned to shards:
+            "round_robin": volume i (over all runs) is
+                written to shard i % n_shards
+            "balanced": all volumes of a run are written
+                to the shard with the fewest volumes so far
+            (ignored if global_shuffle)
+        n_workers: Number of writing processes.
+        randomize_volumes: Bool indicating whether the volumes
+            of each run are written in random order.
+        prefix: Prefix of the shard filenames
+            (prefix-00000-of-00010.tfrecords).
+        batch_size: Number of volumes sent to a writing
+            process at once.
+        queue_size: Maximum number of batches waiting
+            for each writing process.
+        global_shuffle: Bool indicating whether the volumes of
+            all runs are shuffled across runs (and subjects)
+            before they are written, with a two-pass external
+            shuffle: volumes are first scattered into n_buckets
+            temporary files at random, each of which is then
+            shuffled in memory and written round robin to the
+            shards. Each shard is thereby globally shuffled.
+            Its memory use is bounded by memory_budget (in
+            addition to the run that is scattered and the batches
+            waiting for the writing processes).
+        n_buckets: Number of temporary buckets of the global
+            shuffle. Buckets that exceed memory_budget are split
+            further, so that fewer buckets only cost another pass
+            over their volumes.
+        tmp_path: Path in which the temporary buckets are
+            stored (defaults to tfr_path).
+        seed: Seed of the random shuffles and bucket assignments.
+        index: Bool indicating whether an index of the byte
+            offsets and metadata of the records is written
+            next to each shard (see hcprep.convert.IndexedTFRecordWriter;
+            only for uncompressed shards).
+        memory_budget: Maximum memory (in bytes) of the global
+            shuffle. While scattering, the volumes buffered for
+            each bucket are flushed at memory_budget divided by
+            n_buckets. A bucket whose uncompressed float32 size
+            exceeds memory_budget is scattered into smaller
+            buckets at random before it is loaded. If None,
+            volumes are flushed at 16 MB per bucket and each
+            bucket is loaded as a whole.
+
+    Returns:
+        Dict with the sequence of shard filenames ("shards")
+            and the number of volumes in each shard ("n_volumes").
+    """
+    if assignment not in _ASSIGNMENTS:
+        raise ValueError('Invalid assignment: {}'.format(assignment))
+    if index and metadata.get('compression') is not None:
+        raise ValueError('Only uncompressed shards can be indexed.')
+    n_workers = max(1, min(n_workers, n_shards))
+    paths.make_sure_path_exists(tfr_path)
+    shard_files = [os.path.join(tfr_path, '{}-{:05d}-of-{:05d}.tfrecords'.format(
+        prefix, shard, n_shards)) for shard in range(n_shards)]
+
+    # the parent may have loaded tensorflow, which is not fork-safe
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=queue_size) for _ in range(n_workers)]
+    workers = [context.Process(target=_shard_worker,
+                               args=({shard: shard_files[shard]
+                                      for shard in range(w, n_shards, n_workers)},
+                                     queues[w],
+                                     metadata.get('compression'),
+                                     metadata.get('encoding', 'float_list'),
+                                     metadata.get('dtype', 'float32'),
+                                     list(n_classes_per_task),
+                                     index))
+               for w in range(n_workers)]
+    [w.start() for w in workers]
+
+    rng = np.random.RandomState(seed)
+    if global_shuffle:
+        batches = _iter_shuffled_batches(runs, metadata, n_shards, n_buckets,
+                                         tmp_path if tmp_path is not None else tfr_path,
+                                         batch_size, rng, memory_budget=memory_budget)
+    else:
+        batches = _iter_run_batches(runs, metadata, n_shards, assignment,
+                                    randomize_volumes, batch_size, rng)
+    n_volumes = np.zeros(n_shards, dtype=np.int64)
+    try:
+        for batch in batches:
+            shard = batch[0]
+            n_volumes[shard] += len(batch[2])
+            _put(queues[shard % n_workers], workers[shard % n_workers], batch)
+    finally:
+        for q, w in zip(queues, workers):
+            if w.is_alive():
+                q.put(None)
+        [w.join() for w in workers]
+    if any(w.exitcode != 0 for w in workers):
+        raise RuntimeError('A shard writing process failed.')
+    return dict(shards=shard_files, n_volumes=n_volumes.tolist())
@@ -1,4 +1,6 @@
 #!/usr/bin/python
 from .data import summarize_subject_EVs, load_subject_data
+from .label_store import build_label_store, LabelStore
 
-__all__ = ['summarize_subject_EVs', 'load_subject_data']
+__all__ = ['summarize_subject_EVs', 'load_subject_data',
+           'build_label_store', 'LabelStore']
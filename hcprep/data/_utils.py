@@ -1,90 +1,173 @@
 #!/usr/bin/python
 import os
+import json
+import tempfile
 import pandas as pd
 import numpy as np
-from nilearn.image import load_img
+import nibabel as nib
 
 from .. import paths
 
 
-def _generate_ev_df(path, ev_filenames, task, subject, run):
-    df_list = []
-    for f in ev_filenames:
-
-        if task == 'GAMBLING':
-            if 'win.txt' in f:
-                continue
-            elif 'loss.txt' in f:
-                continue
-            elif 'neut.txt' in f:
-                continue
-            else:
-                if '_event' in f:
-                    event_type = f.split('_')[-2].split('-')[1]
-                else:
-                    event_type = f.split('.')[-2].split('-')[1]
-                ev_mat = pd.read_csv(path+f, sep='\t', header=None).values
-                df_tmp = pd.DataFrame({'subject': subject,
-                                       'task': task,
-                                       'run': run,
-                                       'event_type': event_type,
-                                       'onset': ev_mat[:, 0],
-                                       'duration': ev_mat[:, 1],
-                                       'end': ev_mat[:, 0] + ev_mat[:, 1]})
-
-        elif task in ['EMOTION',
-                      'LANGUAGE',
-                      'MOTOR',
-                      'RELATIONAL']:
-            event_type = f.split('.')[0].split('_')[-1].split('-')[1]
-            if event_type == 'cue':
-                continue
-            ev_mat = pd.read_csv(path+f, sep='\t', header=None).values
-            df_tmp = pd.DataFrame({'subject': subject,
-                                   'task': task,
-                                   'run': run,
-                                   'event_type': event_type,
-                                   'onset': ev_mat[:, 0],
-                                   'duration': ev_mat[:, 1],
-                                   'end': ev_mat[:, 0] + ev_mat[:, 1]})
-
-        elif task == 'SOCIAL':
-            if '_resp' in f:
-                event_type = f.split('.')[0].split('_')[-2].split('-')[1]
-                ev_mat = pd.read_csv(path+f, sep='\t', header=None).values
-                df_tmp = pd.DataFrame({'subject': subject,
-                                       'task': task,
-                                       'run': run,
-                                       'event_type': event_type,
-                                       'onset': ev_mat[:, 0],
-                                       'duration': ev_mat[:, 1],
-                                       'end': ev_mat[:, 0] + ev_mat[:, 1]})
-            else:
-                continue
-
-        elif task == 'WM':
-            event_type = f.split('.')[0].split('-')[-1].split('_')[1]
-            if event_type in ['body', 'faces', 'places', 'tools']:
-                ev_mat = pd.read_csv(path+f, sep='\t', header=None).values
-                df_tmp = pd.DataFrame({'subject': subject,
-                                       'task': task,
-                                       'run': run,
-                                       'event_type': event_type,
-                                       'onset': ev_mat[:, 0],
-                                       'duration': ev_mat[:, 1],
-                                       'end': ev_mat[:, 0] + ev_mat[:, 1]})
-            else:
-                continue
-
-        else:
-            raise NameError('Invalid task type.')
-            break
-
-        df_list.append(df_tmp)
-    df = pd.concat(df_list)
+# EV files that describe the events of each task,
+# mapped to the event type that they describe
+_EV_SPEC = {
+    'EMOTION': {'fear.txt': 'fear',
+                'neut.txt': 'neut'},
+    'GAMBLING': {'win_event.txt': 'win',
+                 'loss_event.txt': 'loss',
+                 'neut_event.txt': 'neut'},
+    'LANGUAGE': {'story.txt': 'story',
+                 'math.txt': 'math'},
+    'MOTOR': {'lf.txt': 'lf',
+              'rf.txt': 'rf',
+              'lh.txt': 'lh',
+              'rh.txt': 'rh',
+              't.txt': 't'},
+    'RELATIONAL': {'relation.txt': 'relation',
+                   'match.txt': 'match'},
+    'SOCIAL': {'mental_resp.txt': 'mental',
+               'other_resp.txt': 'other'},
+    'WM': {'0bk_body.txt': 'body',
+           '0bk_faces.txt': 'faces',
+           '0bk_places.txt': 'places',
+           '0bk_tools.txt': 'tools',
+           '2bk_body.txt': 'body',
+           '2bk_faces.txt': 'faces',
+           '2bk_places.txt': 'places',
+           '2bk_tools.txt': 'tools'}
+}
+
+
+def _read_ev_files(filenames):
+    """Read the onsets and durations of a set of EV files
+    (with one event per line) in one batch.
+
+    Returns:
+        Ndarray of onsets and durations (events x 2)
+        and the number of events in each file.
+    """
+    tokens = []
+    n_columns = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            text = f.read()
+        tokens.append(text.split())
+        n_columns.append(max(len(text.split('\n', 1)[0].split()), 1))
+    # parse the numbers of all files at once
+    values = np.array([v for t in tokens for v in t], dtype=np.float64)
+    ev_mats = []
+    n_events = []
+    offset = 0
+    for t, n_col in zip(tokens, n_columns):
+        ev_mat = values[offset:offset+len(t)].reshape(-1, n_col)
+        offset += len(t)
+        if ev_mat.size == 0:
+            # empty EV file (no events)
+            ev_mat = ev_mat.reshape(0, 2)
+        ev_mats.append(ev_mat[:, :2])
+        n_events.append(ev_mat.shape[0])
+    if not ev_mats:
+        return np.zeros((0, 2)), n_events
+    return np.concatenate(ev_mats), n_events
+
+
+def _generate_ev_df(path, task, subject, runs, layout=None):
+    if task not in _EV_SPEC:
+        raise NameError('Invalid task type.')
+    if layout is not None:
+        present = {os.path.basename(f) for f in layout.get(
+            datatype='func', sub=subject, task=task, extension='.txt')}
+    else:
+        present = set(os.listdir(path))
+    ev_files = []
+    ev_runs = []
+    event_types = []
+    for run in runs:
+        for ev_file, event_type in _EV_SPEC[task].items():
+            filename = 'sub-{}_task-{}_run-{}_EV-{}'.format(
+                subject, task, run, ev_file)
+            if filename in present:
+                ev_files.append(path+filename)
+                ev_runs.append(run)
+                event_types.append(event_type)
+    ev_mat, n_events = _read_ev_files(ev_files)
+    df = pd.DataFrame({'subject': subject,
+                       'task': task,
+                       'run': np.repeat(np.array(ev_runs, dtype=object), n_events),
+                       'event_type': np.repeat(np.array(event_types, dtype=object), n_events),
+                       'onset': ev_mat[:, 0],
+                       'duration': ev_mat[:, 1],
+                       'end': ev_mat[:, 0] + ev_mat[:, 1]})
     return df
 
 
+def _read_nifti_header(filename):
+    """Read shape, affine and repetition time of
+    a NIfTI file from its header only."""
+    img = nib.load(filename)
+    header = img.header
+    zooms = header.get_zooms()
+    tr = None
+    if len(zooms) > 3:
+        tr = float(zooms[3])
+        if header.get_xyzt_units()[1] == 'msec':
+            tr /= 1000.
+    return {'shape': [int(s) for s in header.get_data_shape()],
+            'affine': np.asarray(img.affine).tolist(),
+            'tr': tr}
+
+
+def _read_nifti_meta(meta_file):
+    """Return the cached header entries of meta_file,
+    or an empty dict if it is missing or unreadable."""
+    try:
+        with open(meta_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _load_nifti_headers(filenames, meta_file):
+    """Return the header information of a set of NIfTI files,
+    using the cached entries of meta_file where the files
+    are unchanged and updating meta_file otherwise.
+
+    If meta_file cannot be written (eg., for a read-only
+    dataset), the headers are returned without caching them."""
+    meta = _read_nifti_meta(meta_file)
+    headers = {}
+    updated = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        key = os.path.basename(filename)
+        entry = meta.get(key)
+        if (entry is None or
+                entry['size'] != stat.st_size or
+                entry['mtime_ns'] != stat.st_mtime_ns):
+            entry = _read_nifti_header(filename)
+            entry['size'] = stat.st_size
+            entry['mtime_ns'] = stat.st_mtime_ns
+            updated[key] = entry
+        headers[filename] = entry
+    if updated:
+        # merge into the current entries, which other
+        # processes may have updated in the meantime
+        meta = _read_nifti_meta(meta_file)
+        meta.update(updated)
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(meta_file),
+                                            prefix='.tmp_', suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_file, meta_file)
+        except OSError:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return headers
+
+
 def _init_datadict(subject,
                    task,
                    runs,
@@ -95,13 +178,20 @@ def _init_datadict(subject,
     f['anat_mni'] = None
     f['tr'] = t_r
     f['runs'] = runs
+    headers = _load_nifti_headers(
+        [paths.path_bids_func_mni(subject, task, run, path) for run in runs],
+        paths.path_bids_func_meta(subject, path))
     for ri, run in enumerate(runs):
         f_run = {}
         f_run['func'] = None
         f_run['func_mni'] = paths.path_bids_func_mni(subject, task, run, path)
         f_run['func_mask_mni'] = paths.path_bids_func_mask_mni(
             subject, task, run, path)
-        f_run['n_volumes'] = np.int(load_img(f_run['func_mni']).shape[-1])
+        header = headers[f_run['func_mni']]
+        f_run['shape'] = tuple(header['shape'])
+        f_run['affine'] = np.array(header['affine'])
+        f_run['header_tr'] = header['tr']
+        f_run['n_volumes'] = int(header['shape'][-1])
         f_run['trial'] = np.zeros(f_run['n_volumes']) * np.nan
         f_run['n_trial_volumes'] = np.zeros_like(f_run['trial']) * np.nan
         f_run['rel_onset'] = np.zeros_like(f_run['trial']) * np.nan
@@ -120,41 +210,44 @@ def _add_markers_to_datadict(f, EV, n_volumes_discard_trial_onset=1, n_volumes_a
     t_r = f['tr']
 
     # recode stimulus classes
-    event_types = EV['event_type'].values
-    unique_event_types = np.sort(np.unique(event_types))
-    numerical_event_types = np.arange(unique_event_types.size)
-    mapping = {}
-    f['event_type_mapping'] = {}
-    for num_type in numerical_event_types:
-        f['event_type_mapping'][num_type] = unique_event_types[num_type]
-    f['event_type_mapping'][numerical_event_types.max()+1] = 'fixation'
-    tmp = np.ones_like(event_types) * np.nan
-    for event_type in unique_event_types:
-        tmp[np.where(event_types == event_type)[0]] = numerical_event_types[
-            np.where(unique_event_types == event_type)[0]]
-    EV['event_num'] = np.array(tmp)
+    unique_event_types, event_num = np.unique(
+        EV['event_type'].values, return_inverse=True)
+    f['event_type_mapping'] = dict(enumerate(unique_event_types))
+    f['event_type_mapping'][unique_event_types.size] = 'fixation'
+    EV['event_num'] = event_num.reshape(-1).astype(float)
 
     # insert marker data
-    runs = EV['run'].unique()
-    for run in runs:
-        run_data = EV[EV['run'] == run].copy()
-        trials = np.sort(run_data['trial'].values)
-        for trial in trials:
-            trial_data = run_data[run_data['trial'] == trial].copy()
-
-            trial_type = trial_data['event_num'].values[0]
-            run = trial_data['run'].values[0]
-            trial_onset = trial_data['onset'].values[0]
-            trial_end = trial_data['end'].values[0]
-            volume_idx = np.where(
-              (f[run]['onset'] >= (trial_onset + (n_volumes_discard_trial_onset*t_r))) &
-              (f[run]['onset'] <= (trial_end+t_r + (n_volumes_add_trial_end*t_r))))[0]
-            f[run]['trial'][volume_idx] = trial
-            f[run]['n_trial_volumes'][volume_idx] = volume_idx.size
-            f[run]['rel_onset'][volume_idx] = f[run]['onset'][volume_idx] - trial_onset
-            f[run]['trial_type'][volume_idx] = trial_type
-            f[run]['n_valid_volumes'] += len(volume_idx)
-            f[run]['n_trials'] += 1
+    for run, run_data in EV.groupby('run', sort=False):
+        order = np.argsort(run_data['trial'].values, kind='stable')
+        trial = run_data['trial'].values[order]
+        trial_type = run_data['event_num'].values[order]
+        trial_onset = run_data['onset'].values[order]
+        trial_end = run_data['end'].values[order]
+
+        # first and last (excl.) volume of each trial window
+        onset = f[run]['onset']
+        start = np.searchsorted(
+            onset, trial_onset + (n_volumes_discard_trial_onset*t_r), side='left')
+        stop = np.searchsorted(
+            onset, trial_end+t_r + (n_volumes_add_trial_end*t_r), side='right')
+        n_trial_volumes = np.maximum(stop - start, 0)
+
+        # one entry per (trial, volume) pair
+        trial_idx = np.repeat(np.arange(trial.size), n_trial_volumes)
+        volume_idx = (np.arange(trial_idx.size) -
+                      np.repeat(np.cumsum(n_trial_volumes) - n_trial_volumes, n_trial_volumes) +
+                      np.repeat(start, n_trial_volumes))
+
+        # volumes in overlapping windows belong to the later trial
+        volume_idx, last = np.unique(volume_idx[::-1], return_index=True)
+        trial_idx = trial_idx[::-1][last]
+
+        f[run]['trial'][volume_idx] = trial[trial_idx]
+        f[run]['n_trial_volumes'][volume_idx] = n_trial_volumes[trial_idx]
+        f[run]['rel_onset'][volume_idx] = onset[volume_idx] - trial_onset[trial_idx]
+        f[run]['trial_type'][volume_idx] = trial_type[trial_idx]
+        f[run]['n_valid_volumes'] += int(n_trial_volumes.sum())
+        f[run]['n_trials'] += int(trial.size)
 
     return f
 
@@ -1,12 +1,10 @@
 #!/usr/bin/python
-import os
-import pandas as pd
 import numpy as np
 
 from ._utils import _load_subject_data, _generate_ev_df
 
 
-def summarize_subject_EVs(task, subject, runs, path):
+def summarize_subject_EVs(task, subject, runs, path, layout=None):
     """Summarize EV data of a task and subject, across runs.
 
     Args:
@@ -15,18 +13,14 @@ def summarize_subject_EVs(task, subject, runs, path):
         runs: A sequence of the runs ["LR", "RL"] for 
             which to summarize the EV data.
         path: Path to the local HCP data in BIDS format.
+        layout: hcprep.paths.BIDSLayout of the BIDS directory.
+            If given, the EV files are looked up in its index
+            instead of listing the directory.
 
     Returns:
         EV_summary: Pandas dataframe summarizing the EV data.
     """
-    df_list = []
-    for run in runs:
-        EV_files = [f for f in os.listdir(path) if
-                    ('EV-' in f) and (task in f) and
-                    ('run-{}'.format(run) in f) and not 'summary' in f]
-        df_tmp = _generate_ev_df(path, EV_files, task, subject, run)
-        df_list.append(df_tmp)
-    EV_summary = pd.concat(df_list)
+    EV_summary = _generate_ev_df(path, task, subject, runs, layout)
     EV_summary = EV_summary.sort_values(by=['run', 'onset'])
     EV_summary['trial'] = np.arange(EV_summary.shape[0])
     return EV_summary.copy().reset_index(drop=True)
@@ -47,7 +41,12 @@ def load_subject_data(task, subject, runs, path, t_r=0.72):
     Returns:
         Dict of data, containing one entry per run and
             a summary of the fMRI data for this run
-            (incl. the paths for the fMRI data files).
+            (incl. the paths for the fMRI data files
+            and their shape, affine and repetition time).
+            The shapes, affines and repetition times are read
+            from the NIfTI headers only and cached in a
+            sidecar file of the subject (see
+            hcprep.paths.path_bids_func_meta).
     """
     subject_data_dict = _load_subject_data(subject, task, runs, path, t_r)
     return subject_data_dict
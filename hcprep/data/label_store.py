@@ -0,0 +1,185 @@
+#!/usr/bin/python
+import os
+import json
+import numpy as np
+
+from ._utils import _load_subject_data
+from .. import paths
+
+
+_COLUMNS = {'subject': np.int64,
+            'task_id': np.int8,
+            'run_id': np.int8,
+            'volume_idx': np.int32,
+            'trial': np.float64,
+            'trial_type': np.float64,
+            'label': np.int8,
+            'rel_onset': np.float64,
+            'n_trial_volumes': np.float64}
+
+
+def build_label_store(jobs, path, store_path, tasks, runs, classes_per_task, t_r=0.72):
+    """Materialize the volume labels of many HCP subject
+    runs in one columnar label store.
+
+    The store contains one row per fMRI volume, with the
+    columns: subject, task_id, run_id, volume_idx, trial,
+    trial_type, label, rel_onset and n_trial_volumes (see
+    hcprep.data.load_subject_data). "label" is the index of
+    the volume's event type in classes_per_task[task]
+    (-1 for volumes outside of a trial). Each column is stored
+    as a .npy file, so that it can be memory-mapped.
+
+    Args:
+        jobs: A sequence of (subject, task, run) tuples.
+        path: Path to the local HCP data in BIDS format.
+        store_path: Path to which the label store is written.
+        tasks: Sequence of all HCP task names
+            (as in hcprep.info.basics); defines task_id.
+        runs: Sequence of all HCP run names
+            (as in hcprep.info.basics); defines run_id.
+        classes_per_task: Dict of class names per task
+            (as in hcprep.info.basics); defines label.
+        t_r: Repetition time of HCP data
+
+    Returns:
+        hcprep.data.LabelStore
+    """
+    # group runs of each subject and task
+    units = {}
+    for subject, task, run in jobs:
+        units.setdefault((subject, task), []).append(run)
+
+    columns = {column: [] for column in _COLUMNS}
+    index = []
+    n_rows = 0
+    for (subject, task), subject_runs in units.items():
+        f = _load_subject_data(subject, task, subject_runs, path, t_r)
+        class_idx = {c: i for i, c in enumerate(classes_per_task[task])}
+        labels = np.array([class_idx.get(f['event_type_mapping'][i], -1)
+                           for i in sorted(f['event_type_mapping'])])
+        for run in subject_runs:
+            f_run = f[run]
+            n_volumes = f_run['n_volumes']
+            trial_type = f_run['trial_type']
+            label = np.full(n_volumes, -1)
+            valid = np.isfinite(trial_type)
+            label[valid] = labels[trial_type[valid].astype(int)]
+            columns['subject'].append(np.full(n_volumes, int(subject)))
+            columns['task_id'].append(np.full(n_volumes, tasks.index(task)))
+            columns['run_id'].append(np.full(n_volumes, runs.index(run)))
+            columns['volume_idx'].append(np.arange(n_volumes))
+            columns['trial'].append(f_run['trial'])
+            columns['trial_type'].append(trial_type)
+            columns['label'].append(label)
+            columns['rel_onset'].append(f_run['rel_onset'])
+            columns['n_trial_volumes'].append(f_run['n_trial_volumes'])
+            index.append([int(subject), task, run, n_rows, n_rows+n_volumes])
+            n_rows += n_volumes
+
+    paths.make_sure_path_exists(store_path)
+    for column, dtype in _COLUMNS.items():
+        values = (np.concatenate(columns[column]).astype(dtype)
+                  if columns[column] else np.zeros(0, dtype=dtype))
+        np.save(os.path.join(store_path, column+'.npy'), values)
+    with open(os.path.join(store_path, 'index.json'), 'w') as f:
+        json.dump({'tasks': list(tasks),
+                   'runs': list(runs),
+                   'classes_per_task': {task: list(classes)
+                                        for task, classes in classes_per_task.items()},
+                   't_r': t_r,
+                   'n_rows': n_rows,
+                   'units': index}, f)
+    return LabelStore(store_path)
+
+
+class LabelStore:
+    """Memory-mapped columnar store of the volume labels
+    of many HCP subject runs, as created with
+    hcprep.data.build_label_store.
+
+    Columns are only read from disk when they are accessed.
+
+    Args:
+        store_path: Path of the label store.
+
+    Attributes:
+        tasks, runs, classes_per_task: HCP task names, run
+            names and class names per task that define the
+            task_id, run_id and label columns.
+        units: Sequence of (subject, task, run, start, stop)
+            tuples, indicating the rows of each subject run.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.tasks = index['tasks']
+        self.runs = index['runs']
+        self.classes_per_task = index['classes_per_task']
+        self.t_r = index['t_r']
+        self.n_rows = index['n_rows']
+        self.units = [tuple(unit) for unit in index['units']]
+        self._columns = {}
+
+    def __getitem__(self, column):
+        """Return the memory-mapped column."""
+        if column not in self._columns:
+            if column not in _COLUMNS:
+                raise KeyError('Invalid column: {}'.format(column))
+            self._columns[column] = np.load(
+                os.path.join(self.store_path, column+'.npy'), mmap_mode='r')
+        return self._columns[column]
+
+    def __len__(self):
+        return self.n_rows
+
+    def query(self, subjects=None, tasks=None, runs=None, labels=None, valid_only=True):
+        """Return the row indices of all volumes that
+        match the query.
+
+        Eg., all valid WM volumes with label faces:
+        store.query(tasks=['WM'], labels=['faces'])
+
+        Args:
+            subjects: Sequence of subject IDs (None for all).
+            tasks: Sequence of task names (None for all).
+            runs: Sequence of run names (None for all).
+            labels: Sequence of class names (None for all).
+            valid_only: Bool indicating whether only volumes
+                within a trial are returned.
+
+        Returns:
+            Ndarray of row indices.
+        """
+        selected = np.ones(self.n_rows, dtype=bool)
+        if subjects is not None:
+            selected &= np.isin(self['subject'],
+                                np.array(subjects, dtype=np.int64))
+        if tasks is not None:
+            selected &= np.isin(self['task_id'],
+                                [self.tasks.index(task) for task in tasks])
+        if runs is not None:
+            selected &= np.isin(self['run_id'],
+                                [self.runs.index(run) for run in runs])
+        if labels is not None:
+            matches = np.zeros(self.n_rows, dtype=bool)
+            task_id = self['task_id']
+            label = self['label']
+            for ti, task in enumerate(self.tasks):
+                idx = [i for i, c in enumerate(self.classes_per_task.get(task, []))
+                       if c in labels]
+                if idx:
+                    matches |= (task_id == ti) & np.isin(label, idx)
+            selected &= matches
+        if valid_only:
+            selected &= np.isfinite(self['trial_type'])
+        return np.where(selected)[0]
+
+    def select(self, rows, columns=None):
+        """Return a dict of the values of the given
+        rows for each column (default: all columns)."""
+        if columns is None:
+            columns = list(_COLUMNS)
+        return {column: np.asarray(self[column][rows]) for column in columns}
@@ -1,7 +1,13 @@
 #!/usr/bin/python
-from .download import connect_to_hcp_bucket, retrieve_subject_ids, check_subject_data_present, download_subject_data
+from .download import connect_to_hcp_bucket, retrieve_subject_ids, iter_subject_ids, load_subject_manifest, check_subject_data_present, download_subject_data, download_subjects_data
+from .storage import S3Storage, LocalStorage
 
 __all__ = ['connect_to_hcp_bucket',
            'retrieve_subject_ids',
+           'iter_subject_ids',
+           'load_subject_manifest',
            'check_subject_data_present',
-           'download_subject_data']
+           'download_subject_data',
+           'download_subjects_data',
+           'S3Storage',
+           'LocalStorage']
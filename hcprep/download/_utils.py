@@ -1,5 +1,14 @@
 #!/usr/bin/python
 import os
+import json
+import time
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .. import paths
 
 
 def _return_hcp_EV_file_ids(task):
@@ -61,10 +70,397 @@ def _return_hcp_EV_file_ids(task):
     return file_types
 
 
-def _check_key_exists(key, bucket, prefix):
-    keys = [o.key for o in bucket.objects.filter(Prefix=prefix)]
-    if key in keys:
-        check = True
+def _path_manifest(subject, path):
+    return path+'sub-{}_manifest.json'.format(subject)
+
+
+def _read_manifest(subject, path, ttl):
+    manifest_file = _path_manifest(subject, path)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        cached = json.load(f)
+    if (time.time() - cached['created']) > ttl:
+        return None
+    return {key: tuple(value) for key, value in cached['objects'].items()}
+
+
+def _write_manifest(manifest, subject, path):
+    paths.make_sure_path_exists(path)
+    manifest_file = _path_manifest(subject, path)
+    tmp_file = manifest_file+'.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'created': time.time(),
+                   'subject': str(subject),
+                   'objects': manifest}, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def _return_subject_run_files(subject, task, run, output_path, include_anat=True):
+    """Return (bucket key, local output file) pairs of all
+    files of a subject in a task run (without the anatomical
+    scan, if include_anat is False)."""
+    prefix = ('HCP/{}/'.format(subject) +
+              'MNINonLinear/' +
+              'Results/' +
+              'tfMRI_{}_{}/'.format(task, run))
+    path_func = output_path+'sub-{}/func/'.format(subject)
+    files = []
+    # tfMRI data
+    files.append((prefix+'tfMRI_{}_{}.nii.gz'.format(task, run),
+                  paths.path_bids_func_mni(subject, task, run, output_path)))
+    # brainmask
+    files.append((prefix+'brainmask_fs.2.nii.gz',
+                  paths.path_bids_func_mask_mni(subject, task, run, output_path)))
+    # anatomical data
+    if include_anat:
+        files.append(('HCP/{}/MNINonLinear/T1w.nii.gz'.format(subject),
+                      paths.path_bids_anat_mni(subject, task, output_path)))
+    # EV data
+    for EV_file in _return_hcp_EV_file_ids(task):
+        files.append((prefix+'EVs/'+EV_file,
+                      path_func+'sub-{}_task-{}_run-{}_EV-{}'.format(
+                          subject, task, run, EV_file)))
+    return files
+
+
+def _make_subject_dirs(subject, output_path):
+    path_sub = output_path+'sub-{}/'.format(subject)
+    paths.make_sure_path_exists(path_sub)
+    paths.make_sure_path_exists(path_sub+'anat/')
+    paths.make_sure_path_exists(path_sub+'func/')
+
+
+def _format_bytes(n_bytes):
+    return '{:.1f} MB'.format(n_bytes / 1024. / 1024.)
+
+
+def _path_transfer_state(output_file, extension):
+    """Return the path of a transfer state file
+    (partial download or verification sidecar)."""
+    path, filename = os.path.split(output_file)
+    return os.path.join(path, '.hcprep', filename+extension)
+
+
+def _is_verified(output_file, size, etag):
+    sidecar_file = _path_transfer_state(output_file, '.verified.json')
+    if not os.path.isfile(output_file) or not os.path.isfile(sidecar_file):
+        return False
+    with open(sidecar_file, 'r') as f:
+        sidecar = json.load(f)
+    stat = os.stat(output_file)
+    return (sidecar['size'] == size and
+            sidecar['etag'] == etag and
+            sidecar['local_size'] == stat.st_size and
+            sidecar['local_mtime_ns'] == stat.st_mtime_ns)
+
+
+def _write_verified(output_file, size, etag, method):
+    sidecar_file = _path_transfer_state(output_file, '.verified.json')
+    stat = os.stat(output_file)
+    tmp_file = sidecar_file+'.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'size': size,
+                   'etag': etag,
+                   'method': method,
+                   'local_size': stat.st_size,
+                   'local_mtime_ns': stat.st_mtime_ns}, f)
+    os.replace(tmp_file, sidecar_file)
+
+
+class _ETagHasher:
+    """Incrementally computes the S3 ETag of a file.
+
+    Single-part ETags are the MD5 of the object. Multipart
+    ETags are the MD5 of the concatenated part MD5s, followed
+    by the number of parts. As the part size is unknown,
+    all common part sizes that are consistent with the
+    number of parts are tracked.
+    """
+
+    _part_sizes = [8, 16, 5, 15, 32, 64, 100]
+
+    def __init__(self, etag, size):
+        self.etag = etag
+        if '-' in etag:
+            n_parts = int(etag.split('-')[1])
+            self.part_sizes = [p*1024*1024 for p in self._part_sizes
+                               if int(np.ceil(size / (p*1024*1024))) == n_parts]
+        else:
+            self.part_sizes = [None]
+        self._md5 = [hashlib.md5() for _ in self.part_sizes]
+        self._part_md5s = [[] for _ in self.part_sizes]
+        self._part_offsets = [0 for _ in self.part_sizes]
+
+    @property
+    def method(self):
+        if not self.part_sizes:
+            return 'size'
+        return 'etag'
+
+    def update(self, chunk):
+        for i, part_size in enumerate(self.part_sizes):
+            if part_size is None:
+                self._md5[i].update(chunk)
+                continue
+            view = memoryview(chunk)
+            while len(view):
+                n = min(len(view), part_size - self._part_offsets[i])
+                self._md5[i].update(view[:n])
+                self._part_offsets[i] += n
+                view = view[n:]
+                if self._part_offsets[i] == part_size:
+                    self._part_md5s[i].append(self._md5[i].digest())
+                    self._md5[i] = hashlib.md5()
+                    self._part_offsets[i] = 0
+
+    def matches(self):
+        if not self.part_sizes:
+            return True
+        for i, part_size in enumerate(self.part_sizes):
+            if part_size is None:
+                if self._md5[i].hexdigest() == self.etag:
+                    return True
+                continue
+            part_md5s = list(self._part_md5s[i])
+            if self._part_offsets[i]:
+                part_md5s.append(self._md5[i].digest())
+            etag = '{}-{}'.format(
+                hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))
+            if etag == self.etag:
+                return True
+        return False
+
+
+def _hash_file(hasher, filename, chunk_size):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+
+
+def _read_done_ranges(state_file):
+    """Return the (start, end) byte ranges recorded as
+    complete in the state file of a partial download."""
+    ranges = []
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                # skip a line that was cut off by an interruption
+                if len(fields) == 2 and line.endswith('\n'):
+                    ranges.append((int(fields[0]), int(fields[1])))
+    return ranges
+
+
+def _fetch_parts(client, bucket_name, key, part_file, size, etag,
+                 chunk_size, n_part_workers):
+    """Download the missing ranged parts (of chunk_size bytes)
+    of an S3 object into part_file, n_part_workers at a time.
+
+    Each completed part is recorded in a state file next to
+    part_file, so that an interrupted transfer only downloads
+    the parts that are missing. A partial file of a sequential
+    transfer provides all parts that it covers.
+
+    Returns:
+        Number of transferred bytes.
+    """
+    state_file = part_file+'s'
+    if os.path.isfile(part_file) and os.path.isfile(state_file):
+        done = _read_done_ranges(state_file)
+    elif os.path.isfile(part_file) and os.path.getsize(part_file) <= size:
+        done = [(0, os.path.getsize(part_file))]
+    else:
+        done = []
+    with open(part_file, 'ab'):
+        pass
+    os.truncate(part_file, size)
+    with open(state_file, 'w') as f:
+        for start, end in done:
+            f.write('{} {}\n'.format(start, end))
+    missing = [start for start in range(0, size, chunk_size)
+               if not any(s <= start and min(start+chunk_size, size) <= e
+                          for s, e in done)]
+    state_lock = threading.Lock()
+
+    def _fetch_part(start):
+        end = min(start+chunk_size, size)
+        body = client.get_object(Bucket=bucket_name, Key=key, IfMatch=etag,
+                                 Range='bytes={}-{}'.format(start, end-1))['Body']
+        n_bytes = 0
+        with open(part_file, 'r+b') as f:
+            f.seek(start)
+            for chunk in body.iter_chunks(1024*1024):
+                f.write(chunk)
+                n_bytes += len(chunk)
+        if n_bytes != end - start:
+            raise IOError('Transfer of {} was incomplete.'.format(key))
+        with state_lock:
+            with open(state_file, 'a') as f:
+                f.write('{} {}\n'.format(start, end))
+        return n_bytes
+
+    with ThreadPoolExecutor(max_workers=n_part_workers) as executor:
+        return sum(executor.map(_fetch_part, missing))
+
+
+def _fetch_file(client, bucket_name, key, output_file, stat=None, chunk_size=8*1024*1024,
+                n_part_workers=1):
+    """Download an S3 object to output_file.
+
+    Objects that are larger than chunk_size are downloaded
+    in ranged parts of chunk_size bytes, n_part_workers of
+    which are transferred concurrently; smaller objects (or all
+    objects, if n_part_workers is 1) are streamed. The data
+    is written to a partial file, which is resumed if a previous
+    transfer was interrupted. Once complete, its size and ETag
+    are verified against the S3 object, the partial file is
+    atomically renamed to output_file and the result is recorded
+    in a sidecar, so that verified files are not hashed again.
+
+    Returns:
+        Number of transferred bytes.
+    """
+    if stat is None:
+        head = client.head_object(Bucket=bucket_name, Key=key)
+        stat = (head['ContentLength'], head['ETag'].strip('"'))
+    size, etag = stat
+    if _is_verified(output_file, size, etag):
+        return 0
+    paths.make_sure_path_exists(os.path.dirname(
+        _path_transfer_state(output_file, '')))
+
+    # verify files that were downloaded without a sidecar
+    if os.path.isfile(output_file) and os.path.getsize(output_file) == size:
+        hasher = _ETagHasher(etag, size)
+        _hash_file(hasher, output_file, chunk_size)
+        if hasher.matches():
+            _write_verified(output_file, size, etag, hasher.method)
+            return 0
+
+    part_file = _path_transfer_state(output_file, '.part')
+    state_file = part_file+'s'
+    hasher = _ETagHasher(etag, size)
+    n_bytes = 0
+    if n_part_workers > 1 and size > chunk_size:
+        # download ranged parts concurrently
+        n_bytes = _fetch_parts(client, bucket_name, key, part_file, size, etag,
+                               chunk_size, n_part_workers)
+        _hash_file(hasher, part_file, chunk_size)
     else:
-        check = False
-    return check
\ No newline at end of file
+        # resume partial download
+        if os.path.isfile(state_file):
+            # discard the partial file of a ranged download
+            if os.path.isfile(part_file):
+                os.remove(part_file)
+            os.remove(state_file)
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        if offset > size:
+            os.remove(part_file)
+            offset = 0
+        if offset:
+            _hash_file(hasher, part_file, chunk_size)
+        if offset < size:
+            request = dict(Bucket=bucket_name, Key=key, IfMatch=etag)
+            if offset:
+                request['Range'] = 'bytes={}-'.format(offset)
+            body = client.get_object(**request)['Body']
+            with open(part_file, 'ab') as f:
+                for chunk in body.iter_chunks(chunk_size):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    n_bytes += len(chunk)
+        elif not os.path.isfile(part_file):
+            open(part_file, 'wb').close()
+
+    # verify and move into place
+    if os.path.getsize(part_file) != size or not hasher.matches():
+        os.remove(part_file)
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+        raise IOError('Verification of {} failed.'.format(key))
+    os.replace(part_file, output_file)
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    _write_verified(output_file, size, etag, hasher.method)
+    return n_bytes
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def _path_lock(filename):
+    """Return the lock of a local file, which serializes
+    all threads that transfer to (or link) this file."""
+    with _path_locks_lock:
+        if filename not in _path_locks:
+            _path_locks[filename] = threading.Lock()
+        return _path_locks[filename]
+
+
+def _path_object(stat, store_path):
+    """Return the path of an S3 object in the local
+    content-addressed object store.
+
+    Objects are spread over subdirectories by a hash of
+    their ETag, as ETags need not be uniformly distributed
+    (eg., the file identities of hcprep.download.LocalStorage
+    all share the same device prefix)."""
+    size, etag = stat
+    shard = hashlib.md5(etag.encode()).hexdigest()[:2]
+    return store_path+'{}/{}-{}'.format(shard, etag, size)
+
+
+def _link_file(source_file, output_file):
+    """Atomically point output_file to source_file, with
+    a hardlink if possible and a symlink or copy otherwise."""
+    if os.path.isfile(output_file) and os.path.samefile(source_file, output_file):
+        return
+    tmp_file = _path_transfer_state(output_file, '.link')
+    paths.make_sure_path_exists(os.path.dirname(tmp_file))
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        os.link(source_file, tmp_file)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(source_file, os.path.dirname(output_file)),
+                       tmp_file)
+        except OSError:
+            shutil.copyfile(source_file, tmp_file)
+    os.replace(tmp_file, output_file)
+
+
+def _fetch_file_to_store(storage, key, output_file, store_path,
+                         stat=None, chunk_size=8*1024*1024, n_part_workers=1):
+    """Fetch an object into the content-addressed object
+    store and link output_file to it. Every object is only
+    transferred and stored once, however many local
+    files refer to it.
+
+    Returns:
+        Number of transferred bytes.
+    """
+    if stat is None:
+        stat = storage.stat(key)
+        if stat is None:
+            raise IOError('{} does not exist.'.format(key))
+    object_file = _path_object(stat, store_path)
+    with _path_lock(object_file):
+        paths.make_sure_path_exists(os.path.dirname(object_file))
+        # adopt files that were downloaded without the store;
+        # they are verified (and replaced if needed) by fetch
+        if (not os.path.isfile(object_file) and
+                os.path.isfile(output_file) and
+                not os.path.islink(output_file) and
+                os.path.getsize(output_file) == stat[0]):
+            try:
+                os.link(output_file, object_file)
+            except OSError:
+                pass
+        n_bytes = storage.fetch(key, object_file,
+                                stat=stat, chunk_size=chunk_size,
+                                n_part_workers=n_part_workers)
+        _link_file(object_file, output_file)
+    return n_bytes
@@ -1,10 +1,14 @@
 #!/usr/bin/python
 import sys
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import boto3
 
-from ._utils import _return_hcp_EV_file_ids, _check_key_exists
+from ._utils import _return_hcp_EV_file_ids, _read_manifest, _write_manifest, _return_subject_run_files, _make_subject_dirs, _format_bytes, _fetch_file_to_store, _path_lock
+from .storage import S3Storage
 from ..data import summarize_subject_EVs
 from .. import paths
 
@@ -28,7 +32,21 @@ def connect_to_hcp_bucket(ACCESS_KEY, SECRET_KEY):
     return bucket
 
 
-def retrieve_subject_ids(ACCESS_KEY, SECRET_KEY, task, runs=['LR', 'RL'], n=1000):
+def _as_storage(bucket):
+    """Wrap a boto3 bucket in a storage backend."""
+    if hasattr(bucket, 'fetch'):
+        return bucket
+    return S3Storage(bucket=bucket)
+
+
+def _get_storage(ACCESS_KEY, SECRET_KEY, storage, max_pool_connections=10):
+    if storage is not None:
+        return storage
+    return S3Storage(ACCESS_KEY, SECRET_KEY,
+                     max_pool_connections=max_pool_connections)
+
+
+def retrieve_subject_ids(ACCESS_KEY, SECRET_KEY, task, runs=['LR', 'RL'], n=1000, manifest_path=None, n_workers=10, storage=None):
     """Retrieve IDs of HCP subjects in a task from 
     the AWS S3 servers.
 
@@ -38,63 +56,156 @@ def retrieve_subject_ids(ACCESS_KEY, SECRET_KEY, task, runs=['LR', 'RL'], n=1000
         task: String ID of HCP task.
         runs: A sequence of the HCP run IDs ["LR",, "RL"]
         n: Number of subject IDs to retrieve.
+        manifest_path: Local path in which the object index
+            of each subject is stored for reuse
+            (see hcprep.download.load_subject_manifest).
+        n_workers: Number of subjects that are checked concurrently.
+        storage: Storage backend (hcprep.download.S3Storage or
+            hcprep.download.LocalStorage) from which the data
+            is retrieved. If None, the HCP AWS S3 bucket is used.
 
     Returns:
         Subject_ids: Sequence of retrieved subject IDs.
     """
-    bucket = connect_to_hcp_bucket(
-        ACCESS_KEY=ACCESS_KEY, SECRET_KEY=SECRET_KEY)
-    subject_ids = []
-    sample_key = ('/MNINonLinear/' +
-                  'Results/' +
-                  'tfMRI_{}_RL/'.format(task) +
-                  'tfMRI_{}_RL.nii.gz'.format(task))
-    for o in bucket.objects.filter(Prefix='HCP'):
-        if (sample_key in o.key):
-            subject = o.key.split('/')[1]
-            if check_subject_data_present(bucket, subject, task, runs):
-                if subject not in subject_ids:
-                    subject_ids.append(subject)
-        if len(subject_ids) >= n:
-            break
-    return subject_ids
-
-
-def check_subject_data_present(bucket, subject, task, runs):
+    return list(iter_subject_ids(ACCESS_KEY, SECRET_KEY, task, runs=runs, n=n,
+                                 manifest_path=manifest_path, n_workers=n_workers,
+                                 storage=storage))
+
+
+def iter_subject_ids(ACCESS_KEY, SECRET_KEY, task, runs=['LR', 'RL'], n=1000, manifest_path=None, n_workers=10, storage=None):
+    """Iterate over the IDs of HCP subjects in a task
+    whose task-fMRI data is present on the AWS S3 servers.
+
+    Subject directories are enumerated with a delimiter
+    listing of the bucket, while the availability of their
+    data is checked concurrently. Subject IDs are yielded
+    as soon as they are confirmed, in the order in which
+    they are listed in the bucket.
+
+    Args:
+        ACCESS_KEY, SECRET_KEY: access and secret
+            keys necessary to access HCP AWS S3 storage.
+        task: String ID of HCP task.
+        runs: A sequence of the HCP run IDs ["LR",, "RL"]
+        n: Maximum number of subject IDs to yield.
+        manifest_path: Local path in which the object index
+            of each subject is stored for reuse
+            (see hcprep.download.load_subject_manifest).
+        n_workers: Number of subjects that are checked concurrently.
+        storage: Storage backend (hcprep.download.S3Storage or
+            hcprep.download.LocalStorage) from which the data
+            is retrieved. If None, the HCP AWS S3 bucket is used.
+
+    Yields:
+        String ID of a subject whose data is present.
+    """
+    storage = _get_storage(ACCESS_KEY, SECRET_KEY, storage,
+                           max_pool_connections=n_workers)
+
+    def _check(subject):
+        manifest = load_subject_manifest(storage, subject, manifest_path)
+        return check_subject_data_present(storage, subject, task, runs, manifest)
+
+    n_found = 0
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        subjects = storage.list_dirs('HCP/')
+        while n_found < n:
+            # keep a bounded number of checks in flight
+            while len(pending) < 2*n_workers:
+                subject = next(subjects, None)
+                if subject is None:
+                    break
+                pending.append((subject, executor.submit(_check, subject)))
+            if not pending:
+                break
+            subject, future = pending.popleft()
+            if future.result():
+                yield subject
+                n_found += 1
+    finally:
+        # do not wait for running checks if the
+        # generator is closed (or n subjects are found)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_subject_manifest(bucket, subject, manifest_path=None, ttl=7*24*3600):
+    """Return an index of all objects in the MNINonLinear/
+    directory of a HCP subject in the AWS S3 bucket
+    (or another storage backend).
+
+    The directory is listed once. If manifest_path is given,
+    the index is stored there and reused until it is older
+    than ttl seconds.
+
+    Args:
+        bucket: Boto3 bucket created with
+            hcprep.download.connect_to_hcp_bucket,
+            or a storage backend (hcprep.download.S3Storage
+            or hcprep.download.LocalStorage).
+        subject: Integer ID of HCP subject
+        manifest_path: Local path in which the index is stored.
+            If None, the index is not stored.
+        ttl: Time (in seconds) after which a stored index expires.
+
+    Returns:
+        Dict mapping the bucket key of each object
+            to a tuple of its size (in bytes) and ETag
+            (or file identity, for local storage).
+    """
+    if manifest_path is not None:
+        manifest = _read_manifest(subject, manifest_path, ttl)
+        if manifest is not None:
+            return manifest
+    manifest = _as_storage(bucket).list(
+        'HCP/{}/MNINonLinear/'.format(subject))
+    if manifest_path is not None:
+        _write_manifest(manifest, subject, manifest_path)
+    return manifest
+
+
+def check_subject_data_present(bucket, subject, task, runs, manifest=None):
     """Check if a subject's task-fMRI data is present
-    in the AWS S3 bucket.
+    in the AWS S3 bucket (or another storage backend).
 
     Args:
         bucket: Boto3 bucket created with
-            hcprep.download.connect_to_hcp_bucket
+            hcprep.download.connect_to_hcp_bucket,
+            or a storage backend (hcprep.download.S3Storage
+            or hcprep.download.LocalStorage).
         subject: Integer ID of HCP subject
         task: String ID of HCP task.
         runs: A sequence of the HCP run IDs ["LR", "RL"]
+        manifest: Object index of the subject, as returned
+            by hcprep.download.load_subject_manifest.
+            If None, the index is created.
 
     Returns:
         Bool indicating whether task-fMRI data present.
     """
+    if manifest is None:
+        manifest = load_subject_manifest(bucket, subject)
     checks = []
     for run in runs:
         prefix = 'HCP/{}/MNINonLinear/Results/tfMRI_{}_{}/'.format(
             subject, task, run)
         # tfMRI data
         tfMRI_key = (prefix+'tfMRI_{}_{}.nii.gz'.format(task, run))
-        checks.append(_check_key_exists(tfMRI_key, bucket, prefix))
+        checks.append(tfMRI_key in manifest)
 
         # tfMRI mask
         tfMRI_mask_key = (prefix + 'brainmask_fs.2.nii.gz')
-        checks.append(_check_key_exists(tfMRI_mask_key, bucket, prefix))
+        checks.append(tfMRI_mask_key in manifest)
 
         # anatomical scan
-        anat_prefix = 'HCP/{}/MNINonLinear/'.format(subject)
-        anat_key = ('T1w.nii.gz')
-        checks.append(_check_key_exists(anat_key, bucket, anat_prefix))
+        anat_key = 'HCP/{}/MNINonLinear/T1w.nii.gz'.format(subject)
+        checks.append(anat_key in manifest)
 
         # EV data
         for EV_file in _return_hcp_EV_file_ids(task):
             EV_key = (prefix+'EVs/'+EV_file)
-            checks.append(_check_key_exists(EV_key, bucket, prefix))
+            checks.append(EV_key in manifest)
 
     if np.sum(checks) == len(checks):
         return True
@@ -102,7 +213,7 @@ def check_subject_data_present(bucket, subject, task, runs):
         return False
 
 
-def download_subject_data(ACCESS_KEY, SECRET_KEY, subject, task, run, output_path):
+def download_subject_data(ACCESS_KEY, SECRET_KEY, subject, task, run, output_path, use_object_store=True, storage=None, include_anat=True):
     """Download the task-fMRI data of a HCP subject
     in a task run and write it to a local directory 
     in the Brain Imaging Data Structure (BIDS) format.
@@ -114,74 +225,141 @@ def download_subject_data(ACCESS_KEY, SECRET_KEY, subject, task, run, output_pat
         task: String ID of HCP task.
         runs: String ID of HCP run (one of ["LR", "RL"])
         output_path: Local path to which data is written.
+        use_object_store: Bool indicating whether files are
+            stored once in a content-addressed object store
+            (in output_path/.objects/) and linked to their
+            BIDS paths. This avoids downloading and storing
+            the same file (e.g., the anatomical scan) repeatedly.
+        storage: Storage backend (hcprep.download.S3Storage or
+            hcprep.download.LocalStorage) from which the data
+            is retrieved. If None, the HCP AWS S3 bucket is used.
+        include_anat: Bool indicating whether the anatomical
+            scan of the subject is downloaded.
     """
 
     # make sure all requiered dirs exist
-    path_sub = output_path+'sub-{}/'.format(subject)
-    path_anat = path_sub+'anat/'
-    path_func = path_sub+'func/'
-    paths.make_sure_path_exists(path_sub)
-    paths.make_sure_path_exists(path_anat)
-    paths.make_sure_path_exists(path_func)
-
-    # connect to S3 bucket
-    bucket = connect_to_hcp_bucket(
-        ACCESS_KEY=ACCESS_KEY, SECRET_KEY=SECRET_KEY)
-
-    # tfMRI data
-    bucket_id = ('HCP/{}/'.format(subject) +
-                 'MNINonLinear/' +
-                 'Results/' +
-                 'tfMRI_{}_{}/'.format(task, run) +
-                 'tfMRI_{}_{}.nii.gz'.format(task, run))
-    output_file = paths.path_bids_func_mni(subject, task, run, output_path)
-    if not os.path.isfile(output_file):
-        print('downloading file: {}  to  {}'.format(bucket_id, output_file))
-        bucket.download_file(bucket_id, output_file)
-        print('done.')
-
-    # brainmaks
-    bucket_id = ('HCP/{}/'.format(subject) +
-                 'MNINonLinear/' +
-                 'Results/' +
-                 'tfMRI_{}_{}/'.format(task, run) +
-                 'brainmask_fs.2.nii.gz')
-    output_file = paths.path_bids_func_mask_mni(
-        subject, task, run, output_path)
-    if not os.path.isfile(output_file):
-        print('downloading file: {}  to  {}'.format(bucket_id, output_file))
-        bucket.download_file(bucket_id, output_file)
-        print('done.')
+    _make_subject_dirs(subject, output_path)
 
-    # anatomical data
-    bucket_id = ('HCP/{}/'.format(subject) +
-                 'MNINonLinear/' +
-                 'T1w.nii.gz'.format(task, run))
-    output_file = paths.path_bids_anat_mni(subject, task, output_path)
-    if not os.path.isfile(output_file):
-        print('downloading file: {}  to  {}'.format(bucket_id, output_file))
-        bucket.download_file(bucket_id, output_file)
-        print('done.')
+    # connect to storage
+    storage = _get_storage(ACCESS_KEY, SECRET_KEY, storage)
 
-    # EV data
-    identifier = ('HCP/{}/'.format(subject) +
-                  'MNINonLinear/' +
-                  'Results/' +
-                  'tfMRI_{}_{}/'.format(task, run) +
-                  'EVs/')
-    for EV_file in _return_hcp_EV_file_ids(task):
-        bucket_id = identifier+EV_file
-        output_file = path_func+'sub-{}_task-{}_run-{}_EV-{}'.format(
-            subject, task, run, EV_file)
-        if not os.path.isfile(output_file):
-            print('downloading file: {}  to  {}'.format(bucket_id, output_file))
-            bucket.download_file(bucket_id, output_file)
-            print('done.')
+    # tfMRI data, brainmask, anatomical and EV data
+    for bucket_id, output_file in _return_subject_run_files(
+            subject, task, run, output_path, include_anat=include_anat):
+        n_bytes = _fetch(storage, bucket_id, output_file, output_path, use_object_store)
+        # files that are already present (and verified) are skipped silently
+        if n_bytes:
+            print('downloaded file: {}  to  {} ({})'.format(
+                bucket_id, output_file, _format_bytes(n_bytes)))
 
     # create EV summary
+    _create_EV_summary(subject, task, run, output_path)
+
+
+def download_subjects_data(ACCESS_KEY, SECRET_KEY, jobs, output_path,
+                           n_workers=8, chunk_size=8*1024*1024, manifest_path=None,
+                           use_object_store=True, storage=None, n_part_workers=4):
+    """Download the task-fMRI data of many HCP subject
+    runs concurrently and write it to a local directory
+    in the Brain Imaging Data Structure (BIDS) format.
+
+    All transfers share one pooled S3 client and are
+    run on a bounded thread pool. Large files are
+    downloaded in ranged parts, several of which are
+    transferred concurrently. Interrupted transfers
+    are resumed and every file is verified against the
+    size and ETag of its S3 object.
+
+    Args:
+        ACCESS_KEY, SECRET_KEY: access and secret
+            keys necessary to access HCP AWS S3 storage.
+        jobs: A sequence of (subject, task, run) tuples
+            to download.
+        output_path: Local path to which data is written.
+        n_workers: Maximum number of concurrently transferred files.
+        chunk_size: Size (in bytes) of the ranged parts in
+            which files larger than chunk_size are downloaded.
+        manifest_path: Local path in which the object index
+            of each subject is stored for reuse
+            (see hcprep.download.load_subject_manifest).
+        use_object_store: Bool indicating whether files are
+            stored once in a content-addressed object store
+            (in output_path/.objects/) and linked to their
+            BIDS paths.
+        storage: Storage backend (hcprep.download.S3Storage or
+            hcprep.download.LocalStorage) from which the data
+            is retrieved. If None, the HCP AWS S3 bucket is used.
+        n_part_workers: Maximum number of concurrently
+            transferred parts of each file.
+
+    Returns:
+        Dict summarizing the transfers, with the number of
+        files ("n_files"), transferred bytes ("n_bytes"),
+        the elapsed time in seconds ("seconds") and the
+        aggregate throughput in bytes per second ("throughput").
+    """
+    storage = _get_storage(ACCESS_KEY, SECRET_KEY, storage,
+                           max_pool_connections=n_workers*n_part_workers)
+
+    # collect files of all jobs; runs of the same
+    # subject and task share the anatomical scan
+    files = {}
+    for subject, task, run in jobs:
+        _make_subject_dirs(subject, output_path)
+        for bucket_id, output_file in _return_subject_run_files(
+                subject, task, run, output_path):
+            files[output_file] = (subject, bucket_id)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # one listing per subject provides size and ETag of all its files
+        subjects = list({subject: None for subject, _ in files.values()})
+        manifests = dict(zip(subjects, executor.map(
+            lambda subject: load_subject_manifest(storage, subject, manifest_path),
+            subjects)))
+
+        def _download(output_file):
+            subject, bucket_id = files[output_file]
+            return _fetch(storage, bucket_id, output_file,
+                          output_path, use_object_store,
+                          stat=manifests[subject].get(bucket_id),
+                          chunk_size=chunk_size, n_part_workers=n_part_workers)
+
+        n_bytes = sum(executor.map(_download, list(files)))
+    elapsed = time.time() - start
+
+    # create EV summaries
+    for subject, task, run in jobs:
+        _create_EV_summary(subject, task, run, output_path)
+
+    throughput = n_bytes / elapsed if elapsed > 0 else 0.
+    print('downloaded {} files ({}) in {:.1f}s: {}/s'.format(
+        len(files), _format_bytes(n_bytes), elapsed, _format_bytes(throughput)))
+    return dict(n_files=len(files),
+                n_bytes=n_bytes,
+                seconds=elapsed,
+                throughput=throughput)
+
+
+def _fetch(storage, bucket_id, output_file, output_path,
+           use_object_store, stat=None, chunk_size=8*1024*1024, n_part_workers=1):
+    if use_object_store:
+        return _fetch_file_to_store(storage, bucket_id, output_file,
+                                    output_path+'.objects/', stat=stat,
+                                    chunk_size=chunk_size,
+                                    n_part_workers=n_part_workers)
+    # concurrent jobs may share output files (eg., the anatomical scan)
+    with _path_lock(output_file):
+        return storage.fetch(bucket_id, output_file,
+                             stat=stat, chunk_size=chunk_size,
+                             n_part_workers=n_part_workers)
+
+
+def _create_EV_summary(subject, task, run, output_path):
     output_file = paths.path_bids_EV(subject, task, run, output_path)
     if not os.path.isfile(output_file):
         print('creating EV summary: {}'.format(output_file))
-        EV_summary = summarize_subject_EVs(task, subject, [run], path_func)
+        EV_summary = summarize_subject_EVs(
+            task, subject, [run], output_path+'sub-{}/func/'.format(subject))
         EV_summary.to_csv(output_file, index=False)
         print('done.')
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+import os
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from ._utils import _fetch_file, _link_file, _is_verified, _write_verified
+
+
+class S3Storage:
+    """Storage backend for the HCP AWS S3 bucket.
+
+    All operations share one pooled boto3 client, which
+    is safe to use from multiple threads.
+
+    Args:
+        ACCESS_KEY, SECRET_KEY: access and secret
+            keys necessary to access HCP AWS S3 storage.
+        bucket_name: Name of the S3 bucket.
+        max_pool_connections: Maximum number of connections
+            that are kept open to S3.
+        bucket: Boto3 bucket (eg., created with
+            hcprep.download.connect_to_hcp_bucket). If given,
+            its client is used instead of creating a new one.
+    """
+
+    def __init__(self, ACCESS_KEY=None, SECRET_KEY=None,
+                 bucket_name='hcp-openaccess', max_pool_connections=10,
+                 bucket=None):
+        if bucket is None:
+            session = boto3.session.Session(profile_name='hcp',
+                                            aws_access_key_id=ACCESS_KEY,
+                                            aws_secret_access_key=SECRET_KEY,
+                                            region_name='us-east-1')
+            s3 = session.resource('s3', config=Config(
+                max_pool_connections=max_pool_connections))
+            bucket = s3.Bucket(bucket_name)
+        self.bucket = bucket
+        self.bucket_name = bucket.name
+        self.client = bucket.meta.client
+
+    def list(self, prefix):
+        """Return a dict mapping the keys of all objects
+        below prefix to a tuple of their size and ETag."""
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for o in page.get('Contents', []):
+                objects[o['Key']] = (o['Size'], o['ETag'].strip('"'))
+        return objects
+
+    def list_dirs(self, prefix):
+        """Iterate over the names of all directories
+        (ie., common prefixes) directly below prefix."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                yield common_prefix['Prefix'][len(prefix):].strip('/')
+
+    def exists(self, key):
+        """Return a bool indicating whether key exists."""
+        return self.stat(key) is not None
+
+    def stat(self, key):
+        """Return a tuple of the size and ETag of key,
+        or None if key does not exist."""
+        try:
+            head = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise
+        return (head['ContentLength'], head['ETag'].strip('"'))
+
+    def fetch(self, key, output_file, stat=None, chunk_size=8*1024*1024,
+              n_part_workers=1):
+        """Download key to output_file; resumable, atomic
+        and verified against the size and ETag of key.
+        Objects larger than chunk_size are downloaded in
+        ranged parts of chunk_size bytes, n_part_workers
+        at a time.
+
+        Returns:
+            Number of transferred bytes.
+        """
+        return _fetch_file(self.client, self.bucket_name, key, output_file,
+                           stat=stat, chunk_size=chunk_size,
+                           n_part_workers=n_part_workers)
+
+
+class LocalStorage:
+    """Storage backend for a local mirror of the HCP
+    AWS S3 bucket (eg., on a cluster filesystem).
+
+    The mirror must have the same directory layout
+    as the bucket (eg., root/HCP/100307/MNINonLinear/...).
+    Files are fetched as hardlinks (or copies, if
+    hardlinks are not possible).
+
+    Args:
+        root: Path to the root directory of the mirror.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def list(self, prefix):
+        """Return a dict mapping the keys of all files
+        below prefix to a tuple of their size and identity."""
+        objects = {}
+        head, _ = prefix.rsplit('/', 1) if '/' in prefix else ('', prefix)
+        for dirpath, _, filenames in os.walk(self._path(head)):
+            dirkey = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            for filename in filenames:
+                key = filename if dirkey == '.' else dirkey+'/'+filename
+                if key.startswith(prefix):
+                    objects[key] = self._stat(os.path.join(dirpath, filename))
+        return objects
+
+    def list_dirs(self, prefix):
+        """Iterate over the names of all directories
+        directly below prefix."""
+        path = self._path(prefix)
+        if not os.path.isdir(path):
+            return
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_dir():
+                yield entry.name
+
+    def exists(self, key):
+        """Return a bool indicating whether key exists."""
+        return os.path.isfile(self._path(key))
+
+    def stat(self, key):
+        """Return a tuple of the size and identity of key,
+        or None if key does not exist."""
+        if not self.exists(key):
+            return None
+        return self._stat(self._path(key))
+
+    def _stat(self, filename):
+        # the file identity takes the role of the S3 ETag
+        stat = os.stat(filename)
+        return (stat.st_size, '{}-{}'.format(stat.st_dev, stat.st_ino))
+
+    def fetch(self, key, output_file, stat=None, chunk_size=8*1024*1024,
+              n_part_workers=1):
+        """Hardlink (or copy) key to output_file
+        (chunk_size and n_part_workers are ignored).
+
+        The identity of the source of a copy is recorded in a
+        sidecar, so that the copy is not repeated as long as
+        neither the source nor the copy change.
+
+        Returns:
+            Number of copied bytes.
+        """
+        source_file = self._path(key)
+        if os.path.isfile(output_file) and os.path.samefile(source_file, output_file):
+            return 0
+        source = os.stat(source_file)
+        source_id = '{}-{}-{}'.format(source.st_dev, source.st_ino, source.st_mtime_ns)
+        if _is_verified(output_file, source.st_size, source_id):
+            return 0
+        _link_file(source_file, output_file)
+        if os.path.samefile(source_file, output_file):
+            return 0
+        _write_verified(output_file, source.st_size, source_id, 'copy')
+        return os.path.getsize(output_file)
@@ -1,6 +1,8 @@
 #!/usr/bin/python
-from .paths import make_sure_path_exists, path_bids_EV, path_bids_func_mni, path_bids_anat_mni, path_bids_func_mask_mni
+from .paths import make_sure_path_exists, path_bids_EV, path_bids_func_mni, path_bids_anat_mni, path_bids_func_mask_mni, path_bids_func_meta
+from .layout import BIDSLayout
 
 __all__ = ['make_sure_path_exists', 'path_bids_EV',
            'path_bids_func_mni', 'path_bids_anat_mni',
-           'path_bids_func_mask_mni']
+           'path_bids_func_mask_mni', 'path_bids_func_meta',
+           'BIDSLayout']
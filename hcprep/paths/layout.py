@@ -0,0 +1,183 @@
+#!/usr/bin/python
+import os
+import json
+import tempfile
+
+
+_EXTENSIONS = ['.nii.gz', '.nii', '.tfrecords', '.txt', '.csv', '.json', '.npy']
+
+
+def _parse_filename(filename):
+    """Parse the BIDS entities of a filename, eg.:
+    sub-1_task-WM_run-LR_EV-0bk_body.txt ->
+    {'sub': '1', 'task': 'WM', 'run': 'LR',
+     'EV': '0bk_body', 'extension': '.txt'}
+    """
+    entities = {}
+    name = filename
+    for extension in _EXTENSIONS:
+        if name.endswith(extension):
+            entities['extension'] = extension
+            name = name[:-len(extension)]
+            break
+    # EV names can contain underscores
+    if '_EV-' in name:
+        name, entities['EV'] = name.split('_EV-', 1)
+    parts = name.split('_')
+    for part in parts:
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[key] = value
+        else:
+            entities['suffix'] = part
+    return entities
+
+
+class BIDSLayout:
+    """Index of the files in a local BIDS directory,
+    as written by hcprep.download.
+
+    The directory tree is walked once and the BIDS entities
+    (sub, task, run, space, desc, EV, suffix and extension)
+    of each file are parsed. The index is stored in the
+    BIDS directory and, when loaded again, only directories
+    whose modification time changed are scanned again.
+    Existence and enumeration queries are then answered
+    from the index without any further directory scans;
+    queries for a subject only consider its own files.
+
+    Args:
+        path: Path to local BIDS directory.
+        index_file: File in which the index is stored.
+            Defaults to path/.hcprep_layout.json.
+    """
+
+    def __init__(self, path, index_file=None):
+        self.path = path
+        if index_file is None:
+            index_file = os.path.join(path, '.hcprep_layout.json')
+        self.index_file = index_file
+        self._dirs = {}
+        self._files = {}
+        self._by_subject = None
+        if os.path.isfile(index_file):
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            self._dirs = index['dirs']
+            self._files = {d: {filename: _parse_filename(filename)
+                               for filename in filenames}
+                           for d, filenames in index['files'].items()}
+        self.update()
+
+    def update(self):
+        """Rescan all directories that changed since
+        the last scan and store the index."""
+        changed = False
+        pending = ['']
+        seen = set()
+        while pending:
+            d = pending.pop()
+            seen.add(d)
+            full_path = os.path.join(self.path, d)
+            try:
+                mtime_ns = os.stat(full_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._dirs.get(d, {}).get('mtime_ns') != mtime_ns:
+                self._scan(d, mtime_ns)
+                changed = True
+            pending.extend(self._dirs[d]['dirs'])
+        for d in list(self._dirs):
+            if d not in seen:
+                del self._dirs[d]
+                self._files.pop(d, None)
+                changed = True
+        if changed:
+            self._by_subject = None
+        if changed and os.path.isdir(os.path.dirname(os.path.abspath(self.index_file))):
+            self.save()
+
+    def _scan(self, d, mtime_ns):
+        subdirs = []
+        files = {}
+        with os.scandir(os.path.join(self.path, d)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    # only descend into subject and datatype directories
+                    if (d == '' and entry.name.startswith('sub-')) or \
+                            (d != '' and entry.name in ['anat', 'func']):
+                        subdirs.append(os.path.join(d, entry.name))
+                elif entry.is_file():
+                    files[entry.name] = _parse_filename(entry.name)
+        self._dirs[d] = {'mtime_ns': mtime_ns, 'dirs': sorted(subdirs)}
+        self._files[d] = files
+
+    def _subject_files(self):
+        """Return a dict mapping each subject to a dict mapping
+        the (task, run) of its files to lists of their
+        (directory, filename, entities)."""
+        if self._by_subject is None:
+            self._by_subject = {}
+            for d, files in self._files.items():
+                for filename, file_entities in files.items():
+                    self._by_subject.setdefault(file_entities.get('sub'), {}).setdefault(
+                        (file_entities.get('task'), file_entities.get('run')), []).append(
+                            (d, filename, file_entities))
+        return self._by_subject
+
+    def save(self):
+        """Store the index."""
+        index = {'dirs': self._dirs,
+                 'files': {d: sorted(files) for d, files in self._files.items()}}
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.index_file)),
+            prefix='.tmp_', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def exists(self, filename):
+        """Return a bool indicating whether a file (eg., as
+        returned by hcprep.paths.path_bids_func_mni) exists."""
+        d, name = os.path.split(os.path.relpath(filename, self.path))
+        return name in self._files.get(d, {})
+
+    def get(self, datatype=None, **entities):
+        """Return the paths of all files that match
+        the given entities, eg.:
+        layout.get(sub=100307, task='WM', EV='summary')
+
+        Args:
+            datatype: "anat" or "func" (None for both)
+            **entities: BIDS entities (sub, task, run, space,
+                desc, EV, suffix, extension) of the files.
+
+        Returns:
+            Sorted list of file paths.
+        """
+        entities = {key: str(value) for key, value in entities.items()}
+        if 'sub' in entities:
+            by_run = self._subject_files().get(entities['sub'], {})
+            if 'task' in entities and 'run' in entities:
+                candidates = by_run.get((entities['task'], entities['run']), [])
+            else:
+                candidates = [c for files in by_run.values() for c in files]
+        else:
+            candidates = [(d, filename, file_entities)
+                          for d, files in self._files.items()
+                          for filename, file_entities in files.items()]
+        matches = []
+        for d, filename, file_entities in candidates:
+            if datatype is not None and os.path.basename(d) != datatype:
+                continue
+            if all(file_entities.get(key) == value
+                   for key, value in entities.items()):
+                matches.append(os.path.join(self.path, d, filename))
+        return sorted(matches)
+
+    def get_subjects(self):
+        """Return the sorted IDs of all subjects."""
+        subjects = [d.split('sub-', 1)[1] for d in self._dirs.get('', {}).get('dirs', [])]
+        return sorted(int(s) if s.isdigit() else s for s in subjects)
@@ -63,3 +63,17 @@ def path_bids_func_mask_mni(subject, task, run, path):
     """
     return path+'sub-{}/func/sub-{}_task-{}_run-{}_space-MNI152NLin6Asym_desc-prepoc_brainmask.nii.gz'.format(
         subject, subject, task, run)
+
+
+def path_bids_func_meta(subject, path):
+    """Return the path to the local sidecar file that
+    caches the NIfTI header information (eg., shapes,
+    affines and repetition times) of all task-fMRI data
+    of a subject.
+
+    Args:
+        subject: Integer ID of HCP subject
+        path: Path to local BIDS directory.
+    """
+    return path+'sub-{}/func/sub-{}_desc-header_meta.json'.format(
+        subject, subject)
@@ -0,0 +1,4 @@
+#!/usr/bin/python
+from .pipeline import run_pipeline
+
+__all__ = ['run_pipeline']
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import paths
+from ..info import basics
+from ..download import S3Storage, download_subject_data
+from ..download._utils import _return_subject_run_files, _path_transfer_state
+from ..data import load_subject_data
+from ..preprocess import preprocess_subject_data
+from ..convert import write_to_tfr, TFRecordFileWriter
+
+
+def run_pipeline(ACCESS_KEY, SECRET_KEY, jobs, path, tfr_path,
+                 high_pass=1./128., smoothing_fwhm=3,
+                 n_download_workers=4, n_preprocess_workers=1,
+                 queue_size=2, delete_raw=False, storage=None,
+                 hcp_info=None, metadata=None, verbose=False):
+    """Download, preprocess and convert the task-fMRI data of
+    many HCP subject runs in one overlapped pipeline.
+
+    Each (subject, task, run) job is passed through bounded
+    queues from hcprep.download.download_subject_data to
+    hcprep.data.load_subject_data and
+    hcprep.preprocess.preprocess_subject_data, and finally
+    to hcprep.convert.write_to_tfr, as soon as its data is
+    available. Network transfers, cleaning and writing thereby
+    overlap, while the bounded queues limit the number of
+    runs that are kept on disk and in memory at any time.
+    The HCP subject ID (eg., 100307) is stored as the
+    subject_id of each volume.
+
+    Args:
+        ACCESS_KEY, SECRET_KEY: access and secret
+            keys necessary to access HCP AWS S3 storage.
+        jobs: A sequence of (subject, task, run) tuples.
+        path: Local path to which the BIDS data is written.
+        tfr_path: Local path to which the TFRecord files
+            are written (one file per job).
+        high_pass: High frequency cutoff in Hertz.
+        smoothing_fwhm: Smoothing strength, as a Full-Width
+            at Half Maximum, in millimeters.
+        n_download_workers: Number of concurrently downloaded jobs.
+        n_preprocess_workers: Number of concurrently preprocessed jobs.
+        queue_size: Maximum number of jobs waiting between
+            two stages of the pipeline.
+        delete_raw: Bool indicating whether the raw files of a
+            job (task-fMRI data, brainmask and EV files) are
+            deleted once it is converted. If True, downloads are
+            not linked into an object store, so that deleting them
+            frees their disk space, and the anatomical scans
+            (which are not needed for the conversion) are not
+            downloaded.
+        storage: Storage backend (hcprep.download.S3Storage or
+            hcprep.download.LocalStorage) from which the data
+            is retrieved. If None, the HCP AWS S3 bucket is used.
+        hcp_info: Instance of hcprep.info.basics. If None,
+            it is created.
+        metadata: Dataset metadata, as created with
+            hcprep.convert.make_tfr_metadata, defining which
+            voxels are stored for each volume (see
+            hcprep.convert.write_to_tfr). If None, the full
+            grid is stored.
+        verbose: Bool indicating whether each converted
+            job is printed.
+
+    Returns:
+        Dict with the sequence of converted jobs ("converted")
+            and a sequence of (job, exception) tuples
+            for all jobs that failed ("failed").
+
+    Raises:
+        The first exception that stopped a stage of the pipeline
+            (as opposed to the failure of a single job).
+    """
+    if hcp_info is None:
+        hcp_info = basics()
+    if storage is None:
+        storage = S3Storage(ACCESS_KEY, SECRET_KEY,
+                            max_pool_connections=n_download_workers)
+    paths.make_sure_path_exists(path)
+    paths.make_sure_path_exists(tfr_path)
+
+    downloaded = queue.Queue(maxsize=queue_size)
+    cleaned = queue.Queue(maxsize=queue_size)
+    converted = []
+    failed = []
+    errors = []
+
+    def _download_stage():
+        try:
+            with ThreadPoolExecutor(max_workers=n_download_workers) as executor:
+                pending = deque()
+                for job in list(jobs) + [None]:
+                    if job is not None:
+                        pending.append((job, executor.submit(
+                            download_subject_data, ACCESS_KEY, SECRET_KEY,
+                            *job, path, use_object_store=not delete_raw,
+                            storage=storage, include_anat=not delete_raw)))
+                    # hand over finished downloads in job order, while
+                    # keeping at most n_download_workers in flight
+                    while pending and (job is None or
+                                       len(pending) >= n_download_workers or
+                                       pending[0][1].done()):
+                        done_job, future = pending.popleft()
+                        try:
+                            future.result()
+                        except Exception as e:
+                            failed.append((done_job, e))
+                            continue
+                        downloaded.put(done_job)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            # always release the preprocessing stages
+            for _ in range(n_preprocess_workers):
+                downloaded.put(None)
+
+    def _preprocess_stage():
+        done = False
+        try:
+            while True:
+                job = downloaded.get()
+                if job is None:
+                    done = True
+                    break
+                subject, task, run = job
+                try:
+                    subject_data = load_subject_data(
+                        task, subject, [run], path, hcp_info.t_r)
+                    volumes, mask, volume_labels = preprocess_subject_data(
+                        subject_data, [run], high_pass=high_pass,
+                        smoothing_fwhm=smoothing_fwhm, return_masked=True)
+                except Exception as e:
+                    failed.append((job, e))
+                    continue
+                cleaned.put((job, volumes, mask, volume_labels))
+        except BaseException as e:
+            errors.append(e)
+            # keep draining, so that the download stage is not blocked
+            while not done:
+                done = downloaded.get() is None
+        finally:
+            # always release the conversion stage
+            cleaned.put(None)
+
+    def _convert_stage():
+        n_done = 0
+        try:
+            while n_done < n_preprocess_workers:
+                item = cleaned.get()
+                if item is None:
+                    n_done += 1
+                    continue
+                job, volumes, mask, volume_labels = item
+                subject, task, run = job
+                tfr_file = tfr_path+'task-{}_subject-{}_run-{}.tfrecords'.format(
+                    task, subject, run)
+                try:
+                    tfr_writer = TFRecordFileWriter(
+                        tfr_file,
+                        compression=metadata.get('compression') if metadata is not None else None)
+                    try:
+                        write_to_tfr([tfr_writer],
+                                     volumes,
+                                     volume_labels,
+                                     int(subject),
+                                     hcp_info.tasks.index(task),
+                                     hcp_info.runs.index(run),
+                                     hcp_info.n_classes_per_task,
+                                     randomize_volumes=True,
+                                     mask=mask,
+                                     metadata=metadata)
+                    finally:
+                        tfr_writer.close()
+                except Exception as e:
+                    # do not leave a truncated file behind
+                    if os.path.isfile(tfr_file):
+                        os.remove(tfr_file)
+                    failed.append((job, e))
+                    continue
+                if delete_raw:
+                    _delete_raw_data(subject, task, run, path)
+                converted.append(job)
+                if verbose:
+                    print('converted: task-{} subject-{} run-{}'.format(task, subject, run))
+        except BaseException as e:
+            errors.append(e)
+            # keep draining, so that the preprocessing stages are not blocked
+            while n_done < n_preprocess_workers:
+                if cleaned.get() is None:
+                    n_done += 1
+
+    stages = ([threading.Thread(target=_download_stage)] +
+              [threading.Thread(target=_preprocess_stage)
+               for _ in range(n_preprocess_workers)] +
+              [threading.Thread(target=_convert_stage)])
+    [stage.start() for stage in stages]
+    [stage.join() for stage in stages]
+    if errors:
+        raise errors[0]
+
+    for job, e in failed:
+        print('failed: task-{} subject-{} run-{} ({})'.format(
+            job[1], job[0], job[2], e))
+    return dict(converted=converted, failed=failed)
+
+
+def _delete_raw_data(subject, task, run, path):
+    """Delete the downloaded files of a job (along with
+    their verification sidecars) and its EV summary."""
+    raw_files = [paths.path_bids_EV(subject, task, run, path)]
+    for _, output_file in _return_subject_run_files(
+            subject, task, run, path, include_anat=False):
+        raw_files += [output_file,
+                      _path_transfer_state(output_file, '.verified.json')]
+    for raw_file in raw_files:
+        if os.path.isfile(raw_file):
+            os.remove(raw_file)
@@ -1,4 +1,6 @@
 #!/usr/bin/python
-from .preprocess import preprocess_subject_data
+from .preprocess import preprocess_subject_data, preprocess_subjects_data
+from .cache import PreprocessCache
 
-__all__ = ['preprocess_subject_data']
+__all__ = ['preprocess_subject_data', 'preprocess_subjects_data',
+           'PreprocessCache']
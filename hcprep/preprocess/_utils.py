@@ -0,0 +1,183 @@
+#!/usr/bin/python
+import os
+import tempfile
+from functools import lru_cache
+import numpy as np
+import nibabel as nb
+from nilearn.signal import clean
+from nilearn.image import smooth_img
+
+
+def _open_temp_memmap(shape, dtype, tmp_path=None):
+    """Return a new .npy memmap in tmp_path,
+    whose file is removed once it is closed."""
+    fd, tmp_file = tempfile.mkstemp(dir=tmp_path, prefix='.tmp_', suffix='.npy')
+    os.close(fd)
+    try:
+        array = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=shape)
+    finally:
+        # the mapping stays valid after the file is unlinked
+        os.remove(tmp_file)
+    return array
+
+
+def _standardize(signals, block_size=4096):
+    """Standardize the columns of signals in place to
+    zero mean and unit variance, as nilearn.signal.clean
+    does with standardize=True ("zscore_sample").
+
+    The statistics are accumulated in float64, one block
+    of block_size columns at a time, so that signals can
+    be kept in a lower working precision."""
+    n_volumes = signals.shape[0]
+    if n_volumes == 1:
+        return signals
+    for start in range(0, signals.shape[1], block_size):
+        block = signals[:, start:start+block_size].astype(np.float64)
+        block -= block.mean(axis=0)
+        std = np.sqrt(np.einsum('ij,ij->j', block, block) / (n_volumes - 1))
+        # avoid numerical problems
+        std[std < np.finfo(np.float64).eps] = 1.
+        block /= std
+        signals[:, start:start+block_size] = block
+    return signals
+
+
+@lru_cache(maxsize=1)
+def _no_standardize():
+    """Return the value of standardize that disables
+    standardization in nilearn.signal.clean: None where
+    it is accepted (and boolean values are deprecated),
+    False for older versions of nilearn."""
+    try:
+        clean(np.zeros((3, 1)), detrend=False, standardize=None,
+              ensure_finite=False)
+    except (TypeError, ValueError):
+        return False
+    return None
+
+
+@lru_cache(maxsize=16)
+def _cleaning_operator(n_volumes, t_r=0.72, high_pass=1./128., detrend=True):
+    """Return the (n_volumes x n_volumes) matrix of the linear
+    part of nilearn.signal.clean (detrending and filtering).
+
+    Both steps are linear in the signal, so that cleaning
+    the identity matrix yields the operator, which is
+    shared by all runs with the same number of volumes."""
+    operator = clean(np.eye(n_volumes),
+                     detrend=detrend,
+                     standardize=_no_standardize(),
+                     high_pass=high_pass,
+                     t_r=t_r,
+                     ensure_finite=False)
+    operator.setflags(write=False)
+    return operator
+
+
+def _clean_signals(signals, high_pass=1./128., t_r=0.72, detrend=True, standardize=True,
+                   dtype=np.float32):
+    """Clean a (volumes x voxels) matrix with
+    nilearn.signal.clean in the working precision dtype."""
+    signals = clean(np.asarray(signals, dtype=dtype),
+                    detrend=detrend,
+                    standardize=_no_standardize(),
+                    high_pass=high_pass,
+                    t_r=t_r,
+                    ensure_finite=True)
+    signals = np.asarray(signals, dtype=dtype)
+    if standardize:
+        signals = _standardize(signals)
+    return signals
+
+
+def _clean_masked_funcs_batched(masked_funcs, high_pass=1./128., t_r=0.72,
+                                detrend=True, standardize=True, dtype=np.float32):
+    """Clean many (volumes x voxels) matrices as
+    nilearn.signal.clean would, applying the shared
+    cleaning operator of all matrices with the same
+    number of volumes in one matrix multiplication.
+
+    Returns:
+        List of cleaned matrices, in the order of masked_funcs.
+    """
+    cleaned_funcs = [None] * len(masked_funcs)
+    groups = {}
+    for i, masked_func in enumerate(masked_funcs):
+        groups.setdefault(masked_func.shape[0], []).append(i)
+    for n_volumes, idx in groups.items():
+        signals = np.concatenate([np.asarray(masked_funcs[i], dtype=dtype) for i in idx], axis=1)
+        # as ensure_finite in nilearn.signal.clean
+        signals[~np.isfinite(signals)] = 0
+        if detrend or high_pass is not None:
+            operator = _cleaning_operator(n_volumes, t_r=t_r, high_pass=high_pass,
+                                          detrend=detrend)
+            signals = operator.astype(dtype) @ signals
+        if standardize:
+            signals = _standardize(signals)
+        start = 0
+        for i in idx:
+            stop = start + masked_funcs[i].shape[1]
+            cleaned_funcs[i] = signals[:, start:stop]
+            start = stop
+    return cleaned_funcs
+
+
+def _mask_volumes(func_file, mask, smoothing_fwhm=3, tmp_path=None, dtype=np.float32):
+    """Smooth and mask the volumes of a run one at a time
+    and return a (volumes x voxels) memmap of the result."""
+    func = nb.load(func_file, keep_file_open=True)
+    mask_data = np.asarray(mask.dataobj).astype(bool)
+    if not np.allclose(mask.affine, func.affine):
+        raise ValueError('Mask affine:\n{}\n is different from img affine:\n{}'.format(
+            mask.affine, func.affine))
+    if mask_data.shape != func.shape[:3]:
+        raise ValueError('Mask shape: {}\n is different from img shape: {}'.format(
+            mask_data.shape, func.shape[:3]))
+    n_volumes = func.shape[3]
+    masked_func = _open_temp_memmap((n_volumes, int(mask_data.sum())), dtype, tmp_path)
+    for t in range(n_volumes):
+        volume = np.asarray(func.dataobj[..., t], dtype=dtype)
+        # as nilearn.masking.apply_mask, with ensure_finite=True
+        volume = smooth_img(nb.Nifti1Image(volume, func.affine), smoothing_fwhm)
+        masked_func[t] = np.asarray(volume.dataobj)[mask_data]
+    func.uncache()
+    return masked_func
+
+
+def _clean_masked_func_chunked(func_file, mask, smoothing_fwhm=3, high_pass=1./128., t_r=0.72,
+                               detrend=True, standardize=True, chunk_size=10000,
+                               tmp_path=None, batched=False, dtype=np.float32):
+    """Clean a run out-of-core, in chunks of chunk_size voxels.
+
+    The run is first smoothed, masked and written to a
+    memmap, one volume at a time. The voxel time series
+    are then cleaned in column chunks (detrending, filtering
+    and standardization act on each voxel independently)
+    into a pre-allocated memmap, which is returned. Peak
+    memory thereby scales with chunk_size instead of
+    with the size of the run. If batched, each chunk is
+    cleaned with the shared cleaning operator."""
+    masked_func = _mask_volumes(func_file, mask, smoothing_fwhm=smoothing_fwhm,
+                                tmp_path=tmp_path, dtype=dtype)
+    n_volumes, n_voxels = masked_func.shape
+    cleaned_func = _open_temp_memmap((n_volumes, n_voxels), dtype, tmp_path)
+    for start in range(0, n_voxels, chunk_size):
+        chunk = np.array(masked_func[:, start:start+chunk_size])
+        if batched:
+            chunk = _clean_masked_funcs_batched([chunk],
+                                                high_pass=high_pass,
+                                                t_r=t_r,
+                                                detrend=detrend,
+                                                standardize=standardize,
+                                                dtype=dtype)[0]
+        else:
+            chunk = _clean_signals(chunk,
+                                   high_pass=high_pass,
+                                   t_r=t_r,
+                                   detrend=detrend,
+                                   standardize=standardize,
+                                   dtype=dtype)
+        cleaned_func[:, start:start+chunk_size] = chunk
+    del masked_func
+    return cleaned_func
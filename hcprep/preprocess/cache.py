@@ -0,0 +1,156 @@
+#!/usr/bin/python
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+from .. import paths
+
+
+class PreprocessCache:
+    """On-disk cache of cleaned task-fMRI runs.
+
+    Each cleaned run is stored as a (volumes x voxels) .npy
+    matrix of its in-mask voxels. Entries are keyed by the
+    fingerprint (path, size and modification time) of the
+    input NIfTI file, the brain mask and all cleaning
+    parameters (smoothing_fwhm, high_pass, t_r, detrend,
+    standardize, dtype, the cleaning method and the hcprep
+    version), so that only
+    runs whose inputs or parameters changed are cleaned
+    again. Cached runs are memory-mapped when read.
+
+    If the cache grows beyond max_bytes, the least
+    recently used entries are removed.
+
+    Args:
+        cache_path: Path to the cache directory.
+        max_bytes: Maximum size (in bytes) of the cache.
+            If None, the size is not limited.
+    """
+
+    def __init__(self, cache_path, max_bytes=None):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        paths.make_sure_path_exists(cache_path)
+
+    def key(self, func_file, mask, smoothing_fwhm=3, high_pass=1./128., t_r=0.72,
+            detrend=True, standardize=True, dtype=np.float32, batched=False,
+            chunked=False):
+        """Return the cache key of a cleaned run.
+
+        Args:
+            func_file: Path to the NIfTI file of the run.
+            mask: Nifti1Image of the brain mask.
+            smoothing_fwhm, high_pass, t_r, detrend, standardize, dtype:
+                Cleaning parameters
+                (see hcprep.preprocess.preprocess_subject_data).
+            batched, chunked: Bools indicating whether the run is
+                cleaned with the shared cleaning operator (batched)
+                and out-of-core (chunked), as the results of these
+                methods may differ slightly.
+
+        Returns:
+            Hex digest string.
+        """
+        from .. import __version__
+        stat = os.stat(func_file)
+        mask_hash = hashlib.sha1()
+        mask_hash.update(np.ascontiguousarray(
+            np.asarray(mask.dataobj) != 0).tobytes())
+        mask_hash.update(np.asarray(mask.affine, dtype=np.float64).tobytes())
+        if smoothing_fwhm is not None:
+            smoothing_fwhm = np.ravel(smoothing_fwhm).tolist()
+        params = dict(func_file=os.path.abspath(func_file),
+                      size=stat.st_size,
+                      mtime_ns=stat.st_mtime_ns,
+                      mask=mask_hash.hexdigest(),
+                      smoothing_fwhm=smoothing_fwhm,
+                      high_pass=high_pass,
+                      t_r=t_r,
+                      detrend=detrend,
+                      standardize=standardize,
+                      dtype=np.dtype(dtype).name,
+                      batched=bool(batched),
+                      chunked=bool(chunked),
+                      version=__version__)
+        return hashlib.sha1(json.dumps(
+            params, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_path, key+'.npy')
+
+    def get(self, key):
+        """Return the memory-mapped cleaned run of key,
+        or None if key is not cached."""
+        cache_file = self._path(key)
+        try:
+            masked_func = np.load(cache_file, mmap_mode='r')
+            # mark entry as recently used
+            os.utime(cache_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return masked_func
+
+    def put(self, key, masked_func):
+        """Store a cleaned (volumes x voxels) run under key
+        and evict entries if the cache is too large."""
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_path,
+                                        prefix='.tmp_', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, masked_func)
+        os.replace(tmp_file, self._path(key))
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=key)
+
+    def entries(self):
+        """Return a list of (key, size, last use) tuples
+        of all cached runs, from least to most recently used."""
+        entries = []
+        with os.scandir(self.cache_path) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.name.endswith('.npy'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name[:-len('.npy')],
+                                stat.st_size, stat.st_mtime_ns))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self):
+        """Return the total size (in bytes) of the cache."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes, keep=None):
+        """Remove the least recently used entries until
+        the cache is at most max_bytes large.
+
+        Args:
+            max_bytes: Maximum size (in bytes) of the cache.
+            keep: Key that is not removed.
+
+        Returns:
+            Number of removed entries.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        n_removed = 0
+        for key, size, _ in entries:
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_removed += 1
+        return n_removed
+
+    def clear(self):
+        """Remove all entries."""
+        return self.evict(0)
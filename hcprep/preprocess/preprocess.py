@@ -1,28 +1,72 @@
 #!/usr/bin/python
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
-from nilearn.masking import apply_mask, unmask
-from nilearn.signal import clean
+from nilearn.masking import apply_mask, unmask, intersect_masks
 from nilearn.image import load_img, index_img, concat_imgs
 
-from ..data._utils import _load_subject_data
+from ._utils import _clean_signals, _clean_masked_func_chunked, _clean_masked_funcs_batched
+from ..data._utils import _load_subject_data, _load_nifti_headers
+from .. import paths
 
 
-def _clean_func(func, mask, smoothing_fwhm=3, high_pass=1./128., t_r=0.72):
+def _clean_masked_func(func, mask, smoothing_fwhm=3, high_pass=1./128., t_r=0.72,
+                       detrend=True, standardize=True, dtype=np.float32):
     masked_func = apply_mask(func,
                              mask,
+                             dtype=dtype,
                              smoothing_fwhm=smoothing_fwhm,
                              ensure_finite=True)
-    masked_func = clean(masked_func,
-                        detrend=True,
-                        standardize=True,
-                        high_pass=high_pass,
-                        t_r=t_r,
-                        ensure_finite=True)
-    unmasked_func = unmask(masked_func, mask)
-    return unmasked_func
+    masked_func = _clean_signals(masked_func,
+                                 detrend=detrend,
+                                 standardize=standardize,
+                                 high_pass=high_pass,
+                                 t_r=t_r,
+                                 dtype=dtype)
+    return masked_func
 
 
-def preprocess_subject_data(subject_data, runs, high_pass=None, smoothing_fwhm=None):
+def _clean_runs(func_files, masks, smoothing_fwhm=3, high_pass=1./128., t_r=0.72, cache=None,
+                chunk_size=None, batched=False, dtype=np.float32, tmp_path=None):
+    """Return the cleaned (volumes x voxels) matrices of a set
+    of runs, served from (and added to) cache, if given."""
+    masked_funcs = [None] * len(func_files)
+    keys = [None] * len(func_files)
+    if cache is not None:
+        for i, (func_file, mask) in enumerate(zip(func_files, masks)):
+            keys[i] = cache.key(func_file, mask, smoothing_fwhm=smoothing_fwhm,
+                                high_pass=high_pass, t_r=t_r, dtype=dtype,
+                                batched=batched, chunked=chunk_size is not None)
+            masked_funcs[i] = cache.get(keys[i])
+    missing = [i for i, masked_func in enumerate(masked_funcs) if masked_func is None]
+    if chunk_size is not None:
+        for i in missing:
+            masked_funcs[i] = _clean_masked_func_chunked(
+                func_files[i], masks[i], smoothing_fwhm=smoothing_fwhm,
+                high_pass=high_pass, t_r=t_r, chunk_size=chunk_size,
+                tmp_path=tmp_path, batched=batched, dtype=dtype)
+    elif batched:
+        cleaned_funcs = _clean_masked_funcs_batched(
+            [apply_mask(load_img(func_files[i]), masks[i], dtype=dtype,
+                        smoothing_fwhm=smoothing_fwhm, ensure_finite=True)
+             for i in missing],
+            high_pass=high_pass, t_r=t_r, dtype=dtype)
+        for i, cleaned_func in zip(missing, cleaned_funcs):
+            masked_funcs[i] = cleaned_func
+    else:
+        for i in missing:
+            masked_funcs[i] = _clean_masked_func(
+                load_img(func_files[i]), masks[i], smoothing_fwhm=smoothing_fwhm,
+                high_pass=high_pass, t_r=t_r, dtype=dtype)
+    if cache is not None:
+        for i in missing:
+            cache.put(keys[i], masked_funcs[i])
+    return masked_funcs
+
+
+def preprocess_subject_data(subject_data, runs, high_pass=None, smoothing_fwhm=None,
+                            return_masked=False, cache=None, chunk_size=None,
+                            batched=False, dtype=np.float32, tmp_path=None):
     """Clean and return the voxel time-series signal of 
     a subject in a task.
 
@@ -40,22 +84,62 @@ def preprocess_subject_data(subject_data, runs, high_pass=None, smoothing_fwhm=N
             A numpy.ndarray must have 3 elements, giving the
             FWHM along each axis. If smoothing_fwhm is None, 
             no filtering is performed.
+        return_masked: Bool indicating whether the cleaned
+            data is returned as a compact (volumes x voxels)
+            matrix of the in-mask voxels, together with the
+            mask, instead of as a 4D image. With multiple runs,
+            the intersection of the run masks is used.
+        cache: hcprep.preprocess.PreprocessCache in which
+            cleaned runs are stored. Runs that are already
+            cached with the same inputs and parameters
+            are not cleaned again.
+        chunk_size: If given, runs are cleaned out-of-core:
+            their volumes are masked into a memory-mapped
+            temporary file (in tmp_path) and the voxel time
+            series are then cleaned in chunks of chunk_size
+            voxels, so that peak memory is bounded by
+            chunk_size rather than by run size.
+        batched: Bool indicating whether the runs are detrended
+            and filtered with one shared linear operator per
+            number of volumes (instead of per voxel), which is
+            applied to all runs in one matrix multiplication.
+            The result matches that of nilearn.signal.clean
+            to within floating-point tolerance.
+        dtype: Working precision of masking, cleaning and
+            the returned data. The standardization statistics
+            are always accumulated in float64.
+        tmp_path: Path in which the memory-mapped temporary
+            files of out-of-core cleaning are stored (defaults
+            to tempfile.gettempdir(), which is often a small
+            in-memory file system).
 
     Returns:
         func: ndarray of cleaned voxel time-series signals
+            (if return_masked: ndarray of shape volumes x voxels)
+        mask: Nifti1Image of the brain mask
+            (only returned if return_masked)
         labels: labels for each volume (ie., TR).
     """
 
+    if return_masked:
+        return _preprocess_subject_data_masked(
+            subject_data, runs, high_pass=high_pass, smoothing_fwhm=smoothing_fwhm,
+            cache=cache, chunk_size=chunk_size, batched=batched, dtype=dtype,
+            tmp_path=tmp_path)
+
+    # load and clean tfMRI data
+    masks = [load_img(subject_data[run]['func_mask_mni']) for run in runs]
+    masked_funcs = _clean_runs(
+        [subject_data[run]['func_mni'] for run in runs], masks,
+        smoothing_fwhm=smoothing_fwhm, high_pass=high_pass, t_r=subject_data['tr'],
+        cache=cache, chunk_size=chunk_size, batched=batched, dtype=dtype,
+        tmp_path=tmp_path)
+
     func = []
     labels = []
-    for run in runs:
-        # load tfMRI data
-        func_run = load_img(subject_data[run]['func_mni'])
-        mask_run = load_img(subject_data[run]['func_mask_mni'])
-
+    for run, mask_run, masked_func in zip(runs, masks, masked_funcs):
         trial_type = subject_data[run]['trial_type']
-        cleaned_func = _clean_func(
-            func_run, mask_run, smoothing_fwhm=smoothing_fwhm, high_pass=high_pass, t_r=subject_data['tr'])
+        cleaned_func = unmask(masked_func, mask_run)
 
         # subset tfMRI data to valid volumes
         valid_volume_idx = np.isfinite(trial_type)
@@ -66,6 +150,164 @@ def preprocess_subject_data(subject_data, runs, high_pass=None, smoothing_fwhm=N
         labels.append(valid_trial_type)
 
     labels = np.concatenate(labels)
-    func = concat_imgs(func)
+    func = concat_imgs(func, dtype=dtype)
 
     return func, labels
+
+
+def _preprocess_subject_data_masked(subject_data, runs, high_pass=None, smoothing_fwhm=None,
+                                    cache=None, chunk_size=None, batched=False,
+                                    dtype=np.float32, tmp_path=None):
+    masks = [load_img(subject_data[run]['func_mask_mni']) for run in runs]
+    if len(masks) > 1:
+        mask = intersect_masks(masks, threshold=1, connected=False)
+    else:
+        mask = masks[0]
+
+    masked_funcs = _clean_runs(
+        [subject_data[run]['func_mni'] for run in runs], [mask] * len(runs),
+        smoothing_fwhm=smoothing_fwhm, high_pass=high_pass, t_r=subject_data['tr'],
+        cache=cache, chunk_size=chunk_size, batched=batched, dtype=dtype,
+        tmp_path=tmp_path)
+
+    func = []
+    labels = []
+    for run, cleaned_func in zip(runs, masked_funcs):
+        trial_type = subject_data[run]['trial_type']
+
+        # subset tfMRI data to valid volumes
+        valid_volume_idx = np.isfinite(trial_type)
+        func.append(np.asarray(cleaned_func[valid_volume_idx]))
+        labels.append(trial_type[valid_volume_idx])
+
+    labels = np.concatenate(labels)
+    func = np.concatenate(func) if len(func) > 1 else func[0]
+
+    return func, mask, labels
+
+
+def _preprocess_job(job, path, t_r, high_pass, smoothing_fwhm, return_masked, cache,
+                    chunk_size, batched, dtype, tmp_path):
+    subject, task, run = job
+    subject_data = _load_subject_data(subject, task, [run], path, t_r)
+    return preprocess_subject_data(subject_data, [run],
+                                   high_pass=high_pass,
+                                   smoothing_fwhm=smoothing_fwhm,
+                                   return_masked=return_masked,
+                                   cache=cache,
+                                   chunk_size=chunk_size,
+                                   batched=batched,
+                                   dtype=dtype,
+                                   tmp_path=tmp_path)
+
+
+def _estimate_memory(job, path, memory_factor, chunk_size=None, itemsize=8):
+    """Estimate the peak memory (in bytes) of preprocessing
+    a job from the shape in its NIfTI header."""
+    subject, task, run = job
+    func_file = paths.path_bids_func_mni(subject, task, run, path)
+    header = _load_nifti_headers(
+        [func_file], paths.path_bids_func_meta(subject, path))[func_file]
+    if chunk_size is not None:
+        # only a chunk of voxels is cleaned at a time
+        return (int(np.prod(header['shape'])) * itemsize +
+                int(header['shape'][-1]) * chunk_size * itemsize * memory_factor)
+    return int(np.prod(header['shape'])) * itemsize * memory_factor
+
+
+def preprocess_subjects_data(jobs, path, t_r=0.72, high_pass=None, smoothing_fwhm=None,
+                             n_workers=None, memory_budget=None, memory_factor=6,
+                             return_masked=False, cache=None, chunk_size=None,
+                             batched=False, dtype=np.float32, tmp_path=None):
+    """Clean the voxel time-series signals of many HCP
+    subject runs in parallel.
+
+    The (subject, task, run) jobs are distributed across a pool
+    of processes. Each job's peak memory is estimated from the
+    shape in its NIfTI header, and jobs are only started while
+    the estimated memory of all running (and not yet returned)
+    jobs stays within memory_budget. A job that exceeds the
+    budget on its own is run alone.
+
+    Args:
+        jobs: A sequence of (subject, task, run) tuples.
+        path: Path to the local HCP data in BIDS format.
+        t_r: Repetition time of HCP data
+        high_pass: High frequency cutoff in Hertz.
+        smoothing_fwhm: Smoothing strength, as a Full-Width
+            at Half Maximum, in millimeters.
+        n_workers: Number of processes (defaults to the
+            number of CPUs).
+        memory_budget: Maximum estimated memory (in bytes) of all
+            concurrently processed jobs. If None, the number
+            of concurrent jobs is only limited by n_workers.
+        memory_factor: Peak memory of a job as a multiple of
+            its 4D data size in the working precision dtype.
+        return_masked: Bool indicating whether the cleaned data
+            is returned as a compact (volumes x voxels) matrix
+            (see hcprep.preprocess.preprocess_subject_data).
+        cache: hcprep.preprocess.PreprocessCache in which
+            cleaned runs are stored (see
+            hcprep.preprocess.preprocess_subject_data).
+        chunk_size: If given, runs are cleaned out-of-core, in
+            chunks of chunk_size voxels (see
+            hcprep.preprocess.preprocess_subject_data).
+        batched: Bool indicating whether runs are cleaned with
+            a shared linear operator (see
+            hcprep.preprocess.preprocess_subject_data). The
+            operator is computed once per process and number
+            of volumes.
+        dtype: Working precision of masking, cleaning and
+            the returned data.
+        tmp_path: Path in which the temporary files of
+            out-of-core cleaning are stored (see
+            hcprep.preprocess.preprocess_subject_data).
+
+    Yields:
+        (job, func, labels) for each job, in the order of jobs,
+        with func and labels as returned by
+        hcprep.preprocess.preprocess_subject_data
+        (if return_masked: (job, func, mask, labels)).
+    """
+    jobs = list(jobs)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    itemsize = np.dtype(dtype).itemsize
+    estimates = [_estimate_memory(job, path, memory_factor, chunk_size, itemsize)
+                 for job in jobs]
+    result_sizes = [_estimate_memory(job, path, 1, itemsize=itemsize) for job in jobs]
+
+    used = 0
+    next_submit = 0
+    next_yield = 0
+    running = {}
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while next_yield < len(jobs):
+            # admit jobs in order while they fit into the budget
+            while (next_submit < len(jobs) and
+                   len(running) < n_workers and
+                   (memory_budget is None or
+                    not running and not results or
+                    used + estimates[next_submit] <= memory_budget)):
+                future = executor.submit(_preprocess_job, jobs[next_submit], path,
+                                         t_r, high_pass, smoothing_fwhm, return_masked, cache,
+                                         chunk_size, batched, dtype, tmp_path)
+                running[future] = next_submit
+                used += estimates[next_submit]
+                next_submit += 1
+
+            # yield finished jobs in order
+            if next_yield in results:
+                result = results.pop(next_yield)
+                used -= result_sizes[next_yield]
+                yield (jobs[next_yield],) + tuple(result)
+                next_yield += 1
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                results[i] = future.result()
+                # the job's working memory is released, its result is kept
+                used -= estimates[i] - result_sizes[i]
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+import numpy as np
+import nibabel as nib
+import pytest
+
+from hcprep import paths
+from hcprep.data import summarize_subject_EVs
+from hcprep.data._utils import _EV_SPEC
+
+
+SUBJECTS = [100307, 100408]
+RUNS = ['LR', 'RL']
+SHAPE = (4, 5, 4)
+N_VOLUMES = 60
+
+
+def make_bids_run(path, subject, task, run, rng, shape=SHAPE, n_volumes=N_VOLUMES):
+    """Write a small synthetic run (func, brain mask,
+    EV files and EV summary) to the BIDS directory path."""
+    func_path = path+'sub-{}/func/'.format(subject)
+    paths.make_sure_path_exists(func_path)
+    affine = np.diag([2., 2., 2., 1.])
+    func = nib.Nifti1Image(
+        (rng.randn(*shape, n_volumes) * 10 + 100).astype(np.float32), affine)
+    func.header.set_zooms((2., 2., 2., 0.72))
+    nib.save(func, paths.path_bids_func_mni(subject, task, run, path))
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    nib.save(nib.Nifti1Image(mask, affine),
+             paths.path_bids_func_mask_mni(subject, task, run, path))
+    for i, ev_file in enumerate(_EV_SPEC[task]):
+        onset = 1 + 5 * i + rng.rand()
+        with open(func_path+'sub-{}_task-{}_run-{}_EV-{}'.format(
+                subject, task, run, ev_file), 'w') as f:
+            f.write('{:.3f}\t3.0\t1\n'.format(onset))
+    summarize_subject_EVs(task, subject, [run], func_path).to_csv(
+        paths.path_bids_EV(subject, task, run, path), index=False)
+
+
+@pytest.fixture
+def bids_path(tmp_path):
+    """BIDS directory with the WM runs of two subjects."""
+    path = str(tmp_path)+'/bids/'
+    rng = np.random.RandomState(0)
+    for subject in SUBJECTS:
+        for run in RUNS:
+            make_bids_run(path, subject, 'WM', run, rng)
+    return path
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+import numpy as np
+import pytest
+
+from hcprep.convert import (write_to_tfr, make_tfr_metadata, write_tfr_metadata,
+                            read_tfr_metadata, TFRecordFileWriter, iter_tfr_records,
+                            parse_tfr_numpy, iter_tfr_batches_numpy)
+
+
+SHAPE = (6, 7, 5)
+N_VOLUMES = 12
+N_CLASSES_PER_TASK = [2, 3]
+
+
+def _mask():
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[1:5, 2:6, 1:4] = True
+    mask[1, 2, 1] = False
+    return mask
+
+
+def _data(seed=0):
+    rng = np.random.RandomState(seed)
+    X = (rng.randn(*SHAPE, N_VOLUMES) * 50 + 100).astype(np.float32)
+    y = rng.randint(N_CLASSES_PER_TASK[1], size=N_VOLUMES)
+    return X, y
+
+
+def _write(filename, X, y, metadata, mask=None):
+    with TFRecordFileWriter(filename, compression=metadata['compression']) as writer:
+        write_to_tfr([writer], X, y, 100307, 1, 0, N_CLASSES_PER_TASK,
+                     mask=mask, metadata=metadata)
+
+
+def _tolerance(dtype, volume):
+    if dtype == 'int16':
+        # half a quantization step
+        return np.max(np.abs(volume)) / 32767. / 2 + 1e-6
+    if dtype == 'float16':
+        return np.max(np.abs(volume)) * 2**-11
+    return 0
+
+
+@pytest.mark.parametrize('layout', ['full', 'bbox', 'masked'])
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int16'])
+def test_round_trip(tmp_path, layout, dtype):
+    X, y = _data()
+    mask = _mask()
+    metadata = make_tfr_metadata(mask=mask if layout != 'full' else None, layout=layout,
+                                 shape=SHAPE, n_classes_per_task=N_CLASSES_PER_TASK,
+                                 dtype=dtype)
+    filename = str(tmp_path/'data.tfrecords')
+    _write(filename, X, y, metadata)
+    # voxels that are stored; all others are rebuilt as zeros
+    keep = np.ones(SHAPE, dtype=bool)
+    if layout == 'bbox':
+        keep[:] = False
+        keep[1:5, 2:6, 1:4] = True
+    elif layout == 'masked':
+        keep = mask
+    n_volumes = 0
+    for record in iter_tfr_records(filename, check_crc=True):
+        volume, task_id, subject_id, run_id, vi, label, label_onehot = parse_tfr_numpy(
+            record, metadata=metadata, rebuild_full=True)
+        expected = np.where(keep, X[..., vi], 0)
+        np.testing.assert_allclose(volume, expected, rtol=0,
+                                   atol=_tolerance(dtype, X[..., vi][keep]))
+        assert (task_id, subject_id, run_id, label) == (1, 100307, 0, y[vi])
+        np.testing.assert_array_equal(label_onehot, np.eye(5, dtype=int)[2+y[vi]])
+        n_volumes += 1
+    assert n_volumes == N_VOLUMES
+
+
+@pytest.mark.parametrize('layout', ['bbox', 'masked'])
+def test_stored_shape(tmp_path, layout):
+    X, y = _data()
+    mask = _mask()
+    metadata = make_tfr_metadata(mask=mask, layout=layout,
+                                 n_classes_per_task=N_CLASSES_PER_TASK)
+    filename = str(tmp_path/'data.tfrecords')
+    _write(filename, X, y, metadata)
+    parsed = parse_tfr_numpy(next(iter_tfr_records(filename)), metadata=metadata)
+    volume, vi = parsed[0], parsed[4]
+    if layout == 'bbox':
+        assert list(volume.shape) == [4, 4, 3]
+        np.testing.assert_array_equal(volume, X[1:5, 2:6, 1:4, vi])
+    else:
+        assert volume.shape == (int(mask.sum()),)
+        np.testing.assert_array_equal(volume, X[..., vi][mask])
+
+
+@pytest.mark.parametrize('layout', ['full', 'bbox', 'masked'])
+def test_compact_input_matches_full_input(tmp_path, layout):
+    X, y = _data()
+    mask = _mask()
+    metadata = make_tfr_metadata(mask=mask, layout=layout,
+                                 n_classes_per_task=N_CLASSES_PER_TASK)
+    np.random.seed(0)
+    _write(str(tmp_path/'full.tfrecords'), np.where(mask[..., None], X, 0), y, metadata)
+    np.random.seed(0)
+    _write(str(tmp_path/'compact.tfrecords'), X[mask].T, y, metadata, mask=mask)
+    assert (list(iter_tfr_records(str(tmp_path/'full.tfrecords'))) ==
+            list(iter_tfr_records(str(tmp_path/'compact.tfrecords'))))
+
+
+@pytest.mark.parametrize('compression', [None, 'GZIP', 'ZLIB'])
+def test_iter_tfr_batches_numpy(tmp_path, compression):
+    X, y = _data()
+    metadata = make_tfr_metadata(mask=_mask(), layout='masked', dtype='int16',
+                                 n_classes_per_task=N_CLASSES_PER_TASK,
+                                 compression=compression)
+    filenames = [str(tmp_path/'a.tfrecords'), str(tmp_path/'b.tfrecords')]
+    for filename in filenames:
+        _write(filename, X, y, metadata)
+    records = [record for filename in filenames
+               for record in iter_tfr_records(filename, compression=compression)]
+    batches = [tuple(np.array(b) for b in batch)
+               for batch in iter_tfr_batches_numpy(filenames, metadata, 5, rebuild_full=True)]
+    assert [len(batch[0]) for batch in batches] == [5, 5, 5, 5, 4]
+    volumes = np.concatenate([batch[0] for batch in batches])
+    for record, volume in zip(records, volumes):
+        np.testing.assert_array_equal(
+            volume, parse_tfr_numpy(record, metadata=metadata, rebuild_full=True)[0])
+
+
+def test_metadata_file_round_trip(tmp_path):
+    mask = _mask()
+    metadata = make_tfr_metadata(mask=mask, layout='bbox', dtype='int16',
+                                 n_classes_per_task=N_CLASSES_PER_TASK, compression='GZIP')
+    filename = str(tmp_path/'meta'/'metadata.json')
+    write_tfr_metadata(metadata, filename)
+    read = read_tfr_metadata(filename)
+    np.testing.assert_array_equal(read['mask'], mask)
+    assert read['bbox'] == [[1, 5], [2, 6], [1, 4]]
+    assert {k: v for k, v in read.items() if k != 'mask'} == \
+        {k: v for k, v in metadata.items() if k != 'mask'}
+
+
+@pytest.mark.parametrize('layout', ['bbox', 'masked'])
+@pytest.mark.parametrize('dtype', ['float32', 'int16'])
+def test_parse_tfr_matches_numpy(tmp_path, layout, dtype):
+    tf = pytest.importorskip('tensorflow')
+    from hcprep.convert import parse_tfr
+    X, y = _data()
+    metadata = make_tfr_metadata(mask=_mask(), layout=layout, dtype=dtype,
+                                 n_classes_per_task=N_CLASSES_PER_TASK)
+    filename = str(tmp_path/'data.tfrecords')
+    _write(filename, X, y, metadata)
+    for record, example in zip(iter_tfr_records(filename), tf.data.TFRecordDataset(filename)):
+        expected = parse_tfr_numpy(record, metadata=metadata, rebuild_full=True)
+        parsed = parse_tfr(example, metadata=metadata, rebuild_full=True)
+        np.testing.assert_allclose(parsed[0].numpy(), expected[0], rtol=1e-6)
+        assert int(parsed[4].numpy()[0]) == expected[4]
+        np.testing.assert_array_equal(parsed[6].numpy(), expected[6])
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from hcprep.data import load_subject_data, summarize_subject_EVs
+from hcprep.data._utils import _read_ev_files, _generate_ev_df, _add_markers_to_datadict
+
+
+def _add_markers_to_datadict_loop(f, EV, n_volumes_discard_trial_onset=1, n_volumes_add_trial_end=1):
+    """Reference implementation (one trial at a time)."""
+    t_r = f['tr']
+    event_types = EV['event_type'].values
+    unique_event_types = np.sort(np.unique(event_types))
+    numerical_event_types = np.arange(unique_event_types.size)
+    f['event_type_mapping'] = {}
+    for num_type in numerical_event_types:
+        f['event_type_mapping'][num_type] = unique_event_types[num_type]
+    f['event_type_mapping'][numerical_event_types.max()+1] = 'fixation'
+    tmp = np.full(event_types.shape, np.nan)
+    for event_type in unique_event_types:
+        tmp[np.where(event_types == event_type)[0]] = numerical_event_types[
+            np.where(unique_event_types == event_type)[0]]
+    EV['event_num'] = tmp
+    for run in EV['run'].unique():
+        run_data = EV[EV['run'] == run].copy()
+        for trial in np.sort(run_data['trial'].values):
+            trial_data = run_data[run_data['trial'] == trial]
+            trial_type = trial_data['event_num'].values[0]
+            trial_onset = trial_data['onset'].values[0]
+            trial_end = trial_data['end'].values[0]
+            volume_idx = np.where(
+                (f[run]['onset'] >= (trial_onset + (n_volumes_discard_trial_onset*t_r))) &
+                (f[run]['onset'] <= (trial_end+t_r + (n_volumes_add_trial_end*t_r))))[0]
+            f[run]['trial'][volume_idx] = trial
+            f[run]['n_trial_volumes'][volume_idx] = volume_idx.size
+            f[run]['rel_onset'][volume_idx] = f[run]['onset'][volume_idx] - trial_onset
+            f[run]['trial_type'][volume_idx] = trial_type
+            f[run]['n_valid_volumes'] += len(volume_idx)
+            f[run]['n_trials'] += 1
+    return f
+
+
+def _random_datadict(rng, runs, n_volumes, t_r=0.72):
+    f = {'tr': t_r, 'runs': runs}
+    for run in runs:
+        f[run] = {'trial': np.full(n_volumes, np.nan),
+                  'n_trial_volumes': np.full(n_volumes, np.nan),
+                  'rel_onset': np.full(n_volumes, np.nan),
+                  'trial_type': np.full(n_volumes, np.nan),
+                  'n_valid_volumes': 0,
+                  'n_trials': 0,
+                  'onset': np.arange(n_volumes) * t_r}
+    return f
+
+
+def _random_ev(rng, runs, n_trials, duration):
+    run = np.repeat(runs, n_trials)
+    onset = rng.uniform(-5, duration + 5, run.size)
+    length = rng.uniform(0.5, 20, run.size)
+    EV = pd.DataFrame({'run': run,
+                       'event_type': rng.choice(['body', 'faces', 'places'], run.size),
+                       'onset': onset,
+                       'end': onset + length})
+    # trial numbers are not in the order of the rows
+    EV['trial'] = rng.permutation(run.size)
+    return EV
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('n_discard, n_add', [(1, 1), (0, 0), (2, 3)])
+def test_add_markers_matches_loop(seed, n_discard, n_add):
+    rng = np.random.RandomState(seed)
+    runs = ['LR', 'RL']
+    n_volumes = 200
+    EV = _random_ev(rng, runs, 30, n_volumes * 0.72)
+    expected = _add_markers_to_datadict_loop(
+        _random_datadict(rng, runs, n_volumes), EV.copy(), n_discard, n_add)
+    f = _add_markers_to_datadict(
+        _random_datadict(rng, runs, n_volumes), EV.copy(), n_discard, n_add)
+    assert f['event_type_mapping'] == expected['event_type_mapping']
+    for run in runs:
+        for key in ['trial', 'n_trial_volumes', 'rel_onset', 'trial_type']:
+            np.testing.assert_array_equal(f[run][key], expected[run][key])
+        assert f[run]['n_valid_volumes'] == expected[run]['n_valid_volumes']
+        assert f[run]['n_trials'] == expected[run]['n_trials']
+
+
+def test_load_subject_data_markers(bids_path):
+    f = load_subject_data('WM', 100307, ['LR', 'RL'], bids_path)
+    for run in ['LR', 'RL']:
+        assert f[run]['n_volumes'] == 60
+        assert f[run]['n_trials'] == 8
+        assert np.isfinite(f[run]['trial_type']).any()
+    assert sorted(f['event_type_mapping'].values()) == [
+        'body', 'faces', 'fixation', 'places', 'tools']
+
+
+def _write(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+    return filename
+
+
+def test_read_ev_files(tmp_path):
+    filenames = [
+        _write(str(tmp_path/'a.txt'), '1.5\t3.0\t1\n10.25\t2.5\t1\n'),
+        _write(str(tmp_path/'empty.txt'), ''),
+        _write(str(tmp_path/'b.txt'), '4 1'),
+        _write(str(tmp_path/'blank.txt'), '\n'),
+        _write(str(tmp_path/'c.txt'), '7.0 0.5 1\n8.0 0.5 1\n9.0 0.5 1\n')]
+    ev_mat, n_events = _read_ev_files(filenames)
+    assert n_events == [2, 0, 1, 0, 3]
+    expected = np.concatenate(
+        [np.loadtxt(filename, ndmin=2)[:, :2] for filename in filenames
+         if os.path.getsize(filename) > 1])
+    np.testing.assert_array_equal(ev_mat, expected)
+
+
+def test_read_ev_files_only_empty(tmp_path):
+    ev_mat, n_events = _read_ev_files([_write(str(tmp_path/'empty.txt'), '')])
+    assert ev_mat.shape == (0, 2)
+    assert n_events == [0]
+    ev_mat, n_events = _read_ev_files([])
+    assert ev_mat.shape == (0, 2)
+    assert n_events == []
+
+
+def test_generate_ev_df_with_empty_file(tmp_path):
+    path = str(tmp_path)+'/'
+    _write(path+'sub-1_task-GAMBLING_run-LR_EV-win_event.txt', '1.0\t2.0\t1\n5.0\t2.0\t1\n')
+    _write(path+'sub-1_task-GAMBLING_run-LR_EV-loss_event.txt', '')
+    _write(path+'sub-1_task-GAMBLING_run-LR_EV-neut_event.txt', '3.0\t1.0\t1\n')
+    df = _generate_ev_df(path, 'GAMBLING', 1, ['LR'])
+    assert list(df['event_type']) == ['win', 'win', 'neut']
+    np.testing.assert_array_equal(df['end'], [3., 7., 4.])
+    summary = summarize_subject_EVs('GAMBLING', 1, ['LR'], path)
+    np.testing.assert_array_equal(summary['onset'], [1., 3., 5.])
+    np.testing.assert_array_equal(summary['trial'], [0, 1, 2])
+
+
+def test_generate_ev_df_invalid_task(tmp_path):
+    with pytest.raises(NameError):
+        _generate_ev_df(str(tmp_path)+'/', 'REST', 1, ['LR'])
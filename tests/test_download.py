@@ -0,0 +1,225 @@
+#!/usr/bin/python
+import os
+import hashlib
+import numpy as np
+import pytest
+
+from hcprep.download import S3Storage
+from hcprep.download._utils import _fetch_file, _path_transfer_state
+
+
+KEY = 'HCP/100307/MNINonLinear/Results/tfMRI_WM_LR/tfMRI_WM_LR.nii.gz'
+
+
+class _Body:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i+chunk_size]
+
+
+class _FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client, which
+    records all get_object requests. Ranges listed in fail
+    raise once; ranges listed in corrupt return flipped bytes."""
+
+    def __init__(self, objects, etags=None):
+        self.objects = objects
+        self.etags = etags or {}
+        self.gets = []
+        self.fail = set()
+        self.corrupt = set()
+
+    def etag(self, key):
+        return self.etags.get(key, hashlib.md5(self.objects[key]).hexdigest())
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key]),
+                'ETag': '"{}"'.format(self.etag(Key))}
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        self.gets.append(Range)
+        if Range in self.fail:
+            self.fail.remove(Range)
+            raise IOError('Connection reset.')
+        data = self.objects[Key]
+        if Range is not None:
+            start, end = Range.split('=')[1].split('-')
+            data = data[int(start):int(end)+1 if end else None]
+        if Range in self.corrupt:
+            data = bytes(b ^ 0xFF for b in data)
+        return {'Body': _Body(data)}
+
+
+class _FakeBucket:
+    class meta:
+        pass
+
+    def __init__(self, client):
+        self.name = 'hcp-openaccess'
+        self.meta = _FakeBucket.meta()
+        self.meta.client = client
+
+
+def _object(size, seed=0):
+    return np.random.RandomState(seed).bytes(size)
+
+
+def _read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _fetch(client, output_file, **kwargs):
+    return _fetch_file(client, 'hcp-openaccess', KEY, output_file, **kwargs)
+
+
+def test_fetch_and_skip_verified(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    assert _fetch(client, output_file, chunk_size=1024) == len(data)
+    assert _read(output_file) == data
+    assert client.gets == [None]
+    assert os.path.isfile(_path_transfer_state(output_file, '.verified.json'))
+    assert not os.path.exists(_path_transfer_state(output_file, '.part'))
+    assert _fetch(client, output_file, chunk_size=1024) == 0
+    assert client.gets == [None]
+
+
+def test_resume_partial_download(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    part_file = _path_transfer_state(output_file, '.part')
+    os.makedirs(os.path.dirname(part_file))
+    with open(part_file, 'wb') as f:
+        f.write(data[:3000])
+    assert _fetch(client, output_file, chunk_size=1024) == 7000
+    assert client.gets == ['bytes=3000-']
+    assert _read(output_file) == data
+
+
+def test_redownload_corrupted_file(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    # a file of the right size but with other content
+    with open(output_file, 'wb') as f:
+        f.write(_object(10000, seed=1))
+    assert _fetch(client, output_file) == len(data)
+    assert _read(output_file) == data
+
+    # a verified file that was changed afterwards
+    with open(output_file, 'r+b') as f:
+        f.write(b'\x00' * 10)
+    os.utime(output_file, ns=(0, 0))
+    assert _fetch(client, output_file) == len(data)
+    assert _read(output_file) == data
+
+
+def test_adopt_intact_file_without_sidecar(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    with open(output_file, 'wb') as f:
+        f.write(data)
+    assert _fetch(client, output_file) == 0
+    assert client.gets == []
+    assert os.path.isfile(_path_transfer_state(output_file, '.verified.json'))
+
+
+def test_failed_verification(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    client.corrupt.add(None)
+    output_file = str(tmp_path/'func.nii.gz')
+    with pytest.raises(IOError):
+        _fetch(client, output_file)
+    assert not os.path.exists(output_file)
+    assert not os.path.exists(_path_transfer_state(output_file, '.part'))
+    client.corrupt.clear()
+    assert _fetch(client, output_file) == len(data)
+    assert _read(output_file) == data
+
+
+def test_fetch_parts(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    assert _fetch(client, output_file, chunk_size=1024, n_part_workers=4) == len(data)
+    assert _read(output_file) == data
+    assert sorted(client.gets, key=lambda r: int(r.split('=')[1].split('-')[0])) == [
+        'bytes={}-{}'.format(start, min(start+1024, 10000)-1)
+        for start in range(0, 10000, 1024)]
+    part_file = _path_transfer_state(output_file, '.part')
+    assert not os.path.exists(part_file)
+    assert not os.path.exists(part_file+'s')
+
+
+def test_resume_parts(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    client.fail.add('bytes=4096-5119')
+    output_file = str(tmp_path/'func.nii.gz')
+    with pytest.raises(IOError):
+        _fetch(client, output_file, chunk_size=1024, n_part_workers=2)
+    assert len(client.gets) == 10
+    # only the failed part is transferred again
+    assert _fetch(client, output_file, chunk_size=1024, n_part_workers=2) == 1024
+    assert client.gets[10:] == ['bytes=4096-5119']
+    assert _read(output_file) == data
+
+
+def test_parts_adopt_sequential_prefix(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    output_file = str(tmp_path/'func.nii.gz')
+    part_file = _path_transfer_state(output_file, '.part')
+    os.makedirs(os.path.dirname(part_file))
+    with open(part_file, 'wb') as f:
+        f.write(data[:3000])
+    _fetch(client, output_file, chunk_size=1024, n_part_workers=4)
+    # the first two parts are complete
+    assert 'bytes=0-1023' not in client.gets
+    assert 'bytes=1024-2047' not in client.gets
+    assert 'bytes=2048-3071' in client.gets
+    assert _read(output_file) == data
+
+
+def test_corrupted_part(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    client.corrupt.add('bytes=1024-2047')
+    output_file = str(tmp_path/'func.nii.gz')
+    with pytest.raises(IOError):
+        _fetch(client, output_file, chunk_size=1024, n_part_workers=4)
+    assert not os.path.exists(output_file)
+    client.corrupt.clear()
+    assert _fetch(client, output_file, chunk_size=1024, n_part_workers=4) == len(data)
+    assert _read(output_file) == data
+
+
+def test_multipart_etag(tmp_path):
+    part_size = 5 * 1024 * 1024
+    data = _object(2 * part_size + 1000)
+    etag = '{}-3'.format(hashlib.md5(b''.join(
+        hashlib.md5(data[i:i+part_size]).digest()
+        for i in range(0, len(data), part_size))).hexdigest())
+    client = _FakeS3Client({KEY: data}, etags={KEY: etag})
+    output_file = str(tmp_path/'func.nii.gz')
+    assert _fetch(client, output_file, n_part_workers=2) == len(data)
+    assert _read(output_file) == data
+
+
+def test_s3_storage(tmp_path):
+    data = _object(10000)
+    client = _FakeS3Client({KEY: data})
+    storage = S3Storage(bucket=_FakeBucket(client))
+    assert storage.stat(KEY) == (len(data), client.etag(KEY))
+    output_file = str(tmp_path/'func.nii.gz')
+    assert storage.fetch(KEY, output_file, chunk_size=1024, n_part_workers=2) == len(data)
+    assert _read(output_file) == data
+    assert storage.fetch(KEY, output_file, chunk_size=1024, n_part_workers=2) == 0
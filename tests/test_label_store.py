@@ -0,0 +1,78 @@
+#!/usr/bin/python
+import numpy as np
+import pytest
+
+from hcprep.data import build_label_store, LabelStore, load_subject_data
+
+
+TASKS = ['EMOTION', 'GAMBLING', 'LANGUAGE', 'MOTOR', 'RELATIONAL', 'SOCIAL', 'WM']
+RUNS = ['LR', 'RL']
+CLASSES_PER_TASK = {'WM': ['body', 'faces', 'places', 'tools']}
+JOBS = [(100307, 'WM', 'LR'), (100307, 'WM', 'RL'), (100408, 'WM', 'LR')]
+
+
+@pytest.fixture
+def store(bids_path, tmp_path):
+    return build_label_store(JOBS, bids_path, str(tmp_path/'labels'),
+                             TASKS, RUNS, CLASSES_PER_TASK)
+
+
+def _expected_rows(bids_path, subjects=None, runs=None, labels=None, valid_only=True):
+    """Row indices of a query, from the labels of each run."""
+    rows = []
+    start = 0
+    for subject, task, run in JOBS:
+        f = load_subject_data(task, subject, [run], bids_path)
+        trial_type = f[run]['trial_type']
+        for vi in range(f[run]['n_volumes']):
+            valid = np.isfinite(trial_type[vi])
+            label = (f['event_type_mapping'][int(trial_type[vi])] if valid else None)
+            if ((subjects is None or subject in subjects) and
+                    (runs is None or run in runs) and
+                    (labels is None or label in labels) and
+                    (valid or not valid_only)):
+                rows.append(start + vi)
+        start += f[run]['n_volumes']
+    return rows
+
+
+def test_store_layout(store, bids_path):
+    assert len(store) == 3 * 60
+    assert [unit[:3] for unit in store.units] == JOBS
+    reopened = LabelStore(store.store_path)
+    np.testing.assert_array_equal(reopened['label'], store['label'])
+    f = load_subject_data('WM', 100307, ['RL'], bids_path)
+    rows = slice(*store.units[1][3:])
+    np.testing.assert_array_equal(store['trial_type'][rows], f['RL']['trial_type'])
+    np.testing.assert_array_equal(store['volume_idx'][rows], np.arange(60))
+    with pytest.raises(KeyError):
+        store['onset']
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'valid_only': False},
+    {'subjects': [100408]},
+    {'subjects': ['100307'], 'runs': ['RL']},
+    {'labels': ['faces']},
+    {'labels': ['faces', 'tools'], 'runs': ['LR']},
+    {'labels': ['fixation'], 'valid_only': False},
+])
+def test_query(store, bids_path, query):
+    rows = store.query(**query)
+    if 'subjects' in query:
+        query['subjects'] = [int(s) for s in query['subjects']]
+    np.testing.assert_array_equal(rows, _expected_rows(bids_path, **query))
+
+
+def test_query_tasks(store):
+    assert store.query(tasks=['MOTOR']).size == 0
+    np.testing.assert_array_equal(store.query(tasks=['WM']), store.query())
+
+
+def test_select(store):
+    rows = store.query(labels=['places'])
+    assert rows.size > 0
+    selected = store.select(rows, columns=['label', 'subject'])
+    assert sorted(selected) == ['label', 'subject']
+    assert (selected['label'] == CLASSES_PER_TASK['WM'].index('places')).all()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+import importlib
+from concurrent.futures import Future
+import numpy as np
+import pytest
+
+from hcprep.data import load_subject_data
+from hcprep.preprocess import preprocess_subject_data, preprocess_subjects_data
+
+
+preprocess_module = importlib.import_module('hcprep.preprocess.preprocess')
+
+
+class _FakeExecutor:
+    """Runs one job whenever jobs are waited for and
+    records the jobs that are running at each submission."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.running = []
+        self.log = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, fn, job, *args):
+        assert len(self.running) < self.max_workers
+        future = Future()
+        self.running.append((future, job))
+        self.log.append([j for _, j in self.running])
+        return future
+
+    def complete(self, newest_first=False):
+        future, job = self.running.pop(-1 if newest_first else 0)
+        future.set_result(('func', job))
+        return future
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """Replace the process pool and memory estimates of
+    preprocess_subjects_data; the estimate of a job is
+    its size times memory_factor, its result is its size.
+    Jobs finish oldest first, unless newest_first is set."""
+    state = {'executors': [], 'newest_first': False}
+
+    def executor(max_workers):
+        state['executors'].append(_FakeExecutor(max_workers))
+        return state['executors'][-1]
+
+    def wait(futures, return_when):
+        done = state['executors'][-1].complete(state['newest_first'])
+        return {done}, set(futures) - {done}
+
+    monkeypatch.setattr(preprocess_module, 'ProcessPoolExecutor', executor)
+    monkeypatch.setattr(preprocess_module, 'wait', wait)
+    monkeypatch.setattr(preprocess_module, '_estimate_memory',
+                        lambda job, path, memory_factor, chunk_size=None, itemsize=8:
+                        job[0] * memory_factor)
+    return state
+
+
+def _run(jobs, **kwargs):
+    results = list(preprocess_subjects_data(jobs, 'bids/', memory_factor=4, **kwargs))
+    assert [result[0] for result in results] == jobs
+    assert [result[2] for result in results] == jobs
+    return results
+
+
+def test_without_budget_limited_by_workers(scheduler):
+    jobs = [(10, 'WM', run) for run in range(6)]
+    _run(jobs, n_workers=3)
+    assert max(len(running) for running in scheduler['executors'][0].log) == 3
+
+
+def test_budget_limits_concurrent_jobs(scheduler):
+    jobs = [(10, 'WM', run) for run in range(6)]
+    # each job needs 40 while it runs and holds 10 until it is yielded
+    _run(jobs, n_workers=4, memory_budget=100)
+    log = scheduler['executors'][0].log
+    assert max(len(running) for running in log) == 2
+    for running in log:
+        assert sum(job[0] * 4 for job in running) <= 100
+
+
+def test_oversized_job_runs_alone(scheduler):
+    jobs = [(10, 'WM', 0), (50, 'WM', 1), (10, 'WM', 2), (10, 'WM', 3)]
+    _run(jobs, n_workers=4, memory_budget=100)
+    log = scheduler['executors'][0].log
+    for running in log:
+        if (50, 'WM', 1) in running:
+            assert running == [(50, 'WM', 1)]
+    # the other jobs still run concurrently
+    assert any(len(running) > 1 for running in log)
+
+
+def test_budget_counts_held_results(scheduler):
+    scheduler['newest_first'] = True
+    jobs = [(10, 'WM', run) for run in range(4)]
+    _run(jobs, n_workers=4, memory_budget=85)
+    log = scheduler['executors'][0].log
+    # two jobs fit (80); once the second is done, its result (10)
+    # is held until the first is yielded, so that a third job (40)
+    # only fits once the first is done as well
+    assert log[:3] == [[(10, 'WM', 0)],
+                       [(10, 'WM', 0), (10, 'WM', 1)],
+                       [(10, 'WM', 2)]]
+
+
+def test_preprocess_subjects_data_matches_sequential(bids_path):
+    jobs = [(100307, 'WM', 'LR'), (100408, 'WM', 'RL')]
+    results = list(preprocess_subjects_data(jobs, bids_path, n_workers=1,
+                                            memory_budget=1, dtype=np.float64))
+    assert [result[0] for result in results] == jobs
+    for (subject, task, run), func, labels in results:
+        subject_data = load_subject_data(task, subject, [run], bids_path)
+        expected_func, expected_labels = preprocess_subject_data(
+            subject_data, [run], dtype=np.float64)
+        np.testing.assert_allclose(np.asarray(func.dataobj),
+                                   np.asarray(expected_func.dataobj))
+        np.testing.assert_array_equal(labels, expected_labels)
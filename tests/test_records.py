@@ -0,0 +1,132 @@
+#!/usr/bin/python
+import numpy as np
+import pytest
+
+from hcprep.convert import TFRecordFileWriter, iter_tfr_records, crc32c
+from hcprep.convert.records import _crc32c_python
+from hcprep.convert._utils import (_encode_example, _decode_example, _int64_feature,
+                                   _float_feature, _bytes_feature)
+
+
+def test_crc32c_check_value():
+    assert crc32c(b'123456789') == 0xE3069283
+    assert crc32c(b'') == 0
+
+
+@pytest.mark.parametrize('size', [1, 4095, 4096, 4097, 65536, 100003])
+def test_crc32c_blocks_match_bytewise(size):
+    data = np.random.RandomState(size).bytes(size)
+    assert crc32c(data) == _crc32c_python(data) ^ 0xFFFFFFFF
+
+
+def _records(n=20, seed=0):
+    rng = np.random.RandomState(seed)
+    records = [rng.bytes(rng.randint(0, 5000)) for _ in range(n)]
+    # large enough for the blockwise CRC32C
+    records.append(rng.bytes(100003))
+    return records
+
+
+def test_tfrecord_framing_matches_tensorflow(tmp_path):
+    tf = pytest.importorskip('tensorflow')
+    records = _records()
+    tf_file = str(tmp_path/'tf.tfrecords')
+    own_file = str(tmp_path/'own.tfrecords')
+    with tf.io.TFRecordWriter(tf_file) as writer:
+        for record in records:
+            writer.write(record)
+    with TFRecordFileWriter(own_file) as writer:
+        for record in records:
+            writer.write(record)
+    with open(tf_file, 'rb') as f_tf, open(own_file, 'rb') as f_own:
+        assert f_tf.read() == f_own.read()
+
+
+@pytest.mark.parametrize('compression', ['GZIP', 'ZLIB'])
+def test_compressed_records_match_tensorflow(tmp_path, compression):
+    tf = pytest.importorskip('tensorflow')
+    records = _records()
+    own_file = str(tmp_path/'own.tfrecords')
+    with TFRecordFileWriter(own_file, compression=compression) as writer:
+        for record in records:
+            writer.write(record)
+    dataset = tf.data.TFRecordDataset(own_file, compression_type=compression)
+    assert [record.numpy() for record in dataset] == records
+
+    tf_file = str(tmp_path/'tf.tfrecords')
+    with tf.io.TFRecordWriter(tf_file, options=compression) as writer:
+        for record in records:
+            writer.write(record)
+    assert list(iter_tfr_records(tf_file, compression=compression, check_crc=True)) == records
+
+
+def test_iter_tfr_records_detects_corruption(tmp_path):
+    records = _records(n=3)
+    filename = str(tmp_path/'own.tfrecords')
+    with TFRecordFileWriter(filename) as writer:
+        for record in records:
+            writer.write(record)
+    assert list(iter_tfr_records(filename, check_crc=True)) == records
+    with open(filename, 'r+b') as f:
+        f.seek(20)
+        byte = f.read(1)[0]
+        f.seek(20)
+        f.write(bytes([byte ^ 0xFF]))
+    with pytest.raises(ValueError):
+        list(iter_tfr_records(filename, check_crc=True))
+
+
+_RNG = np.random.RandomState(0)
+# (kind, values) of the features of a test example
+_VALUES = {'subject_id': ('int64', [100307]),
+           'label': ('int64', [-3]),
+           'label_onehot': ('int64', [0, 1, 0, 2**40]),
+           'empty': ('int64', []),
+           'volume': ('bytes', [_RNG.bytes(300), b'']),
+           'volume_scale': ('float', [0.125]),
+           'volume_list': ('float', _RNG.randn(50).astype(np.float32).tolist())}
+_FEATURES = {'int64': _int64_feature, 'float': _float_feature, 'bytes': _bytes_feature}
+
+
+def _tf_example(tf):
+    lists = {'int64': lambda v: tf.train.Feature(int64_list=tf.train.Int64List(value=v)),
+             'float': lambda v: tf.train.Feature(float_list=tf.train.FloatList(value=v)),
+             'bytes': lambda v: tf.train.Feature(bytes_list=tf.train.BytesList(value=v))}
+    return tf.train.Example(features=tf.train.Features(feature={
+        name: lists[kind](values) for name, (kind, values) in _VALUES.items()}))
+
+
+def test_encode_example_matches_tensorflow():
+    tf = pytest.importorskip('tensorflow')
+    # map entries are serialized in an implementation-defined
+    # order, which is taken from the serialized TF example
+    expected = _tf_example(tf).SerializeToString()
+    _, tf_features = _decode_example(expected)
+    features = {name: _FEATURES[_VALUES[name][0]](_VALUES[name][1])
+                for name in tf_features}
+    assert _encode_example(features) == expected
+    assert tf.train.Example.FromString(_encode_example(features)) == _tf_example(tf)
+
+
+def test_decode_example_of_tensorflow():
+    tf = pytest.importorskip('tensorflow')
+    buf, features = _decode_example(_tf_example(tf).SerializeToString())
+    assert sorted(features) == sorted(_VALUES)
+    for name, (kind, values) in _VALUES.items():
+        decoded_kind, decoded = features[name]
+        assert decoded_kind == kind
+        if kind == 'bytes':
+            assert [bytes(buf[start:stop]) for start, stop in decoded] == values
+        else:
+            np.testing.assert_array_equal(decoded, np.array(values, dtype=decoded.dtype))
+
+
+def test_encode_decode_round_trip():
+    features = {name: _FEATURES[kind](values) for name, (kind, values) in _VALUES.items()}
+    buf, decoded = _decode_example(_encode_example(features))
+    np.testing.assert_array_equal(decoded['label'][1], [-3])
+    np.testing.assert_array_equal(decoded['label_onehot'][1], [0, 1, 0, 2**40])
+    assert decoded['empty'][1].size == 0
+    np.testing.assert_array_equal(decoded['volume_list'][1], _VALUES['volume_list'][1])
+    assert [bytes(buf[start:stop]) for start, stop in decoded['volume'][1]] == \
+        _VALUES['volume'][1]